@@ -0,0 +1,219 @@
+"""
+按会话隔离的智能体
+
+原来 initialize_agents 用 st.cache_resource 创建一个回答者智能体，所有浏览器会话共用同一份对话记忆：
+一个用户的评估反馈（update_messages）会进入所有人的上下文，并发会话同时读写同一份记忆。这里：
+- 模型客户端（ModelFactory 创建的后端）仍在所有会话间共享，只创建一次；
+- SessionAgentPool 为每个会话创建自己的回答者智能体，记忆按消息条数和 token 上限截断，
+  “新对话”时清空；长时间不活跃或超出会话数上限的会话被回收；
+- AgentPool 管理评估、图片分析这类每次使用前都要清空记忆的无状态智能体，最多 size 个同时使用，
+  不同会话不必排队等同一个智能体。
+每个会话的上下文 token 数（按 context_packer.estimate_tokens 估算）可以随时查询。
+"""
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from context_packer import estimate_tokens
+
+
+def _record_tokens(record) -> int:
+    return estimate_tokens(str(getattr(record.memory_record.message, "content", "") or ""))
+
+
+def context_tokens(agent) -> tuple:
+    """估算智能体记忆中会随下一次请求发送的内容，返回 (消息条数, token数)"""
+    try:
+        records = agent.memory.retrieve()
+    except Exception:
+        return 0, 0
+    return len(records), sum(_record_tokens(record) for record in records)
+
+
+def compact_memory(agent, max_tokens: int) -> tuple:
+    """
+    只保留会随下一次请求发送的记录，并从最早的对话开始丢弃超出 max_tokens 的部分
+
+    camel 的 message_window_size 只限制发送的消息条数，记忆本身仍保存全部历史；
+    这里清空记忆后写回保留的记录（系统消息始终保留）。返回 (消息条数, token数)。
+    """
+    try:
+        records = agent.memory.retrieve()
+    except Exception:
+        return 0, 0
+    system = [record for record in records[:1]
+              if getattr(record.memory_record.role_at_backend, "value", "") in ("system", "developer")]
+    used = sum(_record_tokens(record) for record in system)
+    kept = []
+    for record in reversed(records[len(system):]):
+        tokens = _record_tokens(record)
+        if kept and used + tokens > max_tokens:
+            break
+        kept.insert(0, record)
+        used += tokens
+    agent.memory.clear()
+    agent.memory.write_records([record.memory_record for record in system + kept])
+    return len(system) + len(kept), used
+
+
+class AgentPool:
+    """无状态智能体池：取出时清空记忆，最多 size 个智能体同时使用，空闲的智能体留着复用"""
+
+    def __init__(self, factory, size: int = 2):
+        self.factory = factory
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self.created = 0
+        self.in_use = 0
+        self.waits = 0
+
+    @classmethod
+    def from_agent(cls, agent, size: int = 2):
+        """用已有的智能体创建池，需要更多智能体时克隆（不带记忆）"""
+        clone = getattr(agent, "clone", None)
+        pool = cls(clone if clone else (lambda: agent), size=size if clone else 1)
+        pool._idle.put(agent)
+        pool.created = 1
+        return pool
+
+    @contextmanager
+    def acquire(self):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.waits += 1
+            self._slots.acquire()
+        try:
+            try:
+                agent = self._idle.get_nowait()
+            except queue.Empty:
+                agent = self.factory()
+                with self._lock:
+                    self.created += 1
+            agent.reset()
+            with self._lock:
+                self.in_use += 1
+            try:
+                yield agent
+            finally:
+                with self._lock:
+                    self.in_use -= 1
+                self._idle.put(agent)
+        finally:
+            self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": self.size, "created": self.created, "in_use": self.in_use, "waits": self.waits}
+
+
+class SessionAgents:
+    """一个浏览器会话自己的智能体和上下文统计"""
+
+    def __init__(self, session_id: str, answerer, max_context_tokens: int = 6000):
+        self.session_id = session_id
+        self.answerer = answerer
+        self.max_context_tokens = max_context_tokens
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.turns = 0
+        self.context_messages = 0
+        self.context_tokens = 0
+        self.peak_context_tokens = 0
+
+    def record_turn(self) -> int:
+        """一轮问答结束后截断记忆并更新统计，返回当前上下文 token 数"""
+        self.turns += 1
+        self.last_used = time.time()
+        self.context_messages, self.context_tokens = compact_memory(self.answerer, self.max_context_tokens)
+        self.peak_context_tokens = max(self.peak_context_tokens, self.context_tokens)
+        return self.context_tokens
+
+    def record_cached_turn(self, question: str, answer: str) -> int:
+        """命中回答缓存时没有调用回答者：把这一轮问答写入记忆，后续追问仍能看到上下文"""
+        from camel.messages import BaseMessage
+        from camel.types import OpenAIBackendRole
+
+        self.answerer.update_memory(BaseMessage.make_user_message("用户", question), OpenAIBackendRole.USER)
+        self.answerer.update_memory(BaseMessage.make_assistant_message("智能旅游助手", answer),
+                                    OpenAIBackendRole.ASSISTANT)
+        return self.record_turn()
+
+    def reset(self):
+        """开始新对话：清空回答者的记忆"""
+        self.answerer.reset()
+        self.turns = 0
+        self.context_messages, self.context_tokens = context_tokens(self.answerer)
+        self.last_used = time.time()
+
+    def to_dict(self) -> dict:
+        return {
+            "session_id": self.session_id,
+            "turns": self.turns,
+            "context_messages": self.context_messages,
+            "context_tokens": self.context_tokens,
+            "peak_context_tokens": self.peak_context_tokens,
+            "idle_seconds": time.time() - self.last_used,
+        }
+
+
+class SessionAgentPool:
+    """
+    按会话分配回答者智能体
+
+    answerer_factory() 创建一个新的回答者智能体（共享模型客户端）；每轮问答后记忆截断到 max_context_tokens；
+    超过 idle_ttl 秒未使用的会话在下一次分配时回收，会话数超过 max_sessions 时回收最久未使用的会话。
+    """
+
+    def __init__(self, answerer_factory, max_sessions: int = 100, idle_ttl: float = 3600,
+                 max_context_tokens: int = 6000):
+        self.answerer_factory = answerer_factory
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_context_tokens = max_context_tokens
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    @staticmethod
+    def new_session_id() -> str:
+        return uuid.uuid4().hex
+
+    def get(self, session_id: str) -> SessionAgents:
+        now = time.time()
+        with self._lock:
+            for stale_id in [key for key, session in self._sessions.items()
+                             if key != session_id and now - session.last_used > self.idle_ttl]:
+                del self._sessions[stale_id]
+                self.evicted += 1
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = SessionAgents(session_id, self.answerer_factory(), self.max_context_tokens)
+                self._sessions[session_id] = session
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+                    self.evicted += 1
+            self._sessions.move_to_end(session_id)
+            session.last_used = now
+            return session
+
+    def reset(self, session_id: str):
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is not None:
+            session.reset()
+
+    def stats(self) -> dict:
+        with self._lock:
+            sessions = [session.to_dict() for session in self._sessions.values()]
+        return {
+            "sessions": len(sessions),
+            "evicted": self.evicted,
+            "total_context_tokens": sum(session["context_tokens"] for session in sessions),
+            "max_context_tokens": max((session["context_tokens"] for session in sessions), default=0),
+            "per_session": sessions,
+        }
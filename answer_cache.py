@@ -0,0 +1,153 @@
+"""
+语义回答缓存
+
+很多问题只是换了说法（例如侧边栏的示例问题），原来每次都要重新检索、调用 DeepSeek-V3 生成
+并评估。这里按问题向量缓存已经通过评估的回答：
+- 缓存键为 问题向量 + 咨询模式 + 知识库版本 + 图片感知哈希，模式、知识库或图片不同的问题不会命中；
+- 同一键空间内余弦相似度不低于 threshold、且提到的城市和数字（天数、人数等）完全相同的问题
+  直接返回缓存的回答。e5 对“北京3天”和“上海3天”这类只差一个实体的问题相似度常在 0.95 以上，
+  只看相似度会返回另一个城市的回答；
+- 条目超过 ttl 秒后失效，超过 max_size 条时淘汰最久未使用的条目。
+回答者带有会话记忆，追问的回答依赖之前的对话，聊天助手只在会话的第一轮查找和写入缓存，
+命中时把这一轮问答写入会话记忆。
+问题向量使用知识库的 e5 嵌入模型（带查询向量缓存）计算，可选持久化到 storage/answer_cache.json。
+"""
+import os
+import re
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from kb_partition import find_cities
+from persisted_cache import PersistedCache
+from settings import STORAGE_DIR
+
+ANSWER_CACHE_PATH = os.path.join(STORAGE_DIR, "answer_cache.json")
+
+_CHINESE_DIGITS = {"零": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+# 阿拉伯数字；中文数字只在后面跟着量词时计入，避免“一下”“一些”之类的词
+_NUMBER_PATTERN = re.compile(r"\d+|([零一二两三四五六七八九十]+)(?=[天日晚夜人位个岁元块周月])")
+
+
+def _chinese_number(text: str) -> int:
+    """十以内和几十几的中文数字"""
+    if "十" not in text:
+        return int("".join(str(_CHINESE_DIGITS[char]) for char in text))
+    tens, _, ones = text.partition("十")
+    return (_CHINESE_DIGITS.get(tens, 1) if tens else 1) * 10 + (_CHINESE_DIGITS.get(ones, 0) if ones else 0)
+
+
+def question_entities(question: str) -> list:
+    """问题中提到的城市和数字，[排序后的城市, 排序后的数字]，缓存命中时两者都必须相同"""
+    numbers = set()
+    for match in _NUMBER_PATTERN.finditer(question or ""):
+        try:
+            numbers.add(_chinese_number(match.group(1)) if match.group(1) else int(match.group(0)))
+        except (KeyError, ValueError):
+            continue
+    return [sorted(set(find_cities(question))), sorted(numbers)]
+
+
+class SemanticAnswerCache(PersistedCache):
+    """线程安全的语义回答缓存"""
+
+    label = "回答缓存"
+
+    def __init__(self, embedding_model, threshold: float = 0.95, ttl: float = 24 * 3600,
+                 max_size: int = 500, path: str = None, model_name: str = "", save_every: int = 5):
+        self.embedding_model = embedding_model
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.model_name = model_name
+        self._entries = OrderedDict()
+        self._next_id = 0
+        self.hits = 0
+        self.misses = 0
+        super().__init__(path, save_every)
+
+    def _restore(self, data: dict):
+        # 换了嵌入模型后旧向量不能再用
+        if data.get("model") != self.model_name:
+            print(f"回答缓存的嵌入模型不一致，忽略旧缓存: {self.path}")
+            return
+        now = time.time()
+        for entry in data.get("entries", [])[-self.max_size:]:
+            if now - entry["created"] > self.ttl:
+                continue
+            entry["vector"] = np.asarray(entry["vector"], dtype=np.float32)
+            entry.setdefault("entities", question_entities(entry["question"]))
+            self._entries[self._next_id] = entry
+            self._next_id += 1
+        print(f"已加载 {len(self._entries)} 条回答缓存")
+
+    def _snapshot(self) -> dict:
+        entries = [dict(entry, vector=entry["vector"].tolist()) for entry in self._entries.values()]
+        return {"model": self.model_name, "entries": entries}
+
+    def embed(self, question: str) -> np.ndarray:
+        vector = np.asarray(self.embedding_model.embed(obj=question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, question: str, kb_version: str = "", image_hash: str = "", mode: str = ""):
+        """
+        查找相似问题的缓存回答
+
+        Returns:
+            (条目或None, 问题向量, 最高相似度)。问题向量可以直接传给 put，不必重复编码。
+        """
+        vector = self.embed(question)
+        entities = question_entities(question)
+        now = time.time()
+        with self._lock:
+            best_id, best_similarity = None, 0.0
+            for entry_id, entry in list(self._entries.items()):
+                if now - entry["created"] > self.ttl:
+                    del self._entries[entry_id]
+                    self._unsaved += 1
+                    continue
+                if (entry["kb_version"] != kb_version or entry["image_hash"] != image_hash
+                        or entry.get("mode", "") != mode or entry["entities"] != entities):
+                    continue
+                similarity = float(np.dot(entry["vector"], vector))
+                if similarity > best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+            if best_id is None or best_similarity < self.threshold:
+                self.misses += 1
+                return None, vector, best_similarity
+            self._entries.move_to_end(best_id)
+            entry = self._entries[best_id]
+            entry["hits"] = entry.get("hits", 0) + 1
+            self.hits += 1
+            return {key: value for key, value in entry.items() if key != "vector"}, vector, best_similarity
+
+    def put(self, question: str, answer: str, kb_version: str = "", image_hash: str = "", mode: str = "",
+            vector: np.ndarray = None, **extra):
+        """缓存一个已经通过评估的回答；extra 中的字段（知识库信息、图片描述等）随条目一起返回"""
+        if vector is None:
+            vector = self.embed(question)
+        entry = dict(extra, question=question, answer=answer, kb_version=kb_version,
+                     image_hash=image_hash, mode=mode, entities=question_entities(question),
+                     created=time.time(), hits=0,
+                     vector=np.asarray(vector, dtype=np.float32))
+        with self._lock:
+            self._entries[self._next_id] = entry
+            self._next_id += 1
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._unsaved += 1
+            should_save = self._should_save()
+        if should_save:
+            self.save()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
@@ -0,0 +1,278 @@
+"""
+分层回答评估
+
+原来每个回答都要同步等待 DeepSeek-R1（推理模型，经 OpenRouter）打分，首个回答的显示时间
+至少是两次大模型调用之和。这里改为分层评估：
+1. 本地启发式打分（长度、是否拒答、问题关键词覆盖、是否用到知识库/图片信息、结构、重复度），
+   耗时不到1毫秒，明显合格或明显不合格的回答直接给出结论；
+2. 只有处于两者之间的回答才同步调用大模型评估；
+3. 启发式直接通过的回答按抽样比例在后台交给大模型复核，只记录日志，用于校准阈值。
+
+每次评估的层级、分数和耗时写入 JSONL 日志，并在内存中汇总分数分布和各层延迟。
+"""
+import json
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from camel.messages import BaseMessage as bm
+
+from agent_pool import AgentPool
+from context_packer import estimate_tokens, trim_to_tokens
+from kb_hybrid import tokenize
+from settings import STORAGE_DIR
+
+EVAL_LOG_PATH = os.path.join(STORAGE_DIR, "answer_eval.jsonl")
+
+# 评估方式
+MODE_TIERED = "tiered"
+MODE_JUDGE = "judge"
+MODE_HEURISTIC = "heuristic"
+
+# 评估层级
+TIER_HEURISTIC_ACCEPT = "heuristic_accept"
+TIER_HEURISTIC_REJECT = "heuristic_reject"
+TIER_JUDGE = "judge"
+TIER_AUDIT = "audit"
+
+# 大模型评分达到该值视为合格（与原来的判断一致）
+JUDGE_PASS_SCORE = 6
+
+REFUSAL_PATTERNS = ["抱歉", "对不起", "无法回答", "我不知道", "无法提供", "不能回答", "只对旅游方面"]
+_LIST_PATTERN = re.compile(r"(^|\n)\s*(\d+[\.、）)]|[-*•]|#+|第[一二三四五六七八九十\d]+天|Day\s*\d)")
+
+
+def heuristic_score(question: str, answer: str, knowledge_info: str = "", image_description: str = ""):
+    """
+    本地启发式打分，返回 (1~10的分数, 扣分原因列表)
+
+    分数与大模型评分使用同一量纲，阈值可以直接对照。
+    """
+    text = (answer or "").strip()
+    reasons = []
+    score = 6.0
+
+    if len(text) < 30:
+        score -= 4
+        reasons.append("回答过短")
+    elif len(text) < 120:
+        score -= 1.5
+        reasons.append("回答较简略")
+    elif len(text) >= 300:
+        score += 1
+
+    if any(pattern in text[:80] for pattern in REFUSAL_PATTERNS):
+        score -= 3
+        reasons.append("回答以道歉或拒答开头")
+
+    answer_terms = set(tokenize(text))
+    question_terms = {term for term in tokenize(question) if len(term) > 1}
+    if question_terms:
+        coverage = len(question_terms & answer_terms) / len(question_terms)
+        score += 2 * coverage - 1
+        if coverage < 0.3:
+            reasons.append("没有回应问题中的关键词")
+
+    for name, context in [("知识库", knowledge_info), ("图片", image_description)]:
+        if not context:
+            continue
+        context_terms = {term for term in tokenize(context) if len(term) > 1}
+        if len(context_terms & answer_terms) >= min(3, len(context_terms)):
+            score += 0.5
+        else:
+            score -= 1
+            reasons.append(f"没有用到{name}信息")
+
+    if _LIST_PATTERN.search(text):
+        score += 0.5
+
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if len(lines) >= 5 and len(set(lines)) / len(lines) < 0.6:
+        score -= 2
+        reasons.append("内容重复")
+
+    return max(1.0, min(10.0, score)), reasons
+
+
+def build_judge_prompt(question: str, answer: str, knowledge_info: str = "", image_description: str = "",
+                       answer_tokens: int = 900, knowledge_tokens: int = 600) -> str:
+    """大模型评估提示词（按 token 预算在句子边界处截断过长的回答和知识库内容）"""
+    truncated_answer, _ = trim_to_tokens(answer, answer_tokens)
+    truncated_kb, _ = trim_to_tokens(knowledge_info, knowledge_tokens)
+    return f"""
+请评估以下问答过程的质量：
+
+【用户提问】
+{question}
+
+【图片信息】
+{image_description if image_description else "无图片"}
+
+【知识库信息】
+{truncated_kb if truncated_kb else "未使用知识库"}
+
+【回答者回复摘要】
+{truncated_answer}
+
+【评分标准】
+请从准确性、完整性、清晰度等方面进行打分（1~10），并简要说明理由。
+
+请只返回一个数字 + 简要理由。
+"""
+
+
+def parse_judge_score(content: str):
+    """解析 "8 理由..." / "8. 理由..." 格式的评分，解析失败返回None"""
+    try:
+        return int(float(content.split()[0].strip('.')))
+    except (ValueError, IndexError):
+        return None
+
+
+class TieredEvaluator:
+    """
+    分层回答评估器
+
+    mode:
+        tiered    - 启发式分数 >= accept_threshold 直接通过，< reject_threshold 直接重新生成，其余交给大模型；
+        judge     - 每个回答都同步交给大模型（原来的行为）；
+        heuristic - 只用启发式分数，>= reject_threshold 即通过。
+    """
+
+    def __init__(self, evaluator_agent, mode: str = MODE_TIERED, accept_threshold: float = 7.0,
+                 reject_threshold: float = 4.0, audit_rate: float = 0.1, log_path: str = EVAL_LOG_PATH,
+                 answer_tokens: int = 900, knowledge_tokens: int = 600):
+        self.mode = mode
+        self.accept_threshold = accept_threshold
+        self.reject_threshold = reject_threshold
+        self.audit_rate = audit_rate
+        self.log_path = log_path
+        # 评估提示词中回答和知识库内容的 token 预算
+        self.answer_tokens = answer_tokens
+        self.knowledge_tokens = knowledge_tokens
+        # 评估智能体从池中取用（传入单个智能体时按需克隆），不同会话的评估和后台复核可以同时进行
+        self.agents = evaluator_agent if isinstance(evaluator_agent, AgentPool) else AgentPool.from_agent(evaluator_agent)
+        self._log_lock = threading.Lock()
+        self._audit_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="answer-audit")
+        self._records = []
+
+    def judge(self, question: str, answer: str, knowledge_info: str = "", image_description: str = ""):
+        """同步调用大模型评估，返回 (分数或None, 评估内容, 提示词token数)"""
+        prompt = build_judge_prompt(question, answer, knowledge_info, image_description,
+                                    self.answer_tokens, self.knowledge_tokens)
+        prompt_tokens = estimate_tokens(prompt)
+        evaluation_msg = bm.make_user_message(role_name='评估器', content=prompt)
+        # 每次评估相互独立，取出的智能体已清空之前的评估对话
+        with self.agents.acquire() as agent:
+            response = agent.step(evaluation_msg)
+        if not response or not hasattr(response, 'msgs') or not response.msgs:
+            return None, "", prompt_tokens
+        content = response.msgs[0].content.strip()
+        return parse_judge_score(content), content, prompt_tokens
+
+    def evaluate(self, question: str, answer: str, knowledge_info: str = "", image_description: str = "") -> dict:
+        """
+        评估一个回答
+
+        Returns:
+            dict: passed（是否通过）、score、tier（决定结果的层级）、feedback（不通过时给回答者的改进建议）、
+                  heuristic_score、reasons、prompt_tokens（评估提示词token数，未调用大模型时为0）、seconds
+        """
+        start = time.perf_counter()
+        h_score, reasons = heuristic_score(question, answer, knowledge_info, image_description)
+        result = {"heuristic_score": h_score, "reasons": reasons, "judge_content": "", "prompt_tokens": 0}
+
+        if self.mode == MODE_HEURISTIC or (
+                self.mode == MODE_TIERED and (h_score >= self.accept_threshold or h_score < self.reject_threshold)):
+            passed = h_score >= (self.reject_threshold if self.mode == MODE_HEURISTIC else self.accept_threshold)
+            result.update({
+                "passed": passed,
+                "score": h_score,
+                "tier": TIER_HEURISTIC_ACCEPT if passed else TIER_HEURISTIC_REJECT,
+                "feedback": "" if passed else "；".join(reasons) or "回答质量不够理想",
+            })
+        else:
+            judge_score, content, result["prompt_tokens"] = self.judge(question, answer, knowledge_info, image_description)
+            # 评估失败或无法解析分数时默认通过，与原来的处理一致
+            passed = judge_score is None or judge_score >= JUDGE_PASS_SCORE
+            result.update({
+                "passed": passed,
+                "score": judge_score,
+                "tier": TIER_JUDGE,
+                "feedback": "" if passed else content,
+                "judge_content": content,
+            })
+        result["seconds"] = time.perf_counter() - start
+        self._record(result)
+
+        if result["tier"] == TIER_HEURISTIC_ACCEPT and self.audit_rate > 0 and random.random() < self.audit_rate:
+            self._audit_executor.submit(self._audit, question, answer, knowledge_info, image_description, h_score)
+        return result
+
+    def _audit(self, question, answer, knowledge_info, image_description, h_score):
+        """后台复核启发式直接通过的回答，只记录日志，不影响已经显示的回答"""
+        start = time.perf_counter()
+        try:
+            judge_score, _, prompt_tokens = self.judge(question, answer, knowledge_info, image_description)
+        except Exception as e:
+            print(f"回答复核失败: {str(e)}")
+            return
+        self._record({
+            "tier": TIER_AUDIT,
+            "heuristic_score": h_score,
+            "score": judge_score,
+            "passed": judge_score is None or judge_score >= JUDGE_PASS_SCORE,
+            "prompt_tokens": prompt_tokens,
+            "seconds": time.perf_counter() - start,
+        })
+
+    def _record(self, result: dict):
+        record = {
+            "time": time.time(),
+            "mode": self.mode,
+            "tier": result["tier"],
+            "heuristic_score": round(result["heuristic_score"], 2),
+            "score": result["score"],
+            "passed": result["passed"],
+            "prompt_tokens": result.get("prompt_tokens", 0),
+            "seconds": round(result["seconds"], 4),
+        }
+        with self._log_lock:
+            self._records.append(record)
+            del self._records[:-1000]
+            if not self.log_path:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except Exception as e:
+                print(f"写入回答评估日志失败: {str(e)}")
+
+    def stats(self) -> dict:
+        """最近的评估按层级汇总：次数、通过率、平均分、分数分布和延迟"""
+        with self._log_lock:
+            records = list(self._records)
+        summary = {}
+        for tier in (TIER_HEURISTIC_ACCEPT, TIER_HEURISTIC_REJECT, TIER_JUDGE, TIER_AUDIT):
+            tier_records = [r for r in records if r["tier"] == tier]
+            if not tier_records:
+                continue
+            scores = [r["score"] for r in tier_records if r["score"] is not None]
+            latencies = sorted(r["seconds"] for r in tier_records)
+            histogram = {}
+            for value in scores:
+                bucket = int(round(value))
+                histogram[bucket] = histogram.get(bucket, 0) + 1
+            summary[tier] = {
+                "count": len(tier_records),
+                "pass_rate": sum(1 for r in tier_records if r["passed"]) / len(tier_records),
+                "mean_score": sum(scores) / len(scores) if scores else None,
+                "histogram": dict(sorted(histogram.items())),
+                "p50_seconds": latencies[len(latencies) // 2],
+                "p95_seconds": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            }
+        return summary
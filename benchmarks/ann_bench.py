@@ -0,0 +1,139 @@
+"""
+知识库向量索引的延迟/召回基准测试
+
+用带聚类结构的随机向量模拟不同规模的知识库，对比：
+- 精确查询（numpy 暴力计算，与本地Qdrant的查询方式相同）；
+- HNSWIndex 在不同 ef_search 下的延迟和 recall@k；
+- 建图耗时、增量插入耗时和内存占用。
+
+示例：
+    python benchmarks/ann_bench.py --sizes 10000 100000
+    python benchmarks/ann_bench.py --sizes 10000 100000 1000000 --dim 1024 --json ann_result.json
+
+注意：1M × 1024 维时原始向量约 4GB，HNSW 图中还有一份副本，内存不足时可用 --dim 384 等较小维度。
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from common import print_table, summarize, write_json
+from kb_ann import HNSWIndex, hnswlib
+from kb_index import normalize_vectors
+
+
+def make_vectors(count: int, dim: int, clusters: int, rng) -> np.ndarray:
+    """生成按主题聚类的归一化向量，分块生成以控制峰值内存"""
+    centers = normalize_vectors(rng.standard_normal((clusters, dim), dtype=np.float32))
+    vectors = np.empty((count, dim), dtype=np.float32)
+    for start in range(0, count, 100000):
+        end = min(count, start + 100000)
+        assignment = rng.integers(0, clusters, end - start)
+        noise = rng.standard_normal((end - start, dim), dtype=np.float32) * 0.06
+        vectors[start:end] = normalize_vectors(centers[assignment] + noise)
+    return vectors
+
+
+def exact_top_k(vectors: np.ndarray, queries: np.ndarray, top_k: int):
+    """精确结果和单次查询耗时"""
+    truth, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        scores = vectors @ query
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        latencies.append(time.perf_counter() - start)
+        truth.append([str(i) for i in top])
+    return truth, latencies
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="知识库向量索引延迟/召回基准测试")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[10000, 100000, 1000000], help="知识库分块数量")
+    parser.add_argument("--dim", type=int, default=1024, help="向量维度（e5-large-v2 为 1024）")
+    parser.add_argument("--clusters", type=int, default=256, help="模拟的主题数量")
+    parser.add_argument("--queries", type=int, default=200, help="查询数量")
+    parser.add_argument("--top-k", type=int, default=10, help="计算 recall@k 的 k")
+    parser.add_argument("--ef-search", type=int, nargs="*", default=[32, 64, 128], help="HNSW 查询参数")
+    parser.add_argument("--m", type=int, default=16, help="HNSW 每个节点的邻居数")
+    parser.add_argument("--ef-construction", type=int, default=200, help="HNSW 建图参数")
+    parser.add_argument("--inserts", type=int, default=1000, help="建图后增量插入的向量数")
+    parser.add_argument("--seed", type=int, default=42, help="随机种子")
+    parser.add_argument("--json", dest="json_path", help="把结果写入JSON文件")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if hnswlib is None:
+        print("需要先安装 hnswlib：pip install hnswlib")
+        return
+    rng = np.random.default_rng(args.seed)
+    original_cwd = os.getcwd()
+    results = []
+
+    for size in args.sizes:
+        print(f"\n===== {size} 个分块，{args.dim} 维 =====")
+        vectors = make_vectors(size + args.inserts, args.dim, args.clusters, rng)
+        base, extra = vectors[:size], vectors[size:]
+        picks = rng.choice(size, size=args.queries, replace=False)
+        queries = normalize_vectors(base[picks] + rng.standard_normal((args.queries, args.dim), dtype=np.float32) * 0.03)
+        ids = [str(i) for i in range(size)]
+
+        truth, exact_latencies = exact_top_k(base, queries, args.top_k)
+
+        index = HNSWIndex(dim=args.dim, path=tempfile.mkdtemp(prefix="ann_bench_"), exact_threshold=0,
+                          m=args.m, ef_construction=args.ef_construction)
+        start = time.perf_counter()
+        index.build(ids, base)
+        build_seconds = time.perf_counter() - start
+        print(f"建图耗时 {build_seconds:.2f} 秒（{size / build_seconds:.0f} 个/秒）")
+
+        rows = {"exact": summarize(exact_latencies)}
+        recalls = {"exact": 1.0}
+        for ef in args.ef_search:
+            index.ef_search = ef
+            latencies, hits = [], 0
+            for query, expected in zip(queries, truth):
+                start = time.perf_counter()
+                found = index.search(query, args.top_k)
+                latencies.append(time.perf_counter() - start)
+                hits += len({point_id for point_id, _ in found} & set(expected))
+            rows[f"hnsw ef={ef}"] = summarize(latencies)
+            recalls[f"hnsw ef={ef}"] = hits / (len(queries) * args.top_k)
+
+        # 增量插入：模拟上传新文档，每次插入一批
+        insert_latencies = []
+        for start_row in range(0, len(extra), 100):
+            batch = extra[start_row:start_row + 100]
+            start = time.perf_counter()
+            index.add([f"new-{size}-{start_row + i}" for i in range(len(batch))], batch)
+            insert_latencies.append(time.perf_counter() - start)
+        rows["insert x100"] = summarize(insert_latencies)
+
+        ms_rows = {name: {key: (value * 1000 if key != "count" else value) for key, value in stats.items()}
+                   for name, stats in rows.items()}
+        print_table(f"{size} 个分块（recall@{args.top_k}: "
+                    + ", ".join(f"{name} {recall:.3f}" for name, recall in recalls.items()) + "）",
+                    ms_rows, unit="毫秒")
+        memory = index.memory_bytes()
+        print(f"内存：原始向量 {memory['full_precision'] / 1024 ** 2:.1f}MB，HNSW 图 {memory['graph'] / 1024 ** 2:.1f}MB")
+
+        results.append({
+            "size": size,
+            "dim": args.dim,
+            "build_seconds": build_seconds,
+            "latency_ms": ms_rows,
+            "recall": recalls,
+            "memory_bytes": memory,
+        })
+        del index, vectors, base, extra
+
+    if args.json_path:
+        write_json(os.path.join(original_cwd, args.json_path), {"config": vars(args), "results": results})
+
+
+if __name__ == "__main__":
+    main()
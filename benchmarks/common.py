@@ -0,0 +1,65 @@
+"""
+基准测试共用的工具函数
+"""
+import json
+import math
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 基准测试脚本位于 benchmarks/ 下，需要能导入项目根目录的模块
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+
+def percentile(values: list, p: float) -> float:
+    """最近秩法计算百分位数，values 为空时返回0"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100.0 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(values: list) -> dict:
+    """返回一组耗时（秒）的统计信息"""
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else 0.0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else 0.0,
+    }
+
+
+def print_table(title: str, rows: dict, unit: str = "秒"):
+    """按 名称 -> summarize() 结果打印统计表"""
+    print(f"\n{title}")
+    print(f"{'名称':<16}{'次数':>8}{'平均':>10}{'p50':>10}{'p95':>10}{'p99':>10}  ({unit})")
+    for name, stats in rows.items():
+        print(f"{name:<16}{stats['count']:>8}{stats['mean']:>10.3f}{stats['p50']:>10.3f}"
+              f"{stats['p95']:>10.3f}{stats['p99']:>10.3f}")
+
+
+def compact(text: str) -> str:
+    """去掉全部空白，比较分块和原文片段时不受换行、空格影响"""
+    return "".join(text.split())
+
+
+def make_chunker(spec: str, workers: int = 4):
+    """chinese:大小:重叠 或 unstructured，返回 KnowledgeBaseIngestor 可用的分块函数"""
+    if spec == "unstructured":
+        from kb_ingest import unstructured_chunks
+        return unstructured_chunks
+    from kb_chunking import ChineseChunker
+    _, size, overlap = (spec.split(":") + ["400", "80"])[:3]
+    return ChineseChunker(chunk_size=int(size), overlap=int(overlap), workers=workers)
+
+
+def write_json(path: str, data: dict):
+    """把结果写入JSON文件，便于回归对比"""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存到: {path}")
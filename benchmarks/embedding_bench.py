@@ -0,0 +1,134 @@
+"""
+嵌入后端吞吐量和延迟基准测试
+
+用 benchmarks/data/retrieval_questions.json 中的问题作为查询，对每个后端比较：
+- direct：多个线程直接调用编码器逐条编码（原来多个会话同时提问时的情况）；
+- batched：同样的线程通过 MicroBatcher 提交，编码请求合并成小批量；
+- 单次查询延迟 p50/p99、吞吐量（查询/秒）和平均批大小；
+- 与 torch 后端向量的余弦相似度（量化模型的偏差），torch 不在对比列表中时跳过。
+
+示例：
+    python benchmarks/embedding_bench.py --backends torch onnx onnx-int8 --clients 1 4 16
+    # 测试已经启动的本地嵌入服务（python embedding_service.py）
+    python benchmarks/embedding_bench.py --backends torch service --json embedding_result.json
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from common import REPO_DIR, summarize, write_json
+from embedding_backend import EMBEDDING_MODEL_NAME, MicroBatcher, RemoteEmbedding, create_encoder
+from settings import EMBEDDING_SERVICE_URL
+
+DEFAULT_QUESTIONS = os.path.join(REPO_DIR, "benchmarks", "data", "retrieval_questions.json")
+
+
+def run_clients(embed_one, queries: list, clients: int) -> dict:
+    """clients 个线程分摊全部查询，返回延迟统计（毫秒）和吞吐量"""
+    latencies = []
+
+    def worker(part):
+        local = []
+        for query in part:
+            start = time.perf_counter()
+            embed_one(query)
+            local.append(time.perf_counter() - start)
+        return local
+
+    parts = [queries[i::clients] for i in range(clients)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        for local in executor.map(worker, parts):
+            latencies.extend(local)
+    elapsed = time.perf_counter() - start
+    stats = {key: (value * 1000 if key != "count" else value) for key, value in summarize(latencies).items()}
+    stats["queries_per_second"] = len(queries) / elapsed
+    return stats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="嵌入后端吞吐量和延迟基准测试")
+    parser.add_argument("--backends", nargs="*", default=["torch", "onnx", "onnx-int8"],
+                        choices=["torch", "onnx", "onnx-int8", "service"], help="参与对比的后端")
+    parser.add_argument("--model", default=EMBEDDING_MODEL_NAME, help="SentenceTransformer 模型名")
+    parser.add_argument("--quantization", default="avx2", help="onnx-int8 的量化配置：arm64 / avx2 / avx512 / avx512_vnni")
+    parser.add_argument("--service-url", default=EMBEDDING_SERVICE_URL, help="本地嵌入服务地址")
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS, help="查询文本来源")
+    parser.add_argument("--queries", type=int, default=200, help="每轮的查询数（问题循环使用）")
+    parser.add_argument("--clients", type=int, nargs="*", default=[1, 4, 16], help="并发线程数")
+    parser.add_argument("--max-batch", type=int, default=32, help="批处理的最大批大小")
+    parser.add_argument("--max-wait-ms", type=float, default=2, help="批处理的最长等待时间")
+    parser.add_argument("--json", dest="json_path", help="把结果写入JSON文件")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    original_cwd = os.getcwd()
+    with open(args.questions, "r", encoding="utf-8") as f:
+        questions = [item["question"] for item in json.load(f)["questions"]]
+    # 循环使用问题时加上序号，避免测到任何缓存
+    queries = [f"{questions[i % len(questions)]} ({i})" for i in range(args.queries)]
+
+    results, reference = {}, None
+    backends = sorted(args.backends, key=lambda name: name != "torch")
+    for backend in backends:
+        print(f"\n===== {backend} =====")
+        start = time.perf_counter()
+        try:
+            if backend == "service":
+                encoder = RemoteEmbedding(args.service_url)
+                model_id = encoder.model_id
+            else:
+                encoder, model_id = create_encoder(backend, args.model, args.quantization)
+        except Exception as e:
+            print(f"无法加载，跳过（{str(e)}）")
+            continue
+        entry = {"model": model_id, "load_seconds": time.perf_counter() - start, "runs": {}}
+        encoder.embed_list(questions[:4])  # 预热
+
+        vectors = np.asarray(encoder.embed_list(questions), dtype=np.float32)
+        if backend == "torch":
+            reference = vectors
+        elif reference is not None:
+            cosine = np.sum(vectors * reference, axis=1) / (
+                np.linalg.norm(vectors, axis=1) * np.linalg.norm(reference, axis=1))
+            entry["cosine_to_torch"] = {"mean": float(cosine.mean()), "min": float(cosine.min())}
+            print(f"与 torch 向量的余弦相似度：平均 {cosine.mean():.4f}，最低 {cosine.min():.4f}")
+
+        for clients in args.clients:
+            direct = run_clients(lambda text: encoder.embed_list([text]), queries, clients)
+            # 服务端已经有批处理队列，客户端再加一层没有意义
+            if backend == "service":
+                modes = {"direct": direct}
+            else:
+                batcher = MicroBatcher(encoder.embed_list, max_batch=args.max_batch,
+                                       max_wait=args.max_wait_ms / 1000)
+                batched = run_clients(lambda text: batcher.encode([text]), queries, clients)
+                batched["mean_batch_size"] = batcher.stats()["mean_batch_size"]
+                modes = {"direct": direct, "batched": batched}
+            entry["runs"][clients] = modes
+            for mode, stats in modes.items():
+                extra = f"，平均批大小 {stats['mean_batch_size']:.1f}" if "mean_batch_size" in stats else ""
+                print(f"{clients:>3} 个并发 {mode:<8} p50 {stats['p50']:8.1f} ms  p99 {stats['p99']:8.1f} ms  "
+                      f"{stats['queries_per_second']:7.1f} 查询/秒{extra}")
+        results[backend] = entry
+
+    if "torch" in results:
+        print("\n相对 torch 逐条编码（direct）的吞吐量：")
+        for clients in args.clients:
+            baseline = results["torch"]["runs"][clients]["direct"]["queries_per_second"]
+            row = [f"{backend}/{mode} {stats['queries_per_second'] / baseline:.2f}x"
+                   for backend, entry in results.items() for mode, stats in entry["runs"][clients].items()]
+            print(f"{clients:>3} 个并发：" + "，".join(row))
+
+    if args.json_path:
+        write_json(os.path.join(original_cwd, args.json_path), {"config": vars(args), "results": results})
+
+
+if __name__ == "__main__":
+    main()
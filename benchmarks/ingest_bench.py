@@ -0,0 +1,182 @@
+"""
+知识库入库吞吐量和分块质量基准测试
+
+对同一批文档比较不同的分块方式：
+- PDF 文本抽取在不同进程数下的速度（页/秒）；
+- 分块速度（分块/秒）、分块数量和长度分布、在句末标点处结束的分块比例；
+- 可选：用嵌入模型按不同批大小编码分块的速度（分块/秒）；
+- 检索质量：从文档中随机抽取句子，取其中间一段作为查询，统计包含该句的分块
+  在 BM25（以及可选的向量检索）结果中的 hit@k 和 MRR，并统计完整落在某个分块内的句子比例。
+
+示例：
+    python benchmarks/ingest_bench.py
+    python benchmarks/ingest_bench.py --chunkers unstructured chinese:400:80 chinese:300:60 --workers 1 2 4
+    python benchmarks/ingest_bench.py --model intfloat/e5-large-v2 --embed-batch 16 64 --json ingest_result.json
+"""
+import argparse
+import glob
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from common import REPO_DIR, compact, make_chunker, write_json
+from kb_chunking import extract_pages, merge_wrapped_lines, split_sentences
+from kb_hybrid import BM25Index
+
+_SENTENCE_ENDINGS = "。！？；…!?;.”’」』）)"
+
+
+def make_probes(paths: list, count: int, rng) -> list:
+    """从文档中抽取 (完整句子, 查询片段)，查询片段去掉句子首尾各约20%"""
+    sentences = []
+    for path in paths:
+        for _, paragraph in merge_wrapped_lines(extract_pages(path, workers=1)):
+            sentences.extend(compact(sentence) for sentence in split_sentences(paragraph))
+    sentences = [sentence for sentence in sentences if len(sentence) >= 20]
+    probes = []
+    for sentence in rng.sample(sentences, min(count, len(sentences))):
+        cut = len(sentence) // 5
+        probes.append((sentence, sentence[cut:len(sentence) - cut]))
+    return probes
+
+
+def retrieval_quality(ranked_lists: list, chunk_texts: list, probes: list, top_k: int) -> dict:
+    """ranked_lists[i] 为第i个查询返回的分块序号列表"""
+    compact_chunks = [compact(text) for text in chunk_texts]
+    hits, reciprocal_ranks = 0, 0.0
+    for ranked, (_, query) in zip(ranked_lists, probes):
+        for rank, number in enumerate(ranked[:top_k], start=1):
+            if query in compact_chunks[number]:
+                hits += 1
+                reciprocal_ranks += 1.0 / rank
+                break
+    return {"hit_at_k": hits / len(probes), "mrr": reciprocal_ranks / len(probes)}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="知识库入库吞吐量和分块质量基准测试")
+    parser.add_argument("--files", nargs="*", default=glob.glob(os.path.join(REPO_DIR, "local_data", "*.pdf")),
+                        help="参与测试的文档，默认 local_data/ 下的全部PDF")
+    parser.add_argument("--chunkers", nargs="*", default=["unstructured", "chinese:400:80"],
+                        help="分块方式：unstructured 或 chinese:大小:重叠")
+    parser.add_argument("--workers", type=int, nargs="*", default=[1, 2, 4], help="PDF 抽取的进程数")
+    parser.add_argument("--repeat", type=int, default=3, help="抽取和分块的重复次数，取最快一次")
+    parser.add_argument("--model", help="可选：SentenceTransformer 模型名，测试编码速度和向量检索质量")
+    parser.add_argument("--embed-batch", type=int, nargs="*", default=[32, 128], help="编码批大小")
+    parser.add_argument("--probes", type=int, default=100, help="检索质量测试的查询数")
+    parser.add_argument("--top-k", type=int, default=3, help="计算 hit@k 的 k")
+    parser.add_argument("--seed", type=int, default=42, help="随机种子")
+    parser.add_argument("--json", dest="json_path", help="把结果写入JSON文件")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not args.files:
+        print("没有找到要测试的文档，请用 --files 指定")
+        return
+    rng = random.Random(args.seed)
+    original_cwd = os.getcwd()
+    results = {"files": args.files, "extraction": {}, "chunkers": {}}
+
+    # 1. 文本抽取
+    print("\n===== 文本抽取 =====")
+    for workers in args.workers:
+        best, pages = None, 0
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            pages = sum(len(extract_pages(path, workers)) for path in args.files)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results["extraction"][workers] = {"pages": pages, "seconds": best, "pages_per_second": pages / best}
+        print(f"{workers} 个进程：{pages} 页，{best:.3f} 秒，{pages / best:.1f} 页/秒")
+
+    probes = make_probes(args.files, args.probes, rng)
+    if not probes:
+        print("\n文档中没有不少于20个字的句子，跳过完整句子比例和检索质量测试")
+    encoder = None
+    if args.model:
+        from camel.embeddings import SentenceTransformerEncoder
+        encoder = SentenceTransformerEncoder(model_name=args.model)
+
+    # 2. 分块、编码和检索质量
+    for spec in args.chunkers:
+        print(f"\n===== 分块方式 {spec} =====")
+        chunker = make_chunker(spec, max(args.workers))
+        best, chunks = None, []
+        try:
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                chunks = [chunk for path in args.files for chunk in chunker(path)]
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+        except Exception as e:
+            print(f"分块失败，跳过：{str(e)}")
+            continue
+        texts = [chunk["text"] for chunk in chunks]
+        if not texts:
+            print("没有产生任何分块，跳过")
+            continue
+        lengths = sorted(len(text) for text in texts)
+        compact_texts = [compact(text) for text in texts]
+        entry = {
+            "chunks": len(texts),
+            "seconds": best,
+            "chunks_per_second": len(texts) / best,
+            "length_min": lengths[0],
+            "length_p50": lengths[len(lengths) // 2],
+            "length_max": lengths[-1],
+            "sentence_end_ratio": sum(1 for text in texts if text.rstrip()[-1:] in _SENTENCE_ENDINGS) / len(texts),
+            "intact_sentence_ratio": sum(1 for sentence, _ in probes
+                                         if any(sentence in text for text in compact_texts)) / len(probes)
+                                     if probes else None,
+        }
+        intact = f"，完整包含抽样句子 {entry['intact_sentence_ratio']:.0%}" if probes else ""
+        print(f"{len(texts)} 个分块，{best:.3f} 秒，{entry['chunks_per_second']:.1f} 分块/秒；"
+              f"长度 最小 {entry['length_min']} / 中位 {entry['length_p50']} / 最大 {entry['length_max']}；"
+              f"以句末标点结束 {entry['sentence_end_ratio']:.0%}{intact}")
+
+        if probes:
+            bm25_dir = tempfile.mkdtemp(prefix="ingest_bench_bm25_")
+            try:
+                lexical_index = BM25Index(path=bm25_dir)
+                lexical_index.build([(str(number), text) for number, text in enumerate(texts)])
+                ranked = [[int(doc_id) for doc_id, _ in lexical_index.search(query, top_k=args.top_k)]
+                          for _, query in probes]
+            finally:
+                shutil.rmtree(bm25_dir, ignore_errors=True)
+            entry["bm25"] = retrieval_quality(ranked, texts, probes, args.top_k)
+            print(f"BM25 hit@{args.top_k} {entry['bm25']['hit_at_k']:.3f}，MRR {entry['bm25']['mrr']:.3f}")
+
+        if encoder is not None:
+            import numpy as np
+
+            entry["encoding"] = {}
+            vectors = None
+            for batch_size in args.embed_batch:
+                start = time.perf_counter()
+                vectors = []
+                for i in range(0, len(texts), batch_size):
+                    vectors.extend(encoder.embed_list(texts[i:i + batch_size]))
+                elapsed = time.perf_counter() - start
+                entry["encoding"][batch_size] = {"seconds": elapsed, "chunks_per_second": len(texts) / elapsed}
+                print(f"编码批大小 {batch_size}：{elapsed:.2f} 秒，{len(texts) / elapsed:.1f} 分块/秒")
+            if not probes:
+                results["chunkers"][spec] = entry
+                continue
+            matrix = np.asarray(vectors, dtype=np.float32)
+            queries = np.asarray(encoder.embed_list([query for _, query in probes]), dtype=np.float32)
+            ranked = [list(np.argsort(-(matrix @ query))[:args.top_k]) for query in queries]
+            entry["dense"] = retrieval_quality(ranked, texts, probes, args.top_k)
+            print(f"向量检索 hit@{args.top_k} {entry['dense']['hit_at_k']:.3f}，MRR {entry['dense']['mrr']:.3f}")
+
+        results["chunkers"][spec] = entry
+
+    if args.json_path:
+        write_json(os.path.join(original_cwd, args.json_path), {"config": vars(args), "results": results})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+攻略生成流程的离线端到端基准测试
+
+启动本地模拟的大模型、Google搜索、Pixabay和Unsplash接口，在同一进程中运行真实的
+user / search / generate 服务，通过 web_central 的 CentralService 跑完整的
+user → search → generate 流程，统计各阶段 p50/p95/p99 和吞吐量。
+
+示例：
+    python benchmarks/pipeline_bench.py --clients 4 --requests 8 --llm-latency 0.5
+    python benchmarks/pipeline_bench.py --llm-failure-rate 0.1 --json bench_result.json
+    # 录制一次大模型响应，之后不访问模拟大模型、按录制结果确定性回放
+    python benchmarks/pipeline_bench.py --llm-cache record --llm-cache-dir llm_recording
+    python benchmarks/pipeline_bench.py --llm-cache replay --llm-cache-dir llm_recording
+
+注意：camel 创建智能体时需要 tiktoken 编码文件，首次运行前请在联网环境下运行一次，
+或通过 TIKTOKEN_CACHE_DIR 指定已缓存的目录。
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import print_table, summarize, write_json
+from stub_servers import StubBehavior, StubServer, start_stub_servers
+
+DEFAULT_QUERIES = [
+    "我想去北京玩三天",
+    "打算去上海旅游2天",
+    "计划去杭州旅行2天",
+    "我想去成都玩3天",
+]
+
+STAGES = ["user", "search", "generate"]
+
+
+class LateBoundApp:
+    """先占用端口再绑定应用：服务地址需要在导入服务模块之前写入环境变量"""
+
+    def __init__(self):
+        self.app = None
+
+    def __call__(self, environ, start_response):
+        return self.app(environ, start_response)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="攻略生成流程离线基准测试")
+    parser.add_argument("--clients", type=int, default=2, help="并发客户端数")
+    parser.add_argument("--requests", type=int, default=4, help="总请求数")
+    parser.add_argument("--queries", nargs="*", default=DEFAULT_QUERIES, help="轮流使用的用户输入")
+    parser.add_argument("--items", type=int, default=4, help="模拟大模型每类返回的景点/美食数量")
+    parser.add_argument("--seed", type=int, default=42, help="随机种子")
+    for name, latency in [("llm", 0.5), ("google", 0.2), ("pixabay", 0.1), ("unsplash", 0.1)]:
+        parser.add_argument(f"--{name}-latency", type=float, default=latency, help=f"{name} 模拟延迟（秒）")
+        parser.add_argument(f"--{name}-jitter", type=float, default=latency / 4, help=f"{name} 延迟抖动（秒）")
+        parser.add_argument(f"--{name}-failure-rate", type=float, default=0.0, help=f"{name} 失败率")
+    parser.add_argument("--llm-cache", choices=["off", "on", "record", "replay"], default="off",
+                        help="大模型响应缓存模式，默认关闭以测量完整流程")
+    parser.add_argument("--llm-cache-dir", default="llm_recording", help="大模型响应缓存目录（相对于当前目录）")
+    parser.add_argument("--json", dest="json_path", help="把结果写入JSON文件")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    behaviors = {
+        name: StubBehavior(
+            latency=getattr(args, f"{name}_latency"),
+            jitter=getattr(args, f"{name}_jitter"),
+            failure_rate=getattr(args, f"{name}_failure_rate"),
+            seed=args.seed + i,
+        )
+        for i, name in enumerate(["llm", "google", "pixabay", "unsplash"])
+    }
+    stubs, env = start_stub_servers(behaviors, items=args.items)
+    original_cwd = os.getcwd()
+
+    # 先为三个内部服务占用端口，再写入环境变量，最后导入服务模块
+    service_apps = {name: LateBoundApp() for name in ["user", "search", "generate"]}
+    services = {name: StubServer(name, app).start() for name, app in service_apps.items()}
+    work_dir = tempfile.mkdtemp(prefix="travel_bench_")
+    env.update({
+        "USER_SERVICE_URL": f"{services['user'].base_url}/extract_travel_info",
+        "SEARCH_SERVICE_URL": f"{services['search'].base_url}/get_travel_plan",
+        "GENERATE_SERVICE_URL": f"{services['generate'].base_url}/generate_itinerary_html",
+        "STORAGE_DIR": os.path.join(work_dir, "storage"),
+        # 每次请求都走完整流程，不使用已生成的攻略
+        "GUIDE_TTL_HOURS": "0",
+        "FIRST_DEEPSEEK_API_KEY": "stub",
+        "GOOGLE_API_KEY": "stub",
+        "SEARCH_ENGINE_ID": "stub",
+        "PIXABAY_API_KEY": "stub",
+        "UNSPLASH_ACCESS_KEY": "stub",
+        "LLM_CACHE": args.llm_cache,
+        "LLM_CACHE_DIR": os.path.abspath(args.llm_cache_dir),
+    })
+    os.environ.update(env)
+    os.chdir(work_dir)
+
+    import user
+    import search
+    import generate
+    import web_central
+    import metrics
+    import llm_gateway
+
+    warmup = {}
+    for name, module in [("user", user), ("search", search), ("generate", generate)]:
+        service_apps[name].app = module.create_app(warm_up=False)
+        start = time.perf_counter()
+        module.lifecycle.warm_up(background=False)
+        warmup[name] = time.perf_counter() - start
+        if not module.lifecycle.ready:
+            print(f"{name} 服务预热失败: {module.lifecycle.status()['resources']}")
+            sys.exit(1)
+
+    central = web_central.central_service
+    print(f"模拟服务已启动，工作目录: {work_dir}")
+    print(f"并发客户端 {args.clients}，总请求 {args.requests}")
+
+    records = []
+    lock = threading.Lock()
+
+    def run_one(i):
+        query = args.queries[i % len(args.queries)]
+        marks = {}
+
+        def progress(stage, message):
+            marks.setdefault(stage, time.perf_counter())
+
+        start = time.perf_counter()
+        # 与 web_central 的后台任务一样带上请求ID，三个服务的分阶段耗时都记在同一个ID下
+        with metrics.request_context("web_central", name="process_user_query"):
+            result = central.process_user_query(query, progress=progress)
+        end = time.perf_counter()
+
+        durations = {}
+        points = [(stage, marks[stage]) for stage in STAGES if stage in marks] + [("end", end)]
+        for (stage, begin), (_, finish) in zip(points, points[1:]):
+            durations[stage] = finish - begin
+        record = {
+            "query": query,
+            "ok": result.get("status") == "success",
+            "error": result.get("error"),
+            "total": end - start,
+            "stages": durations,
+        }
+        with lock:
+            records.append(record)
+            print(f"[{len(records)}/{args.requests}] {query} - "
+                  f"{'成功' if record['ok'] else '失败'} {record['total']:.2f} 秒")
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        list(executor.map(run_one, range(args.requests)))
+    wall_seconds = time.perf_counter() - wall_start
+
+    ok_records = [r for r in records if r["ok"]]
+    stage_stats = {stage: summarize([r["stages"][stage] for r in ok_records if stage in r["stages"]])
+                   for stage in STAGES}
+    stage_stats["total"] = summarize([r["total"] for r in ok_records])
+    result = {
+        "config": {key: value for key, value in vars(args).items() if key != "json_path"},
+        "warmup_seconds": warmup,
+        "wall_seconds": wall_seconds,
+        "requests": len(records),
+        "succeeded": len(ok_records),
+        "failed": len(records) - len(ok_records),
+        "throughput_per_minute": len(ok_records) / wall_seconds * 60 if wall_seconds else 0.0,
+        "stages": stage_stats,
+        "stub_calls": {name: behavior.stats() for name, behavior in behaviors.items()},
+        "service_stages": metrics.stage_summary(),
+        "llm_cache": llm_gateway.get_gateway().cache.stats() if llm_gateway.get_gateway().cache else None,
+        "errors": sorted({r["error"] for r in records if r["error"]}),
+    }
+
+    print_table("各阶段耗时（成功请求）", stage_stats)
+    print(f"\n成功 {result['succeeded']} / {result['requests']}，总耗时 {wall_seconds:.2f} 秒，"
+          f"吞吐量 {result['throughput_per_minute']:.2f} 次/分钟")
+    print(f"模拟接口调用: {result['stub_calls']}")
+    if result["llm_cache"]:
+        print(f"大模型响应缓存: {result['llm_cache']}")
+    print("\n各服务分阶段累计耗时（含失败请求）：")
+    for service, stages in result["service_stages"].items():
+        print(f"  {service}: " + "，".join(
+            f"{name} {entry['seconds']:.2f} 秒/{entry['count']} 次" for name, entry in stages.items()))
+    for error in result["errors"]:
+        print(f"错误: {error}")
+
+    for server in list(stubs.values()) + list(services.values()):
+        server.stop()
+    if args.json_path:
+        write_json(os.path.join(original_cwd, args.json_path), result)
+
+
+if __name__ == "__main__":
+    main()
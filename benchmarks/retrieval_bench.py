@@ -0,0 +1,195 @@
+"""
+知识库检索质量和延迟基准测试
+
+用 benchmarks/data/retrieval_questions.json 中标注好的中文旅游问题评估检索效果。每个问题标注了
+相关分块中必然出现的原文片段，不依赖分块方式和向量ID，所以修改分块、索引或检索方式后都可以直接对比：
+- recall@k：前k个结果中包含相关分块的问题比例；
+- MRR：第一个相关分块排名倒数的平均值；
+- 单次查询延迟 p50/p99（包含查询编码，与聊天助手中的一次检索相同）。
+
+可对比的检索方式：
+    qdrant  camel VectorRetriever 直接查询本地Qdrant（原来的方式）
+    exact / int8 / binary  kb_index 精确或量化+重排索引
+    hnsw    kb_ann HNSW 近似最近邻索引
+    bm25    只用 BM25 关键词检索
+    hybrid  BM25 + 向量检索 RRF 融合
+    partitioned  hybrid + 按问题中的城市路由到城市分区（聊天助手的默认方式）
+索引都建在临时目录中，不会改动 storage_travel_kb 下已有的索引文件。
+
+示例：
+    # 评估现有知识库（聊天助手运行时本地Qdrant目录被占用，需要先停止）
+    python benchmarks/retrieval_bench.py --retrievers qdrant int8 hnsw bm25 hybrid --json retrieval_result.json
+    # 用指定的分块方式把PDF重新入库到临时目录后评估，用于比较分块方式
+    python benchmarks/retrieval_bench.py --ingest local_data/北京旅游.pdf --chunker chinese:300:60
+    # 用 int8 量化的 ONNX 模型编码查询，检查量化后的检索质量
+    python benchmarks/retrieval_bench.py --backend onnx-int8 --retrievers qdrant hybrid
+
+全部在本地运行，不调用任何在线接口；嵌入模型需要已经下载到本地缓存。
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from common import REPO_DIR, compact, make_chunker, summarize, write_json
+from kb_ingest import KB_COLLECTION_NAME, KB_PATH, KB_VECTOR_DIM, IngestionManifest, KnowledgeBaseIngestor
+
+DEFAULT_QUESTIONS = os.path.join(REPO_DIR, "benchmarks", "data", "retrieval_questions.json")
+RETRIEVERS = ["qdrant", "exact", "int8", "binary", "hnsw", "bm25", "hybrid", "partitioned"]
+
+
+class BM25OnlyRetriever:
+    """只用 BM25 的检索器，返回格式与 VectorRetriever.query 相同"""
+
+    def __init__(self, storage, lexical_index):
+        self.storage = storage
+        self.lexical_index = lexical_index
+
+    def query(self, query: str, top_k: int = 1, similarity_threshold: float = 0.0) -> list:
+        hits = self.lexical_index.search(query, top_k=top_k)
+        if not hits:
+            return []
+        points = self.storage.client.retrieve(collection_name=self.storage.collection_name,
+                                              ids=[doc_id for doc_id, _ in hits], with_payload=True)
+        payloads = {str(point.id): point.payload or {} for point in points}
+        return [payloads[doc_id] for doc_id, _ in hits if doc_id in payloads]
+
+
+def build_retriever(name: str, encoder, storage, work_dir: str):
+    """在临时目录中构建索引并返回检索器"""
+    from kb_hybrid import BM25Index, HybridRetriever, load_collection_texts
+    from kb_index import IndexedVectorRetriever, build_index_from_storage
+
+    if name == "qdrant":
+        from camel.retrievers import VectorRetriever
+        return VectorRetriever(embedding_model=encoder, storage=storage)
+    if name in ("exact", "int8", "binary"):
+        index = build_index_from_storage(storage, mode="none" if name == "exact" else name,
+                                         path=os.path.join(work_dir, name))
+        return IndexedVectorRetriever(encoder, storage, index)
+    if name == "hnsw":
+        from kb_ann import HNSWIndex, hnswlib
+        if hnswlib is None:
+            raise RuntimeError("需要先安装 hnswlib")
+        index = build_index_from_storage(storage, mode="none", path=os.path.join(work_dir, name),
+                                         index_class=HNSWIndex, exact_threshold=0)
+        return IndexedVectorRetriever(encoder, storage, index)
+    lexical_index = BM25Index(path=os.path.join(work_dir, f"{name}_bm25"))
+    lexical_index.build(load_collection_texts(storage))
+    if name == "bm25":
+        return BM25OnlyRetriever(storage, lexical_index)
+    if name == "partitioned":
+        from kb_partition import CityPartitions, PartitionedRetriever
+        partitions = CityPartitions(encoder, storage, path=os.path.join(work_dir, "partitions"))
+        partitions.build()
+        return PartitionedRetriever(HybridRetriever(encoder, storage, lexical_index), partitions)
+    return HybridRetriever(encoder, storage, lexical_index)
+
+
+def evaluate(retriever, questions: list, ks: list, repeat: int) -> dict:
+    """逐个问题检索，返回 recall@k、MRR、延迟统计和未命中的问题"""
+    max_k = max(ks)
+    latencies, first_ranks = [], []
+    for item in questions:
+        evidence = [compact(text) for text in item["evidence"]]
+        for _ in range(repeat):
+            start = time.perf_counter()
+            results = retriever.query(item["question"], top_k=max_k, similarity_threshold=0.0)
+            latencies.append(time.perf_counter() - start)
+        rank = None
+        for position, result in enumerate(results[:max_k], start=1):
+            text = compact(result.get("text", ""))
+            if any(piece in text for piece in evidence):
+                rank = position
+                break
+        first_ranks.append(rank)
+    report = {f"recall@{k}": sum(1 for rank in first_ranks if rank and rank <= k) / len(questions) for k in ks}
+    report["mrr"] = sum(1.0 / rank for rank in first_ranks if rank) / len(questions)
+    report["latency_ms"] = {key: (value * 1000 if key != "count" else value)
+                            for key, value in summarize(latencies).items()}
+    report["misses"] = [item["id"] for item, rank in zip(questions, first_ranks) if rank is None]
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="知识库检索质量和延迟基准测试")
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS, help="标注的问题集")
+    parser.add_argument("--retrievers", nargs="*", default=["qdrant", "bm25", "hybrid"], choices=RETRIEVERS,
+                        help="参与对比的检索方式")
+    parser.add_argument("--k", type=int, nargs="*", default=[1, 3, 5], help="计算 recall@k 的 k")
+    parser.add_argument("--repeat", type=int, default=1, help="每个问题重复查询的次数（只影响延迟统计）")
+    parser.add_argument("--model", default="intfloat/e5-large-v2", help="查询编码使用的 SentenceTransformer 模型")
+    parser.add_argument("--backend", default="torch", choices=["torch", "onnx", "onnx-int8"],
+                        help="查询编码使用的嵌入后端（见 embedding_backend.py）")
+    parser.add_argument("--path", default=os.path.join(REPO_DIR, KB_PATH), help="本地Qdrant目录")
+    parser.add_argument("--collection", default=KB_COLLECTION_NAME, help="集合名称")
+    parser.add_argument("--ingest", nargs="*", help="先把这些文件入库到临时目录，再对临时知识库评估")
+    parser.add_argument("--chunker", default="chinese:400:80", help="--ingest 使用的分块方式")
+    parser.add_argument("--json", dest="json_path", help="把结果写入JSON文件")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    original_cwd = os.getcwd()
+    with open(args.questions, "r", encoding="utf-8") as f:
+        questions = json.load(f)["questions"]
+    print(f"共 {len(questions)} 个标注问题")
+
+    from camel.storages import QdrantStorage
+    from embedding_backend import create_encoder
+
+    encoder, _ = create_encoder(args.backend, args.model)
+    work_dir = tempfile.mkdtemp(prefix="retrieval_bench_")
+    results = {}
+    try:
+        if args.ingest:
+            storage = QdrantStorage(vector_dim=KB_VECTOR_DIM, path=os.path.join(work_dir, "qdrant"),
+                                    collection_name=args.collection)
+            ingestor = KnowledgeBaseIngestor(encoder, storage, chunker=make_chunker(args.chunker),
+                                             manifest=IngestionManifest(os.path.join(work_dir, "manifest.json")))
+            for path in args.ingest:
+                ingestor.ingest_file(path)
+        else:
+            storage = QdrantStorage(vector_dim=KB_VECTOR_DIM, path=args.path, collection_name=args.collection)
+        points = storage.status().vector_count
+        if not points:
+            print("知识库集合为空，请先上传文档或使用 --ingest")
+            return
+        print(f"集合 {args.collection} 共 {points} 个分块")
+
+        # 预热：加载模型、初始化计算图
+        for item in questions[:3]:
+            encoder.embed(obj=item["question"])
+
+        for name in args.retrievers:
+            try:
+                start = time.perf_counter()
+                retriever = build_retriever(name, encoder, storage, work_dir)
+                build_seconds = time.perf_counter() - start
+            except Exception as e:
+                print(f"{name}: 无法构建，跳过（{str(e)}）")
+                continue
+            report = evaluate(retriever, questions, args.k, args.repeat)
+            report["build_seconds"] = build_seconds
+            results[name] = report
+
+        header = "".join(f"{f'recall@{k}':>11}" for k in args.k)
+        print(f"\n{'检索方式':<10}{header}{'MRR':>8}{'p50(ms)':>10}{'p99(ms)':>10}  未命中")
+        for name, report in results.items():
+            recalls = "".join(f"{report[f'recall@{k}']:>11.3f}" for k in args.k)
+            latency = report["latency_ms"]
+            print(f"{name:<10}{recalls}{report['mrr']:>8.3f}{latency['p50']:>10.2f}{latency['p99']:>10.2f}  "
+                  f"{', '.join(report['misses']) or '-'}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json_path:
+        config = dict(vars(args), points=points)
+        write_json(os.path.join(original_cwd, args.json_path), {"config": config, "results": results})
+
+
+if __name__ == "__main__":
+    main()
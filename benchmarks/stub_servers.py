@@ -0,0 +1,282 @@
+"""
+本地模拟外部接口：OpenAI兼容大模型、Google Custom Search、Pixabay、Unsplash
+
+每个模拟服务都可以配置延迟（基础延迟 + 随机抖动）和失败率，用于离线基准测试。
+"""
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import make_server
+
+# 压测时请求日志会淹没统计输出
+logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+CITIES = ["北京", "上海", "杭州", "成都", "西安", "广州", "深圳", "南京", "重庆", "厦门"]
+CHINESE_NUMBERS = {"一": 1, "两": 2, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9, "十": 10}
+
+
+class StubBehavior:
+    """模拟服务的延迟和失败注入配置"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, failure_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+
+    def apply(self) -> bool:
+        """按配置等待，返回本次调用是否应当失败"""
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            fail = self._random.random() < self.failure_rate
+            if fail:
+                self.failures += 1
+        time.sleep(delay)
+        return fail
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": self.calls, "failures": self.failures}
+
+
+class StubServer:
+    """在后台线程中运行一个WSGI应用，端口由系统分配"""
+
+    def __init__(self, name: str, app, behavior: StubBehavior = None):
+        self.name = name
+        self.app = app
+        self.behavior = behavior
+        self._server = make_server("127.0.0.1", 0, app, threaded=True)
+        self.port = self._server.server_port
+        self._thread = threading.Thread(target=self._server.serve_forever, name=f"stub-{name}", daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+
+def _find_city(text: str) -> str:
+    for city in CITIES:
+        if city in text:
+            return city
+    return CITIES[0]
+
+
+def _find_days(text: str):
+    match = re.search(r"(\d+)\s*[天日]", text)
+    if match:
+        return int(match.group(1))
+    match = re.search(r"([一两二三四五六七八九十])\s*[天日]", text)
+    if match:
+        return CHINESE_NUMBERS[match.group(1)]
+    if re.search(r"一周|一个星期", text):
+        return 7
+    return None
+
+
+def _json_block(data) -> str:
+    return "```json\n" + json.dumps(data, ensure_ascii=False, indent=2) + "\n```"
+
+
+def fake_completion_text(system_prompt: str, user_prompt: str, items: int = 4) -> str:
+    """根据系统提示词判断调用方，返回格式符合该调用方解析逻辑的内容"""
+    city = _find_city(user_prompt)
+    if "旅游信息提取助手" in system_prompt:
+        days = _find_days(user_prompt)
+        return json.dumps({
+            "city": city,
+            "days": days,
+            "need_more_info": days is None,
+            "response": "信息在Navigator的数据库中查询到啦，正在努力为您生成攻略~" if days else "请补充你计划的行程天数~",
+        }, ensure_ascii=False)
+    if "搜索质量打分专家" in system_prompt:
+        return _json_block([
+            {
+                "result_id": i,
+                "title": f"{city}旅游推荐{i}",
+                "description": f"{city}景点{i}和{city}美食{i}的介绍，适合游玩半天。",
+                "long_description": f"{city}景点{i}是当地最著名的地方之一。",
+                "url": f"https://example.com/{i}",
+            }
+            for i in range(1, 3)
+        ])
+    if "提取出景点信息" in system_prompt:
+        return _json_block({"attractions": [
+            {"name": f"{city}景点{i}", "description": f"{city}第{i}个必去景点"} for i in range(1, items + 1)
+        ]})
+    if "提取出美食信息" in system_prompt:
+        return _json_block({
+            "foods": [{"name": f"{city}美食{i}", "description": f"{city}第{i}道特色美食"} for i in range(1, items + 1)],
+            "food_shop": [{"name": f"{city}老字号{i}", "description": f"{city}第{i}家老店"} for i in range(1, 3)],
+        })
+    if "旅游攻略生成专家" in system_prompt:
+        return _json_block({"base_guide": f"第一天游览{city}景点1和{city}景点2，第二天游览{city}景点3。"})
+    if "旅游规划师" in system_prompt:
+        days = _find_days(user_prompt) or 1
+        lines = []
+        for day in range(1, days + 1):
+            lines += [
+                f"Day{day}:",
+                f"- 早餐：{city}美食{day}",
+                f"- 上午：{city}景点{day}",
+                f"- 午餐：{city}美食{day + 1}",
+                f"- 下午：{city}景点{day + 1}",
+                f"- 晚餐：{city}老字号1",
+                "",
+            ]
+        return "\n".join(lines)
+    return f"这是关于{city}旅游的模拟回答。"
+
+
+def _message_text(message: dict) -> str:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+
+def create_llm_app(behavior: StubBehavior, items: int = 4) -> Flask:
+    """OpenAI兼容的 /v1/chat/completions 模拟接口"""
+    app = Flask("stub_llm")
+
+    @app.route("/v1/chat/completions", methods=["POST"])
+    def chat_completions():
+        if behavior.apply():
+            return jsonify({"error": {"message": "模拟限流", "type": "rate_limit_error"}}), 429
+        body = request.get_json()
+        messages = body.get("messages", [])
+        system_prompt = " ".join(_message_text(m) for m in messages if m.get("role") == "system")
+        user_prompt = next((_message_text(m) for m in reversed(messages) if m.get("role") == "user"), "")
+        text = fake_completion_text(system_prompt, user_prompt, items=items)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        prompt_tokens = sum(len(_message_text(m)) for m in messages)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(text),
+                 "total_tokens": prompt_tokens + len(text)}
+
+        if body.get("stream"):
+            def stream():
+                for i in range(0, len(text), 8):
+                    chunk = {
+                        "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                        "model": body.get("model"),
+                        "choices": [{"index": 0, "delta": {"content": text[i:i + 8]}, "finish_reason": None}],
+                    }
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                chunk = {
+                    "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": body.get("model"),
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                }
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                yield "data: [DONE]\n\n"
+            return Response(stream(), mimetype="text/event-stream")
+
+        return jsonify({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop",
+            }],
+            "usage": usage,
+        })
+
+    return app
+
+
+def create_google_app(behavior: StubBehavior) -> Flask:
+    """Google Custom Search /customsearch/v1 模拟接口"""
+    app = Flask("stub_google")
+
+    @app.route("/customsearch/v1")
+    def custom_search():
+        if behavior.apply():
+            return jsonify({"error": {"code": 500, "message": "模拟故障"}}), 500
+        query = request.args.get("q", "")
+        num = request.args.get("num", 10, type=int)
+        city = _find_city(query)
+        return jsonify({"items": [
+            {
+                "title": f"{query} - 结果{i}",
+                "link": f"https://example.com/search/{i}",
+                "snippet": f"{city}景点{i}、{city}美食{i}的攻略摘要",
+                "pagemap": {"metatags": [{"og:description": f"{city}旅游攻略详细介绍{i}"}]},
+            }
+            for i in range(1, num + 1)
+        ]})
+
+    return app
+
+
+def create_pixabay_app(behavior: StubBehavior) -> Flask:
+    """Pixabay /api/ 模拟接口"""
+    app = Flask("stub_pixabay")
+
+    @app.route("/api/")
+    def search_images():
+        if behavior.apply():
+            return jsonify({"error": "模拟故障"}), 500
+        query = request.args.get("q", "")
+        return jsonify({"hits": [
+            {"webformatURL": f"https://pixabay.example.com/{zlib.crc32(query.encode()) % 10000}_{i}.jpg"} for i in range(3)
+        ]})
+
+    return app
+
+
+def create_unsplash_app(behavior: StubBehavior) -> Flask:
+    """Unsplash /search/photos 模拟接口"""
+    app = Flask("stub_unsplash")
+
+    @app.route("/search/photos")
+    def search_photos():
+        if behavior.apply():
+            return jsonify({"errors": ["模拟故障"]}), 500
+        query = request.args.get("query", "")
+        return jsonify({"results": [
+            {"urls": {"regular": f"https://unsplash.example.com/{zlib.crc32(query.encode()) % 10000}_{i}.jpg"}} for i in range(3)
+        ]})
+
+    return app
+
+
+def start_stub_servers(behaviors: dict, items: int = 4) -> tuple:
+    """
+    启动全部模拟服务，behaviors 为 {"llm"|"google"|"pixabay"|"unsplash": StubBehavior}
+
+    返回 ({名称: StubServer}, 可直接写入环境变量的地址配置)
+    """
+    servers = {
+        "llm": StubServer("llm", create_llm_app(behaviors["llm"], items=items), behaviors["llm"]).start(),
+        "google": StubServer("google", create_google_app(behaviors["google"]), behaviors["google"]).start(),
+        "pixabay": StubServer("pixabay", create_pixabay_app(behaviors["pixabay"]), behaviors["pixabay"]).start(),
+        "unsplash": StubServer("unsplash", create_unsplash_app(behaviors["unsplash"]), behaviors["unsplash"]).start(),
+    }
+    env = {
+        "LLM_API_BASE": f"{servers['llm'].base_url}/v1",
+        "GOOGLE_SEARCH_URL": f"{servers['google'].base_url}/customsearch/v1",
+        "PIXABAY_API_URL": f"{servers['pixabay'].base_url}/api/",
+        "UNSPLASH_API_URL": f"{servers['unsplash'].base_url}/search/photos",
+    }
+    return servers, env
@@ -2,16 +2,17 @@ import requests
 import json
 import time
 import os
+from settings import USER_SERVICE_URL, SEARCH_SERVICE_URL, GENERATE_SERVICE_URL, STORAGE_DIR
 
 class CentralService:
     def __init__(self):
         # 服务地址
-        self.user_service_url = "http://localhost:5001/extract_travel_info"
-        self.search_service_url = "http://localhost:5002/get_travel_plan"
-        self.generate_service_url = "http://localhost:5003/generate_itinerary_html"
+        self.user_service_url = USER_SERVICE_URL
+        self.search_service_url = SEARCH_SERVICE_URL
+        self.generate_service_url = GENERATE_SERVICE_URL
         
         # 确保存储目录存在
-        os.makedirs("storage", exist_ok=True)
+        os.makedirs(STORAGE_DIR, exist_ok=True)
     
     def process_user_query(self, user_query):
         """处理用户查询并协调三个服务"""
@@ -1,18 +1,30 @@
 import streamlit as st
 from camel.messages import BaseMessage as bm
 from camel.agents import ChatAgent
-from camel.models import ModelFactory
-from camel.types import ModelPlatformType
 import os
 from PIL import Image
 from dotenv import load_dotenv
-from camel.embeddings import SentenceTransformerEncoder
 from camel.storages import QdrantStorage
 from camel.retrievers import VectorRetriever
-import tempfile
-import shutil
+from embedding_cache import EmbeddingCache, CachedEmbedding
+from embedding_backend import BatchingEmbedding, create_embedding_model
+from kb_ingest import KnowledgeBaseIngestor, KB_PATH, KB_COLLECTION_NAME, unstructured_chunks
+from kb_chunking import ChineseChunker
+from kb_index import IndexedVectorRetriever, open_index
+from kb_ann import HNSWIndex, ANN_INDEX_DIR
+from kb_hybrid import HybridRetriever, open_bm25_index
+from kb_partition import CityPartitions, PartitionedRetriever
+from answer_eval import TieredEvaluator
+from answer_cache import SemanticAnswerCache, ANSWER_CACHE_PATH
+from json_stream import STREAM_AGENT_OPTIONS, stream_text
+from context_packer import pack_chunks, describe_packing, estimate_tokens
+from vision_cache import VisionCache, CachedVisionAnalyzer, VISION_CACHE_PATH, CACHE_EXACT, CACHE_NEAR
+from agent_pool import AgentPool, SessionAgentPool
+from kb_worker import IngestionWorker, STATUS_QUEUED, STATUS_PARSING, STATUS_EMBEDDING, STATUS_ERROR
+from llm_gateway import create_model, get_gateway
+from settings import LLM_API_BASE
 import time
-import openai
+from concurrent.futures import ThreadPoolExecutor
 
 load_dotenv()
 
@@ -32,28 +44,109 @@ if not os.path.exists('local_data'):
 def initialize_knowledge_base():
     """初始化知识库相关组件"""
     try:
-        # 初始化嵌入模型
-        embedding_model = SentenceTransformerEncoder(model_name='intfloat/e5-large-v2')
+        # 初始化嵌入模型（所有会话的编码请求合并成小批量），并加上查询向量缓存（所有会话共享）
+        base_embedding_model = create_embedding_model(
+            backend=os.getenv('EMBEDDING_BACKEND', 'torch'),
+            quantization=os.getenv('EMBEDDING_QUANTIZATION', 'avx2'),
+            max_batch=int(os.getenv('EMBEDDING_MAX_BATCH', '32')),
+            max_wait=float(os.getenv('EMBEDDING_MAX_WAIT_MS', '2')) / 1000
+        )
+        query_cache = EmbeddingCache(
+            max_size=int(os.getenv('QUERY_EMBEDDING_CACHE_SIZE', '1024')),
+            path=os.getenv('QUERY_EMBEDDING_CACHE_PATH', 'storage_travel_kb/query_embedding_cache.json') or None,
+            model_name=base_embedding_model.model_id
+        )
+        embedding_model = CachedEmbedding(base_embedding_model, query_cache)
         
         # 初始化向量存储
         vector_storage = QdrantStorage(
             vector_dim=embedding_model.get_output_dim(),
             collection="travel_collection",
-            path="storage_travel_kb",
-            collection_name="旅游知识库"
+            path=KB_PATH,
+            collection_name=KB_COLLECTION_NAME
         )
         
-        # 初始化向量检索器
-        vector_retriever = VectorRetriever(
-            embedding_model=embedding_model,
-            storage=vector_storage
-        )
+        # 初始化检索器：默认BM25+向量混合检索；可选HNSW近似最近邻索引和向量量化，都未开启时直接查询Qdrant
+        quantization = os.getenv('KB_QUANTIZATION', 'none')
+        oversampling = float(os.getenv('KB_OVERSAMPLING', '4'))
+        if os.getenv('KB_ANN_INDEX', 'none') == 'hnsw':
+            index = open_index(
+                vector_storage,
+                mode=quantization,
+                oversampling=oversampling,
+                path=ANN_INDEX_DIR,
+                index_class=HNSWIndex,
+                exact_threshold=int(os.getenv('KB_EXACT_THRESHOLD', '20000'))
+            )
+        elif quantization in ('int8', 'binary'):
+            index = open_index(vector_storage, mode=quantization, oversampling=oversampling)
+        else:
+            index = None
+        
+        if os.getenv('KB_HYBRID', '1') == '1':
+            vector_retriever = HybridRetriever(
+                embedding_model=embedding_model,
+                storage=vector_storage,
+                lexical_index=open_bm25_index(vector_storage),
+                index=index,
+                dense_top_k=int(os.getenv('KB_DENSE_TOP_K', '3')),
+                lexical_top_k=int(os.getenv('KB_LEXICAL_TOP_K', '10'))
+            )
+        elif index is not None:
+            vector_retriever = IndexedVectorRetriever(
+                embedding_model=embedding_model,
+                storage=vector_storage,
+                index=index
+            )
+        else:
+            vector_retriever = VectorRetriever(
+                embedding_model=embedding_model,
+                storage=vector_storage
+            )
+        
+        # 按城市分区：问题只提到一个城市时只检索该城市的分块，分区没有结果时退回上面的全局检索
+        if os.getenv('KB_PARTITIONS', '1') == '1':
+            partitions = CityPartitions.open(
+                embedding_model,
+                vector_storage,
+                mode=quantization if quantization in ('int8', 'binary') else 'none',
+                oversampling=oversampling,
+                dense_top_k=int(os.getenv('KB_DENSE_TOP_K', '3')),
+                lexical_top_k=int(os.getenv('KB_LEXICAL_TOP_K', '10'))
+            )
+            vector_retriever = PartitionedRetriever(vector_retriever, partitions)
         
         return vector_retriever, embedding_model, vector_storage
     except Exception as e:
         st.error(f"知识库初始化失败：{str(e)}")
         return None, None, None
 
+@st.cache_resource
+def initialize_ingestion_worker():
+    """初始化后台入库队列（所有会话共享，与检索共用嵌入模型和向量存储）"""
+    vector_retriever, embedding_model, vector_storage = initialize_knowledge_base()
+    if vector_storage is None:
+        return None
+    # 默认按中文句子边界分块；KB_CHUNKER=unstructured 恢复 Unstructured IO 按标题分块
+    if os.getenv('KB_CHUNKER', 'chinese') == 'unstructured':
+        chunker = unstructured_chunks
+    else:
+        chunker = ChineseChunker(
+            chunk_size=int(os.getenv('KB_CHUNK_SIZE', '400')),
+            overlap=int(os.getenv('KB_CHUNK_OVERLAP', '80')),
+            workers=int(os.getenv('KB_PDF_WORKERS', str(min(4, os.cpu_count() or 1))))
+        )
+    ingestor = KnowledgeBaseIngestor(
+        embedding_model=embedding_model,
+        storage=vector_storage,
+        chunker=chunker,
+        embed_batch=int(os.getenv('KB_EMBED_BATCH', '128')),
+        index=getattr(vector_retriever, 'index', None),
+        lexical_index=getattr(vector_retriever, 'lexical_index', None),
+        partitions=getattr(vector_retriever, 'partitions', None)
+    )
+    return IngestionWorker(ingestor)
+
 # 初始化模型和Agent（使用缓存避免重复创建）
 @st.cache_resource
 def initialize_agents():
@@ -65,72 +158,82 @@ def initialize_agents():
         st.error("❌ 请设置环境变量 DEEPSEEK_API_KEY 和 QWEN_API_KEY 和 SECOND_DEEPSEEK_API_KEY")
         st.stop()
     
-    api_base = "https://api.siliconflow.cn/v1"
-    
     # 设置环境变量
     os.environ["OPENAI_API_KEY"] = deepseek_api_key
-    os.environ["OPENAI_API_BASE"] = api_base
+    os.environ["OPENAI_API_BASE"] = LLM_API_BASE
     
+    # 所有模型都经过 llm_gateway：同一个 API Key 的模型共用限流额度，429 时统一退避重试
+    # 聊天助手的模型不使用大模型响应缓存：回答要流式显示、重新提问应得到新的回答，提示词中还有用户上传的图片
     # 创建文本回答者模型（DeepSeek-V3）
-    answerer_model = ModelFactory.create(
-        model_platform=ModelPlatformType.OPENAI_COMPATIBLE_MODEL,
-        model_type="deepseek-ai/DeepSeek-V3",
-        url=api_base,
-        api_key=deepseek_api_key,
-        model_config_dict={"max_tokens": 4096}
-    )
+    answerer_model = create_model("deepseek-ai/DeepSeek-V3", "FIRST_DEEPSEEK_API_KEY",
+                                  model_config_dict={"max_tokens": 4096}, cache=False)
     
     # 创建图像理解模型（Qwen2.5-VL-72B-Instruct）
-    vision_model = ModelFactory.create(
-        model_platform=ModelPlatformType.OPENAI_COMPATIBLE_MODEL,
-        model_type="Qwen/Qwen2.5-VL-72B-Instruct",
-        url='https://api-inference.modelscope.cn/v1/',
-        api_key=qwen_api_key,
-        model_config_dict={"max_tokens": 4096},
-    )
+    vision_model = create_model("Qwen/Qwen2.5-VL-72B-Instruct", "QWEN_API_KEY",
+                                url='https://api-inference.modelscope.cn/v1/',
+                                model_config_dict={"max_tokens": 4096}, cache=False)
     
     # 创建评估者模型（DeepSeek-R1）
-    evaluator_model = ModelFactory.create(
-        model_platform=ModelPlatformType.OPENAI_COMPATIBLE_MODEL,
-        model_type="deepseek/deepseek-r1-0528:free",
-        url="https://openrouter.ai/api/v1/",
-        api_key=second_deepseek_api_key,
-        model_config_dict={"max_tokens": 4096}
-    )
+    evaluator_model = create_model("deepseek/deepseek-r1-0528:free", "SECOND_DEEPSEEK_API_KEY",
+                                   url="https://openrouter.ai/api/v1/",
+                                   model_config_dict={"max_tokens": 4096}, cache=False)
     
-    # 文本回答者 Agent
-    answerer_agent = ChatAgent(
-        system_message=bm.make_assistant_message(
-            role_name="智能旅游助手",
-            content="""
-            你是一个 AI 旅游助手，请用中文详细回答用户的问题。你对旅游行业有深入的了解，能够根据用户的需求提供详细的旅游方案。
-            当用户提供图片时，你会收到图片的描述信息，请结合图片内容和用户问题提供相关的旅游建议。
-            当提供了知识库信息时，请优先参考知识库内容来回答问题，并结合你的旅游知识提供全面的建议。
-            你只对旅游方面的问题有回应，如果用户的问题与旅游无关，请礼貌地告诉用户你只对旅游方面的问题有回应。
-            """
-        ),
-        model=answerer_model,
-        message_window_size=10
+    # 回答者使用流式输出，页面可以边生成边显示；知识库助手仍使用非流式模型
+    if os.getenv('ANSWER_STREAMING', '1') == '1':
+        answerer_stream_model = create_model("deepseek-ai/DeepSeek-V3", "FIRST_DEEPSEEK_API_KEY",
+                                             model_config_dict={"max_tokens": 4096, "stream": True},
+                                             cache=False)
+    else:
+        answerer_stream_model = answerer_model
+    
+    # 文本回答者 Agent：每个会话一个，共享模型客户端；记忆按消息条数和 token 上限截断
+    def create_answerer_agent():
+        return ChatAgent(
+            system_message=bm.make_assistant_message(
+                role_name="智能旅游助手",
+                content="""
+                你是一个 AI 旅游助手，请用中文详细回答用户的问题。你对旅游行业有深入的了解，能够根据用户的需求提供详细的旅游方案。
+                当用户提供图片时，你会收到图片的描述信息，请结合图片内容和用户问题提供相关的旅游建议。
+                当提供了知识库信息时，请优先参考知识库内容来回答问题，并结合你的旅游知识提供全面的建议。
+                你只对旅游方面的问题有回应，如果用户的问题与旅游无关，请礼貌地告诉用户你只对旅游方面的问题有回应。
+                """
+            ),
+            model=answerer_stream_model,
+            message_window_size=int(os.getenv('ANSWERER_WINDOW_SIZE', '10')),
+            **STREAM_AGENT_OPTIONS
+        )
+    
+    session_agents = SessionAgentPool(
+        create_answerer_agent,
+        max_sessions=int(os.getenv('SESSION_MAX', '100')),
+        idle_ttl=float(os.getenv('SESSION_IDLE_MINUTES', '60')) * 60,
+        max_context_tokens=int(os.getenv('ANSWERER_CONTEXT_TOKENS', '6000'))
     )
     
-    # 图像理解 Agent
-    vision_agent = ChatAgent(
-        system_message=bm.make_assistant_message(
-            role_name="图像分析师",
-            content="你是一个图像分析专家，请仔细观察图片并用中文详细描述图片的内容，特别关注与旅游相关的元素，如景点、建筑、自然风光、文化特色等。"
+    # 图像理解 Agent 和评估者 Agent 不保留对话记忆，从池中取用，多个会话可以同时使用
+    pool_size = int(os.getenv('AGENT_POOL_SIZE', '4'))
+    vision_agents = AgentPool(
+        lambda: ChatAgent(
+            system_message=bm.make_assistant_message(
+                role_name="图像分析师",
+                content="你是一个图像分析专家，请仔细观察图片并用中文详细描述图片的内容，特别关注与旅游相关的元素，如景点、建筑、自然风光、文化特色等。"
+            ),
+            model=vision_model,
+            output_language='中文'
         ),
-        model=vision_model,
-        output_language='中文'
+        size=pool_size
     )
     
-    # 评估者 Agent
-    evaluator_agent = ChatAgent(
-        system_message=bm.make_assistant_message(
-            role_name="评估专家",
-            content="你是一个 AI 评估员，评价ai对用户问题的回答质量以及符合用户需求程度，请在最开始输出一个数字，即对回答的分数（1~10），然后再简要说明原因。确保你输出的开头是一个数字"
+    evaluator_agents = AgentPool(
+        lambda: ChatAgent(
+            system_message=bm.make_assistant_message(
+                role_name="评估专家",
+                content="你是一个 AI 评估员，评价ai对用户问题的回答质量以及符合用户需求程度，请在最开始输出一个数字，即对回答的分数（1~10），然后再简要说明原因。确保你输出的开头是一个数字"
+            ),
+            model=evaluator_model,
+            message_window_size=10
         ),
-        model=evaluator_model,
-        message_window_size=10
+        size=pool_size
     )
     
     # 知识库助手 Agent
@@ -149,74 +252,253 @@ def initialize_agents():
         output_language='中文'
     )
     
-    return answerer_agent, vision_agent, evaluator_agent, kb_agent
+    return session_agents, vision_agents, evaluator_agents, kb_agent
+
+@st.cache_resource
+def initialize_evaluator(_evaluator_agents):
+    """初始化分层回答评估器（所有会话共享，评估日志和统计在进程内汇总）"""
+    return TieredEvaluator(
+        _evaluator_agents,
+        mode=os.getenv('ANSWER_EVAL_MODE', 'tiered'),
+        accept_threshold=float(os.getenv('ANSWER_EVAL_ACCEPT', '7')),
+        reject_threshold=float(os.getenv('ANSWER_EVAL_REJECT', '4')),
+        audit_rate=float(os.getenv('ANSWER_EVAL_AUDIT_RATE', '0.1')),
+        answer_tokens=int(os.getenv('ANSWER_EVAL_ANSWER_TOKENS', '900')),
+        knowledge_tokens=int(os.getenv('ANSWER_EVAL_KB_TOKENS', '600'))
+    )
+
+@st.cache_resource
+def initialize_answer_cache():
+    """初始化语义回答缓存（所有会话共享，复用知识库的嵌入模型）"""
+    _, embedding_model, _ = initialize_knowledge_base()
+    if embedding_model is None or os.getenv('ANSWER_CACHE', '1') != '1':
+        return None
+    return SemanticAnswerCache(
+        embedding_model,
+        threshold=float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.95')),
+        ttl=float(os.getenv('ANSWER_CACHE_TTL_HOURS', '24')) * 3600,
+        max_size=int(os.getenv('ANSWER_CACHE_SIZE', '500')),
+        path=os.getenv('ANSWER_CACHE_PATH', ANSWER_CACHE_PATH) or None,
+        model_name=embedding_model.embedding_model.model_id
+    )
+
+VISION_PROMPT = "请详细描述这张图片的内容，特别关注与旅游相关的元素"
 
-def process_uploaded_file(uploaded_file, vector_retriever):
-    """处理上传的文件并添加到知识库"""
+@st.cache_resource
+def initialize_vision_analyzer(_vision_agents):
+    """初始化图片预处理和图片描述缓存（所有会话共享）"""
+    cache = VisionCache(
+        max_size=int(os.getenv('VISION_CACHE_SIZE', '256')),
+        path=os.getenv('VISION_CACHE_PATH', VISION_CACHE_PATH) or None,
+        max_distance=int(os.getenv('VISION_CACHE_MAX_DISTANCE', '5')),
+        prompt=VISION_PROMPT
+    )
+    return CachedVisionAnalyzer(
+        _vision_agents,
+        cache=cache,
+        prompt=VISION_PROMPT,
+        max_edge=int(os.getenv('VISION_MAX_EDGE', '1280')),
+        quality=int(os.getenv('VISION_JPEG_QUALITY', '85'))
+    )
+
+EVAL_TIER_NAMES = {
+    'heuristic_accept': '启发式直接通过',
+    'heuristic_reject': '启发式直接重试',
+    'judge': '评估模型',
+    'audit': '后台复核',
+}
+
+def process_uploaded_file(uploaded_file, ingestion_worker):
+    """保存上传的文件并加入后台入库队列，返回 (是否成功, 任务ID或错误信息)"""
     try:
-        # 创建临时文件
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            tmp_file_path = tmp_file.name
-        
-        # 将文件复制到local_data目录
+        # 将文件保存到local_data目录
         local_file_path = os.path.join('local_data', uploaded_file.name)
-        shutil.copy2(tmp_file_path, local_file_path)
-        
-        # 处理文件并添加到向量数据库
-        vector_retriever.process(content=local_file_path)
+        with open(local_file_path, 'wb') as f:
+            f.write(uploaded_file.getvalue())
         
-        # 清理临时文件
-        os.unlink(tmp_file_path)
-        
-        return True, local_file_path
+        # 解析和编码在后台线程中进行，内容没变的文件会直接跳过
+        task_id = ingestion_worker.submit(local_file_path)
+        return True, task_id
     except Exception as e:
         return False, str(e)
 
-def query_knowledge_base(query, vector_retriever, top_k=3):
-    """查询知识库"""
+def describe_ingestion_result(result):
+    """把入库统计转换为侧边栏显示的文字"""
+    if result['status'] == 'skipped':
+        return f"ℹ️ {result['doc']}：内容未变化，已跳过"
+    if result['status'] == 'duplicate':
+        return f"ℹ️ {result['doc']}：与已入库文件 {result['duplicate_of']} 内容相同，已跳过"
+    action = "更新" if result['status'] == 'updated' else "添加"
+    city = f"，归入{result['city']}分区" if result.get('city') else ""
+    return (f"✅ {result['doc']}：已{action}到知识库（共 {result['chunks_total']} 个分块，"
+            f"新编码 {result['chunks_new']} 个，删除 {result['chunks_removed']} 个{city}）")
+
+def _auto_refresh(func):
+    """较新版本的Streamlit支持局部定时刷新，入库进度无需整页重跑即可更新"""
+    fragment = getattr(st, 'fragment', None)
+    return fragment(run_every=2)(func) if fragment else func
+
+@_auto_refresh
+def render_ingestion_progress(ingestion_worker):
+    """显示入库队列长度和每个文件的进度"""
+    if ingestion_worker is None:
+        return
+    st.metric("知识库文件数", len(ingestion_worker.ingestor.manifest.documents))
+    partitions = ingestion_worker.ingestor.partitions
+    if partitions is not None and partitions.stats():
+        st.caption("城市分区：" + "，".join(f"{city} {count} 块" for city, count in sorted(partitions.stats().items())))
+    tasks = ingestion_worker.tasks()[:5]
+    if not tasks:
+        return
+    st.caption(f"入库队列：{ingestion_worker.queue_depth()} 个文件待处理")
+    for task in tasks:
+        if task['status'] == STATUS_QUEUED:
+            st.caption(f"⏳ {task['doc']}：排队中")
+        elif task['status'] == STATUS_PARSING:
+            st.caption(f"📄 {task['doc']}：正在解析文档...")
+        elif task['status'] == STATUS_EMBEDDING:
+            ratio = task['chunks_done'] / task['chunks_total'] if task['chunks_total'] else 0.0
+            st.progress(ratio, text=f"🧮 {task['doc']}：{task['chunks_done']}/{task['chunks_total']} 个分块，"
+                                    f"{task['chunks_per_second']:.1f} 块/秒")
+        elif task['status'] == STATUS_ERROR:
+            st.caption(f"❌ {task['doc']}：入库失败 {task['error']}")
+        else:
+            st.caption(describe_ingestion_result(task['result']))
+
+# 知识库上下文：检索的候选分块数和放入回答者提示词的 token 预算
+KB_CONTEXT_CANDIDATES = int(os.getenv('KB_CONTEXT_CANDIDATES', '5'))
+KB_CONTEXT_TOKENS = int(os.getenv('KB_CONTEXT_TOKENS', '1200'))
+
+def retrieve_knowledge(query, vector_retriever, top_k=KB_CONTEXT_CANDIDATES, token_budget=KB_CONTEXT_TOKENS):
+    """
+    检索知识库，返回 (知识库文本, 过程日志, 错误信息)
+
+    检索结果按相关度放入 token 预算：跳过内容重叠的分块，放不下时在句子边界处截断。
+    不调用 st 的任何方法，可以在后台线程中运行；查询向量缓存和混合检索的耗时记录是线程局部的，
+    所以也在这里读取。
+    """
+    log = []
     try:
+        start = time.perf_counter()
         retrieved_info = vector_retriever.query(query=query, top_k=top_k)
-        return retrieved_info
+        elapsed = time.perf_counter() - start
+        
+        embedding_model = vector_retriever.embedding_model
+        if isinstance(embedding_model, CachedEmbedding) and embedding_model.last_lookup:
+            lookup = embedding_model.last_lookup
+            cache_stats = embedding_model.cache.stats()
+            log.append(
+                f"🔎 查询向量{'命中缓存' if lookup['hit'] else '未命中缓存'}，"
+                f"编码耗时 {lookup['seconds'] * 1000:.1f} ms，"
+                f"缓存命中率 {cache_stats['hit_rate']:.0%}（{cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']}）"
+            )
+            if not lookup['hit'] and isinstance(embedding_model.embedding_model, BatchingEmbedding):
+                batch_stats = embedding_model.embedding_model.stats()
+                log.append(
+                    f"🧮 嵌入批处理：平均每批 {batch_stats['mean_batch_size']:.1f} 条，"
+                    f"平均排队 {batch_stats['mean_wait_ms']:.1f} ms"
+                )
+        route = getattr(vector_retriever, 'last_route', None)
+        if route and route['partition']:
+            log.append(f"🗺️ 按城市路由：{route['city']}分区（{route['chunks']} 个分块）")
+        elif route and route['fallback']:
+            log.append(f"🗺️ 识别到城市「{route['city']}」，{route['fallback']}，使用全局检索")
+        step_timings = getattr(vector_retriever, 'last_timings', None)
+        if step_timings:
+            log.append("⏱️ 知识库检索分步耗时：" + "，".join(
+                f"{name} {seconds * 1000:.1f} ms" for name, seconds in step_timings.items()
+            ))
+        log.append(f"⏱️ 知识库检索总耗时 {elapsed * 1000:.1f} ms")
+        
+        # 没有达到相似度阈值时检索器返回一条只有提示文字的结果，不放入提示词
+        texts = [info['text'] for info in retrieved_info or [] if 'content path' in info]
+        packed = pack_chunks(texts, token_budget)
+        log.append("📦 知识库上下文：" + describe_packing(packed, len(texts)))
+        return packed['text'], log, None
     except Exception as e:
-        st.error(f"知识库查询失败：{str(e)}")
-        return []
+        return "", log, str(e)
 
-def analyze_image(image, vision_agent):
-    """分析上传的图片"""
+def analyze_image(image, vision_analyzer):
+    """
+    分析上传的图片，返回 (图片描述, 错误信息, 提示文字)；不调用 st，可以在后台线程中运行
+
+    图片先缩小并重新编码再上传，相同或几乎相同的图片直接使用缓存的描述。
+    """
     try:
-        vision_msg = bm.make_user_message(
-            role_name="User", 
-            content="请详细描述这张图片的内容，特别关注与旅游相关的元素", 
-            image_list=[image]
-        )
-        
-        response = vision_agent.step(vision_msg)
+        result = vision_analyzer.analyze(image)
+        if result['cache'] == CACHE_EXACT:
+            note = "命中图片描述缓存"
+        elif result['cache'] == CACHE_NEAR:
+            note = f"命中相似图片的描述缓存（哈希距离 {result['distance']}）"
+        else:
+            note = (f"{result['size'][0]}×{result['size'][1]} 缩小为 {result['upload_size'][0]}×{result['upload_size'][1]}，"
+                    f"上传 {result['upload_bytes'] / 1024:.0f} KB")
         
         # 检查响应是否有效
-        if not response or not hasattr(response, 'msgs') or not response.msgs:
-            st.error("图片分析失败：API返回空响应")
-            return None
-            
-        image_description = response.msgs[0].content
-        return image_description
+        if not result['description']:
+            return None, "API返回空响应", note
+        return result['description'], None, note
     except Exception as e:
-        st.error(f"图片分析失败：{str(e)}")
-        return None
+        return None, str(e), ""
 
-def process_question_with_knowledge(user_question, image_description, vector_retriever, answerer_agent, kb_agent, evaluator_agent, use_kb=True):
-    """处理包含知识库检索的用户问题，并加入带延迟的重试机制"""
-    knowledge_info = ""
+def describe_llm_wait(process_log):
+    """当前线程最近一次大模型调用在网关中排队或被限流时写入处理日志"""
+    last_call = get_gateway().last_call()
+    if not last_call or (last_call['queue_wait'] < 0.5 and last_call['attempts'] == 1):
+        return
+    reasons = "、".join(sorted(last_call['throttled'])) or "无"
+    process_log.append(
+        f"⏳ 大模型排队 {last_call['queue_wait']:.1f} 秒（受限原因：{reasons}），"
+        f"共请求 {last_call['attempts']} 次，服务商限流 {last_call['rate_limited']} 次"
+    )
+
+def gather_context(user_question, image, vision_analyzer, vector_retriever):
+    """
+    并发执行图片分析（远程视觉模型）和知识库检索（查询编码 + 本地检索），两者都完成后再构建提示词
+
+    Returns:
+        (图片描述, 图片分析错误, 图片分析提示, retrieve_knowledge 的结果或None, 各步骤耗时)
+    """
+    timings = {}
     
-    # 如果启用知识库，先检索相关信息
-    if use_kb and vector_retriever:
+    def timed(name, func, *args):
+        start = time.perf_counter()
         try:
-            retrieved_info = query_knowledge_base(user_question, vector_retriever)
-            if retrieved_info:
-                knowledge_texts = [info['text'] for info in retrieved_info]
-                knowledge_info = "\n\n".join(knowledge_texts)
-        except Exception as e:
-            st.warning(f"知识库检索失败，将使用基础模式：{str(e)}")
+            return func(*args)
+        finally:
+            timings[name] = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        image_future = executor.submit(timed, '图片分析', analyze_image, image, vision_analyzer) if image is not None else None
+        kb_future = executor.submit(timed, '知识库检索', retrieve_knowledge, user_question, vector_retriever) if vector_retriever else None
+        image_description, image_error, image_note = image_future.result() if image_future else (None, None, "")
+        knowledge = kb_future.result() if kb_future else None
+    timings['合计'] = time.perf_counter() - start
+    return image_description, image_error, image_note, knowledge, timings
+
+def process_question_with_knowledge(user_question, image_description, knowledge, answerer_agent, kb_agent, evaluator, context_timings=None, stream_writer=None):
+    """
+    处理用户问题（图片描述和知识库检索结果已由 gather_context 准备好），并加入带延迟的重试机制
+
+    stream_writer(chunks) 接收逐段文本的生成器并返回完整回答，用于在页面上流式显示。
+
+    Returns:
+        (最终回答, 处理过程日志, 知识库信息, 回答是否通过评估)
+    """
+    knowledge_info = ""
+    process_log = []
+    
+    if context_timings and len(context_timings) > 1:
+        process_log.append("⏱️ 并发准备上下文：" + "，".join(
+            f"{name} {seconds * 1000:.0f} ms" for name, seconds in context_timings.items()
+        ))
+    
+    if knowledge:
+        knowledge_info, retrieval_log, retrieval_error = knowledge
+        process_log.extend(retrieval_log)
+        if retrieval_error:
+            process_log.append(f"⚠️ 知识库检索失败，使用基础模式：{retrieval_error}")
     
     # 构建完整问题
     full_question = f"用户问题：{user_question}\n\n"
@@ -228,6 +510,10 @@ def process_question_with_knowledge(user_question, image_description, vector_ret
         full_question += f"知识库相关信息：\n{knowledge_info}\n\n"
     
     full_question += "请结合以上信息回答用户的旅游相关问题。"
+    process_log.append(
+        f"🧮 本轮提示词约 {estimate_tokens(full_question)} tokens"
+        f"（知识库 {estimate_tokens(knowledge_info)}，图片描述 {estimate_tokens(image_description or '')}）"
+    )
     
     usr_msg = bm.make_user_message(
         role_name='用户',
@@ -238,105 +524,74 @@ def process_question_with_knowledge(user_question, image_description, vector_ret
     attempts = 0
     final_answer = None
     is_satisfied = False
-    process_log = []
-    wait_time = 5  # <--- 新增：初始等待时间为5秒
+    best_answer, best_score = None, None
     
     while attempts < max_retries and not is_satisfied:
         attempts += 1
         process_log.append(f"🔄 尝试第 {attempts} 次生成回答...")
         
         try:
-            # Step 1: 回答者生成答案
+            # Step 1: 回答者生成答案（提供了 stream_writer 时边生成边显示）
             answer_response = answerer_agent.step(usr_msg)
+            describe_llm_wait(process_log)
+            stream_stats = {}
+            chunks = stream_text(answer_response, stream_stats)
+            answer_content = stream_writer(chunks) if stream_writer else "".join(chunks)
             
-            if not answer_response or not hasattr(answer_response, 'msgs') or not answer_response.msgs:
+            if not answer_content:
                 process_log.append("❌ 回答生成失败：API返回空响应")
                 final_answer = "抱歉，我无法生成回答，请稍后重试。"
                 break
                 
-            answer_content = answer_response.msgs[0].content
+            if 'first_token' in stream_stats:
+                process_log.append(
+                    f"⏱️ 首段文字 {stream_stats['first_token'] * 1000:.0f} ms，"
+                    f"生成完成 {stream_stats.get('total', 0) * 1000:.0f} ms"
+                )
             process_log.append(f"【回答者回复】\n{answer_content}")
             
-            # Step 2: 构造评估请求 (并截断过长的内容)
-            truncated_answer = (answer_content[:1500] + '...') if len(answer_content) > 1500 else answer_content
-            truncated_kb = (knowledge_info[:1000] + '...') if len(knowledge_info) > 1000 else knowledge_info
-
-            evaluation_prompt = f"""
-请评估以下问答过程的质量：
-
-【用户提问】
-{user_question}
-
-【图片信息】
-{image_description if image_description else "无图片"}
-
-【知识库信息】
-{truncated_kb if truncated_kb else "未使用知识库"}
-
-【回答者回复摘要】
-{truncated_answer}
-
-【评分标准】
-请从准确性、完整性、清晰度等方面进行打分（1~10），并简要说明理由。
-
-请只返回一个数字 + 简要理由。
-"""
-            
-            evaluation_msg = bm.make_user_message(
-                role_name='评估器',
-                content=evaluation_prompt
+            # Step 2: 分层评估（启发式打分，只有边界情况才同步调用评估模型）
+            evaluation = evaluator.evaluate(user_question, answer_content, knowledge_info, image_description or "")
+            if evaluation['judge_content']:
+                process_log.append(f"【评估结果】\n{evaluation['judge_content']}")
+            score = evaluation['score']
+            score_text = f"{score:.1f}" if isinstance(score, float) else str(score)
+            process_log.append(
+                f"📏 评估层级：{EVAL_TIER_NAMES[evaluation['tier']]}，分数 {score_text}，"
+                f"耗时 {evaluation['seconds'] * 1000:.1f} ms"
+                + (f"，评估提示词约 {evaluation['prompt_tokens']} tokens" if evaluation['prompt_tokens'] else "")
+                + (f"（{'；'.join(evaluation['reasons'])}）" if evaluation['reasons'] else "")
             )
+            if score is not None and (best_score is None or score > best_score):
+                best_answer, best_score = answer_content, score
             
-            # Step 3: 评估者分析回答质量
-            evaluation_response = evaluator_agent.step(evaluation_msg)
-            
-            if not evaluation_response or not hasattr(evaluation_response, 'msgs') or not evaluation_response.msgs:
-                process_log.append("⚠️ 评估失败：API返回空响应，默认通过")
-                final_answer = answer_content
+            # Step 3: 判断是否满意
+            if evaluation['passed']:
                 is_satisfied = True
-                break
-                
-            evaluation_content = evaluation_response.msgs[0].content.strip()
-            process_log.append(f"【评估结果】\n{evaluation_content}")
-            
-            # Step 4: 判断是否满意
-            try:
-                score_str = evaluation_content.split()[0]
-                # 兼容 "8." 这样的格式
-                score = int(float(score_str.strip('.')))
-                if score >= 6:
-                    is_satisfied = True
-                    final_answer = answer_content
-                    process_log.append(f"✅ 评分达标（{score}分），生成完成！")
-                else:
-                    improve_msg = bm.make_user_message(
-                        role_name='评估反馈',
-                        content=f"你的回答得分 {score} 分，不够理想。请根据以下建议改进：{evaluation_content}"
-                    )
-                    answerer_agent.update_messages(improve_msg)
-                    process_log.append(f"❌ 评分不达标（{score}分），准备重新生成...")
-            except (ValueError, IndexError) as e:
-                process_log.append(f"⚠️ 无法解析评分 '{evaluation_content[:20]}...'，默认通过。错误: {e}")
                 final_answer = answer_content
-                is_satisfied = True
-
-        except openai.RateLimitError as e:
-            process_log.append(f" Rate-limit 错误：TPM 达到上限。将在 {wait_time} 秒后重试...")
-            time.sleep(wait_time)
-            wait_time *= 2  # 指数退避，增加下次等待时间
-            if attempts == max_retries:
-                final_answer = f"抱歉，API 请求过于频繁，请稍后再试。错误详情: {e}"
+                process_log.append(f"✅ 评分达标（{score_text}分），生成完成！")
+            else:
+                improve_msg = bm.make_user_message(
+                    role_name='评估反馈',
+                    content=f"你的回答得分 {score_text} 分，不够理想。请根据以下建议改进：{evaluation['feedback']}"
+                )
+                answerer_agent.update_messages(improve_msg)
+                process_log.append(f"❌ 评分不达标（{score_text}分），准备重新生成...")
 
         except Exception as e:
             process_log.append(f"❌ 第{attempts}次尝试失败：{str(e)}")
             if attempts == max_retries:
                 final_answer = "抱歉，系统遇到问题，请稍后重试。"
     
+    if not is_satisfied and best_answer is not None:
+        final_answer = best_answer
+        process_log.append(f"⚠️ {attempts} 次尝试均未达标，返回得分最高的回答（{best_score}分）")
+    
     if final_answer is None:
         final_answer = "抱歉，我无法为您提供满意的回答，请稍后重试或重新描述您的问题。"
         process_log.append("❌ 所有尝试都失败，返回默认回答")
     
-    return final_answer, process_log, knowledge_info
+    return final_answer, process_log, knowledge_info, is_satisfied
 
 # 主界面
 def main():
@@ -346,12 +601,21 @@ def main():
     
     # 初始化agents和知识库
     try:
-        answerer_agent, vision_agent, evaluator_agent, kb_agent = initialize_agents()
+        session_agents, vision_agents, evaluator_agents, kb_agent = initialize_agents()
+        evaluator = initialize_evaluator(evaluator_agents)
+        vision_analyzer = initialize_vision_analyzer(vision_agents)
         vector_retriever, embedding_model, vector_storage = initialize_knowledge_base()
+        ingestion_worker = initialize_ingestion_worker()
+        answer_cache = initialize_answer_cache()
     except Exception as e:
         st.error(f"初始化失败：{str(e)}")
         st.stop()
     
+    # 每个浏览器会话使用自己的回答者智能体，对话记忆互不影响
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = SessionAgentPool.new_session_id()
+    session = session_agents.get(st.session_state.session_id)
+    
     # 侧边栏设置
     with st.sidebar:
         st.header("⚙️ 功能设置")
@@ -364,6 +628,12 @@ def main():
             ["纯文字咨询", "图片+文字咨询", "知识库+文字咨询", "全功能模式"],
             index=0
         )
+        if st.button("🆕 新对话", help="清空本会话的对话记忆，之后的问题不再参考之前的问答"):
+            session.reset()
+            for key in ('final_answer', 'process_log', 'user_question', 'image_description',
+                        'uploaded_image', 'knowledge_info', 'answer_cache_similarity'):
+                st.session_state.pop(key, None)
+            st.success("已开始新对话")
         st.markdown("---")
         st.subheader("🔗 网页生成")
         st.markdown(
@@ -383,17 +653,14 @@ def main():
             
             if uploaded_kb_file is not None:
                 if st.button("📥 添加到知识库"):
-                    with st.spinner("正在处理文件并添加到知识库..."):
-                        success, result = process_uploaded_file(uploaded_kb_file, vector_retriever)
-                        if success:
-                            st.success(f"✅ 文件已成功添加到知识库：{result}")
-                            st.session_state.kb_files_count = st.session_state.get('kb_files_count', 0) + 1
-                        else:
-                            st.error(f"❌ 文件添加失败：{result}")
+                    success, result = process_uploaded_file(uploaded_kb_file, ingestion_worker)
+                    if success:
+                        st.success("✅ 文件已加入入库队列，处理期间可以继续提问")
+                    else:
+                        st.error(f"❌ 文件添加失败：{result}")
             
-            # 知识库统计
-            kb_count = st.session_state.get('kb_files_count', 0)
-            st.metric("知识库文件数", kb_count)
+            # 知识库统计（以入库清单为准，重启后也能保留）和入库进度
+            render_ingestion_progress(ingestion_worker)
         
         # 示例问题
         st.subheader("💡 示例问题")
@@ -464,21 +731,71 @@ def main():
                 image_description = None
                 use_kb = mode in ["知识库+文字咨询", "全功能模式"]
                 
-                # 如果有图片，先分析图片
-                if uploaded_image is not None:
-                    with st.spinner("正在分析图片..."):
-                        image_description = analyze_image(uploaded_image, vision_agent)
+                # 语义回答缓存：相同模式、知识库版本和图片下，城市和数字都相同的相似问题直接返回已通过评估的回答。
+                # 回答依赖会话的对话记忆，只在会话的第一轮查找和写入，追问（“那里冬天冷吗？”）总是交给回答者
+                cached, question_vector, cache_similarity = None, None, None
+                fresh_session = session.turns == 0
+                if answer_cache is not None and fresh_session:
+                    kb_version = ingestion_worker.ingestor.manifest.version() if use_kb and ingestion_worker else ""
+                    image_key = vision_analyzer.image_key(uploaded_image) if uploaded_image is not None else ""
+                    try:
+                        cached, question_vector, cache_similarity = answer_cache.lookup(
+                            user_input, kb_version, image_key, mode=mode
+                        )
+                    except Exception as e:
+                        print(f"查询回答缓存失败: {str(e)}")
+                
+                if cached:
+                    final_answer = cached['answer']
+                    knowledge_info = cached.get('knowledge_info', "")
+                    image_description = cached.get('image_description')
+                    process_log = [
+                        f"💾 命中语义回答缓存：与“{cached['question']}”的相似度 {cache_similarity:.3f}，"
+                        f"跳过图片分析、知识库检索、回答生成和评估"
+                    ]
+                    # 这一轮问答写入会话记忆，后续追问仍有上下文
+                    session.record_cached_turn(user_input, final_answer)
+                else:
+                    # 图片分析和知识库检索并发执行
+                    with st.spinner("正在分析图片并检索知识库..." if uploaded_image is not None else "正在准备回答..."):
+                        image_description, image_error, image_note, knowledge, context_timings = gather_context(
+                            user_input, uploaded_image, vision_analyzer, vector_retriever if use_kb else None
+                        )
+                    if uploaded_image is not None:
                         if image_description:
-                            st.success("✅ 图片分析完成")
+                            st.success(f"✅ 图片分析完成（{image_note}）" if image_note else "✅ 图片分析完成")
                         else:
-                            st.error("❌ 图片分析失败，将继续处理文字问题")
+                            st.error(f"❌ 图片分析失败（{image_error}），将继续处理文字问题")
+                    if knowledge and knowledge[2]:
+                        st.warning(f"知识库检索失败，将使用基础模式：{knowledge[2]}")
+                    
+                    # 处理问题：回答边生成边显示，评估完成后在下方统一展示结果
+                    answer_placeholder = st.empty()
+                    
+                    def stream_writer(chunks):
+                        with answer_placeholder.container():
+                            st.caption("✍️ 正在生成回答...")
+                            written = st.write_stream(chunks)
+                        return written if isinstance(written, str) else "".join(map(str, written or []))
                 
-                # 处理问题
-                with st.spinner("正在思考答案，请稍候..."):
-                    final_answer, process_log, knowledge_info = process_question_with_knowledge(
-                        user_input, image_description, vector_retriever if use_kb else None, 
-                        answerer_agent, kb_agent, evaluator_agent, use_kb
+                    final_answer, process_log, knowledge_info, is_satisfied = process_question_with_knowledge(
+                        user_input, image_description, knowledge,
+                        session.answerer, kb_agent, evaluator, context_timings, stream_writer
                     )
+                    answer_placeholder.empty()
+                    session.record_turn()
+                    process_log.append(
+                        f"🧮 本会话第 {session.turns} 轮，回答者上下文 {session.context_messages} 条消息，"
+                        f"约 {session.context_tokens} tokens"
+                    )
+                    
+                    # 只缓存通过评估、且图片分析和知识库检索都成功的回答
+                    if answer_cache is not None and fresh_session and question_vector is not None and is_satisfied \
+                            and not image_error and not (knowledge and knowledge[2]):
+                        answer_cache.put(
+                            user_input, final_answer, kb_version, image_key, mode=mode, vector=question_vector,
+                            knowledge_info=knowledge_info, image_description=image_description
+                        )
                 
                 # 存储结果到session state
                 st.session_state.final_answer = final_answer
@@ -487,6 +804,7 @@ def main():
                 st.session_state.image_description = image_description
                 st.session_state.uploaded_image = uploaded_image
                 st.session_state.knowledge_info = knowledge_info
+                st.session_state.answer_cache_similarity = cache_similarity if cached else None
             else:
                 st.warning("请输入问题后再提交！")
     
@@ -502,10 +820,53 @@ def main():
         if 'image_count' not in st.session_state:
             st.session_state.image_count = 0
         st.metric("已分析图片", st.session_state.image_count)
+        if vision_analyzer.cache is not None:
+            vision_stats = vision_analyzer.cache.stats()
+            if vision_stats['hits'] + vision_stats['near_hits'] + vision_stats['misses']:
+                st.caption(
+                    f"图片描述缓存命中率 {vision_stats['hit_rate']:.0%}"
+                    f"（相同 {vision_stats['hits']}，相似 {vision_stats['near_hits']}，未命中 {vision_stats['misses']}）"
+                )
+        
+        # 会话统计
+        session_stats = session_agents.stats()
+        st.caption(
+            f"本会话 {session.turns} 轮，上下文约 {session.context_tokens} tokens；"
+            f"活跃会话 {session_stats['sessions']} 个，最大上下文约 {session_stats['max_context_tokens']} tokens"
+        )
+        
+        # 大模型限流统计（本进程内各 API Key）
+        for key, llm_stats in get_gateway().stats().items():
+            st.caption(
+                f"{key}：{llm_stats['requests']} 次调用，最近一分钟 {llm_stats['requests_last_minute']} 次 / "
+                f"{llm_stats['tokens_last_minute']} tokens，平均排队 {llm_stats['mean_queue_wait']:.1f} 秒，"
+                f"服务商限流 {llm_stats['rate_limited']} 次"
+            )
         
         # 知识库统计
-        kb_count = st.session_state.get('kb_files_count', 0)
+        kb_count = len(ingestion_worker.ingestor.manifest.documents) if ingestion_worker else 0
         st.metric("知识库文件", kb_count)
+        
+        # 语义回答缓存统计
+        if answer_cache is not None:
+            answer_cache_stats = answer_cache.stats()
+            st.caption(
+                f"回答缓存 {answer_cache_stats['size']} 条，命中率 {answer_cache_stats['hit_rate']:.0%}"
+                f"（{answer_cache_stats['hits']}/{answer_cache_stats['hits'] + answer_cache_stats['misses']}）"
+            )
+        
+        # 回答评估统计（本进程内最近的评估）
+        eval_stats = evaluator.stats()
+        if eval_stats:
+            with st.expander("📏 回答评估统计", expanded=False):
+                for tier, tier_stats in eval_stats.items():
+                    mean_score = tier_stats['mean_score']
+                    st.caption(
+                        f"{EVAL_TIER_NAMES[tier]}：{tier_stats['count']} 次，通过率 {tier_stats['pass_rate']:.0%}，"
+                        f"平均分 {'-' if mean_score is None else f'{mean_score:.1f}'}，"
+                        f"p50 {tier_stats['p50_seconds'] * 1000:.0f} ms，p95 {tier_stats['p95_seconds'] * 1000:.0f} ms，"
+                        f"分数分布 {tier_stats['histogram']}"
+                    )
     
     # 显示结果
     if hasattr(st.session_state, 'final_answer') and st.session_state.final_answer:
@@ -533,6 +894,8 @@ def main():
             st.write(st.session_state.user_question)
         
         # 最终答案
+        if st.session_state.get('answer_cache_similarity'):
+            st.info(f"💾 该回答来自语义缓存（与之前的相似问题相似度 {st.session_state.answer_cache_similarity:.3f}）")
         st.success("**AI旅游助手回答：**")
         st.write(st.session_state.final_answer)
         
@@ -0,0 +1,116 @@
+"""
+按 token 预算打包提示词上下文
+
+原来知识库检索到的前3段文本不论多长都整段拼进回答者的提示词，评估提示词则按字符数硬截断
+（回答1500字、知识库1000字）。这里：
+- estimate_tokens 按 DeepSeek 官方给出的换算估算 token 数（中文约0.6、英文字符约0.3个token），
+  不依赖分词器下载，回答者和评估模型使用同一口径；
+- pack_chunks 按相关度依次放入检索结果，跳过与已放入内容高度重叠的分块，预算不够放下整段时
+  在句子边界处截断，剩余预算太少则丢弃；
+- trim_to_tokens 在句子边界处截断单段文本。
+每次打包的保留、截断、去重和丢弃情况都记录在返回结果中，便于写入处理日志。
+"""
+import re
+
+# DeepSeek 文档：1个中文字符约0.6个token，1个英文字符约0.3个token
+CJK_TOKENS_PER_CHAR = 0.6
+OTHER_TOKENS_PER_CHAR = 0.3
+
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]")
+_SENTENCE_END = re.compile(r"[。！？；!?;\n]|\.(\s|$)")
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的 token 数"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    other = len(text) - cjk - text.count(" ")
+    return int(cjk * CJK_TOKENS_PER_CHAR + other * OTHER_TOKENS_PER_CHAR + 0.999)
+
+
+def trim_to_tokens(text: str, budget: int, marker: str = "...") -> tuple:
+    """
+    把文本截断到 budget 个 token 以内，尽量在句子结尾处截断
+
+    Returns:
+        (截断后的文本, 是否被截断)
+    """
+    if estimate_tokens(text) <= budget:
+        return text, False
+    if budget <= 0:
+        return "", True
+    # 先按估算比例粗定位，再逐步回退到预算以内（给截断标记留出位置）
+    limit = budget - estimate_tokens(marker)
+    end = min(len(text), int(limit / OTHER_TOKENS_PER_CHAR))
+    while end > 0 and estimate_tokens(text[:end]) > limit:
+        end = int(end * 0.9)
+    cut = text[:end]
+    boundaries = [match.end() for match in _SENTENCE_END.finditer(cut)]
+    # 句子边界离截断点太远时宁可在句中截断，避免浪费过多预算
+    if boundaries and boundaries[-1] >= end * 0.6:
+        cut = cut[:boundaries[-1]]
+    return cut.rstrip() + marker, True
+
+
+def _shingles(text: str, size: int = 3) -> set:
+    compact = "".join(text.split())
+    return {compact[i:i + size] for i in range(max(1, len(compact) - size + 1))}
+
+
+def pack_chunks(chunks: list, budget: int, duplicate_threshold: float = 0.8,
+                min_chunk_tokens: int = 64, separator: str = "\n\n") -> dict:
+    """
+    按相关度顺序把文本分块放入 token 预算
+
+    Args:
+        chunks: 文本列表，已按相关度从高到低排列
+        budget: token 预算
+        duplicate_threshold: 与已放入的某一分块的三字片段重合比例达到该值时视为重复
+        min_chunk_tokens: 剩余预算少于该值时不再截断放入
+
+    Returns:
+        dict: text（打包后的文本）、tokens、budget，
+              kept [(序号, token数, 是否截断)]、duplicates [序号]、dropped [序号]
+    """
+    separator_tokens = estimate_tokens(separator)
+    result = {"text": "", "tokens": 0, "budget": budget, "kept": [], "duplicates": [], "dropped": []}
+    pieces, kept_shingles = [], []
+    used = 0
+    for number, text in enumerate(chunks):
+        text = (text or "").strip()
+        if not text:
+            continue
+        shingles = _shingles(text)
+        if any(len(shingles & previous) / len(shingles) >= duplicate_threshold for previous in kept_shingles):
+            result["duplicates"].append(number)
+            continue
+        remaining = budget - used - (separator_tokens if pieces else 0)
+        tokens = estimate_tokens(text)
+        trimmed = False
+        if tokens > remaining:
+            if remaining < min_chunk_tokens:
+                result["dropped"].append(number)
+                continue
+            text, trimmed = trim_to_tokens(text, remaining)
+            tokens = estimate_tokens(text)
+        used += tokens + (separator_tokens if pieces else 0)
+        pieces.append(text)
+        kept_shingles.append(shingles)
+        result["kept"].append((number, tokens, trimmed))
+    result["text"] = separator.join(pieces)
+    result["tokens"] = used
+    return result
+
+
+def describe_packing(packed: dict, candidates: int) -> str:
+    """一行打包摘要，用于处理日志"""
+    trimmed = sum(1 for _, _, was_trimmed in packed["kept"] if was_trimmed)
+    parts = [f"候选 {candidates} 段，保留 {len(packed['kept'])} 段"]
+    if trimmed:
+        parts.append(f"截断 {trimmed} 段")
+    if packed["duplicates"]:
+        parts.append(f"去重 {len(packed['duplicates'])} 段")
+    if packed["dropped"]:
+        parts.append(f"超出预算丢弃 {len(packed['dropped'])} 段")
+    return "，".join(parts) + f"，约 {packed['tokens']}/{packed['budget']} tokens"
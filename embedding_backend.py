@@ -0,0 +1,263 @@
+"""
+可替换的嵌入后端和动态批处理
+
+原来 Streamlit 进程内直接用 SentenceTransformerEncoder（PyTorch）逐条编码查询，多个会话同时提问时
+各自调用模型，在只有CPU的机器上互相争抢线程。这里提供：
+- 三种本地后端：torch（原来的方式）、onnx（ONNX Runtime，向量与 torch 基本一致）、
+  onnx-int8（动态 int8 量化，速度更快，向量略有偏差，可用 benchmarks/embedding_bench.py 检查）；
+- MicroBatcher：所有会话的编码请求进入同一个队列，由一个线程凑成小批量后一次编码；
+- RemoteEmbedding：调用 embedding_service.py 提供的本地嵌入服务，多个进程共用一个模型和批处理队列。
+ONNX 后端需要 sentence-transformers>=3.2 和 optimum[onnxruntime]，首次使用时导出到 storage_travel_kb/onnx_model/。
+"""
+import itertools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+from camel.embeddings import BaseEmbedding, SentenceTransformerEncoder
+
+from settings import EMBEDDING_SERVICE_URL
+
+EMBEDDING_MODEL_NAME = "intfloat/e5-large-v2"
+LOCAL_BACKENDS = ("torch", "onnx", "onnx-int8")
+ONNX_MODEL_DIR = os.path.join("storage_travel_kb", "onnx_model")
+
+
+def export_onnx_model(model_name: str, quantization: str = None, model_dir: str = ONNX_MODEL_DIR) -> tuple:
+    """
+    导出 ONNX 模型（已导出时直接复用）
+
+    Args:
+        quantization: None 表示 float32；否则为 int8 动态量化的指令集配置（arm64 / avx2 / avx512 / avx512_vnni）
+
+    Returns:
+        (本地模型目录, SentenceTransformer 的 model_kwargs)
+    """
+    from sentence_transformers import SentenceTransformer
+
+    local_dir = os.path.join(model_dir, model_name.replace("/", "__"))
+    if not os.path.exists(os.path.join(local_dir, "onnx", "model.onnx")):
+        print(f"首次使用ONNX后端，正在导出 {model_name} ...")
+        SentenceTransformer(model_name, backend="onnx").save_pretrained(local_dir)
+    if not quantization:
+        return local_dir, {}
+    file_name = f"onnx/model_qint8_{quantization}.onnx"
+    if not os.path.exists(os.path.join(local_dir, file_name)):
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+
+        print(f"正在生成 int8 量化模型（{quantization}）...")
+        export_dynamic_quantized_onnx_model(SentenceTransformer(local_dir, backend="onnx"), quantization, local_dir)
+    return local_dir, {"file_name": file_name}
+
+
+def create_encoder(backend: str = "torch", model_name: str = EMBEDDING_MODEL_NAME,
+                   quantization: str = "avx2") -> tuple:
+    """
+    创建本地编码器
+
+    Returns:
+        (编码器, 模型标识)。模型标识写入查询向量缓存和回答缓存，量化模型的向量与原模型不同，标识也不同。
+    """
+    if backend == "torch":
+        return SentenceTransformerEncoder(model_name=model_name), model_name
+    if backend == "onnx":
+        local_dir, model_kwargs = export_onnx_model(model_name)
+        return SentenceTransformerEncoder(model_name=local_dir, backend="onnx", model_kwargs=model_kwargs), model_name
+    if backend == "onnx-int8":
+        local_dir, model_kwargs = export_onnx_model(model_name, quantization)
+        encoder = SentenceTransformerEncoder(model_name=local_dir, backend="onnx", model_kwargs=model_kwargs)
+        return encoder, f"{model_name}@int8-{quantization}"
+    raise ValueError(f"Unknown embedding backend: {backend}")
+
+
+class MicroBatcher:
+    """
+    把并发的编码请求合并成小批量
+
+    队列中第一个请求到达后最多再等待 max_wait 秒，凑够 max_batch 条文本或等待超时就一起编码。
+    编码器空闲时单个请求几乎不增加延迟；编码器忙时新请求在队列中自然积累，下一批一次处理完。
+    入库这类多条文本的请求按 max_batch 切成多份排队，单条文本的查询优先处理，
+    最多等待正在编码的一批，不必等整个入库批次编码完。
+    """
+
+    def __init__(self, encode_batch, max_batch: int = 32, max_wait: float = 0.002):
+        self.encode_batch = encode_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.texts = 0
+        self.largest_batch = 0
+        self.encode_seconds = 0.0
+        self.wait_seconds = 0.0
+        threading.Thread(target=self._run, name="embedding-batcher", daemon=True).start()
+
+    def _put(self, texts: list, priority: int) -> Future:
+        future = Future()
+        self._queue.put((priority, next(self._counter), texts, future, time.perf_counter()))
+        return future
+
+    def submit(self, texts: list) -> Future:
+        texts = list(texts)
+        # 单条文本（交互查询）优先于批量编码
+        priority = 0 if len(texts) <= 1 else 1
+        parts = [self._put(texts[i:i + self.max_batch], priority)
+                 for i in range(0, len(texts), self.max_batch)] or [self._put(texts, priority)]
+        if len(parts) == 1:
+            return parts[0]
+
+        future = Future()
+        remaining = [len(parts)]
+        lock = threading.Lock()
+
+        def part_done(part: Future):
+            with lock:
+                if future.done():
+                    return
+                if part.exception() is not None:
+                    future.set_exception(part.exception())
+                    return
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    future.set_result([vector for done in parts for vector in done.result()])
+
+        for part in parts:
+            part.add_done_callback(part_done)
+        return future
+
+    def encode(self, texts: list, timeout: float = None) -> list:
+        return self.submit(texts).result(timeout)
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        count = len(batch[0][2])
+        deadline = time.perf_counter() + self.max_wait
+        while count < self.max_batch:
+            try:
+                remaining = deadline - time.perf_counter()
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if count + len(item[2]) > self.max_batch:
+                # 放不下的部分留给下一批（保持原来的优先级和顺序）
+                self._queue.put(item)
+                break
+            batch.append(item)
+            count += len(item[2])
+        return [item[2:] for item in batch]
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [text for item_texts, _, _ in batch for text in item_texts]
+            start = time.perf_counter()
+            try:
+                vectors = self.encode_batch(texts)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            finished = time.perf_counter()
+            with self._lock:
+                self.requests += len(batch)
+                self.batches += 1
+                self.texts += len(texts)
+                self.largest_batch = max(self.largest_batch, len(texts))
+                self.encode_seconds += finished - start
+                self.wait_seconds += sum(start - submitted for _, _, submitted in batch)
+            offset = 0
+            for item_texts, future, _ in batch:
+                future.set_result(vectors[offset:offset + len(item_texts)])
+                offset += len(item_texts)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "batches": self.batches,
+                "texts": self.texts,
+                "mean_batch_size": self.texts / self.batches if self.batches else 0.0,
+                "largest_batch": self.largest_batch,
+                "mean_wait_ms": self.wait_seconds / self.requests * 1000 if self.requests else 0.0,
+                "texts_per_second": self.texts / self.encode_seconds if self.encode_seconds else 0.0,
+            }
+
+
+class BatchingEmbedding(BaseEmbedding[str]):
+    """进程内编码器 + 动态批处理，embed() 和 embed_list() 都经过同一个队列，模型不会被并发调用"""
+
+    def __init__(self, encoder: BaseEmbedding, model_id: str = EMBEDDING_MODEL_NAME,
+                 max_batch: int = 32, max_wait: float = 0.002):
+        self.encoder = encoder
+        self.model_id = model_id
+        self.batcher = MicroBatcher(encoder.embed_list, max_batch=max_batch, max_wait=max_wait)
+        self._output_dim = None
+
+    def embed(self, obj: str, **kwargs) -> list:
+        return self.batcher.encode([obj])[0]
+
+    def embed_list(self, objs: list, **kwargs) -> list:
+        if not objs:
+            raise ValueError("Input text list is empty")
+        return self.batcher.encode(objs)
+
+    def get_output_dim(self) -> int:
+        if self._output_dim is None:
+            self._output_dim = self.encoder.get_output_dim()
+        return self._output_dim
+
+    def stats(self) -> dict:
+        return self.batcher.stats()
+
+
+class RemoteEmbedding(BaseEmbedding[str]):
+    """调用本地嵌入服务（embedding_service.py）编码，文本较多时按服务的单次请求上限分多次请求"""
+
+    def __init__(self, url: str = EMBEDDING_SERVICE_URL, timeout: float = 60):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self._session = requests.Session()
+        info = self.info()
+        self.model_id = info["model"]
+        self._output_dim = info["dim"]
+        self.max_texts = info.get("max_texts", 256)
+
+    def info(self) -> dict:
+        response = self._session.get(f"{self.url}/info", timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def embed_list(self, objs: list, **kwargs) -> list:
+        if not objs:
+            raise ValueError("Input text list is empty")
+        vectors = []
+        for start in range(0, len(objs), self.max_texts):
+            texts = objs[start:start + self.max_texts]
+            response = self._session.post(f"{self.url}/embed", json={"texts": texts}, timeout=self.timeout)
+            data = response.json()
+            if response.status_code != 200 or data.get("status") != "success":
+                raise RuntimeError(f"嵌入服务返回错误: {data.get('message', response.status_code)}")
+            vectors.extend(data["vectors"])
+        return vectors
+
+    def get_output_dim(self) -> int:
+        return self._output_dim
+
+    def stats(self) -> dict:
+        return self.info().get("batcher", {})
+
+
+def create_embedding_model(backend: str = "torch", model_name: str = EMBEDDING_MODEL_NAME,
+                           quantization: str = "avx2", max_batch: int = 32, max_wait: float = 0.002,
+                           service_url: str = EMBEDDING_SERVICE_URL):
+    """按后端名称创建嵌入模型：torch / onnx / onnx-int8 在进程内批处理，service 调用本地嵌入服务"""
+    if backend == "service":
+        return RemoteEmbedding(service_url)
+    encoder, model_id = create_encoder(backend, model_name, quantization)
+    return BatchingEmbedding(encoder, model_id, max_batch=max_batch, max_wait=max_wait)
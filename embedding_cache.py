@@ -0,0 +1,114 @@
+"""
+查询向量缓存：相同（规范化后）的问题不再重复调用嵌入模型编码
+"""
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from camel.embeddings import BaseEmbedding
+
+from persisted_cache import PersistedCache
+
+
+def normalize_query(text: str) -> str:
+    """规范化查询文本：全半角统一、去掉首尾空白、合并连续空白、英文小写"""
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split()).lower()
+
+
+class EmbeddingCache(PersistedCache):
+    """线程安全的LRU缓存：规范化查询文本 -> 向量，可选持久化到JSON文件"""
+
+    label = "查询向量缓存"
+
+    def __init__(self, max_size: int = 1024, path: str = None, model_name: str = "",
+                 save_every: int = 20):
+        self.max_size = max_size
+        self.model_name = model_name
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        super().__init__(path, save_every)
+
+    def _restore(self, data: dict):
+        # 换了嵌入模型后旧向量不能再用
+        if data.get("model") != self.model_name:
+            print(f"查询向量缓存的模型不一致，忽略旧缓存: {self.path}")
+            return
+        for key, vector in data.get("entries", [])[-self.max_size:]:
+            self._data[key] = vector
+        print(f"已加载 {len(self._data)} 条查询向量缓存")
+
+    def _snapshot(self) -> dict:
+        return {"model": self.model_name, "entries": list(self._data.items())}
+
+    def get(self, key: str):
+        with self._lock:
+            vector = self._data.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key: str, vector: list):
+        with self._lock:
+            self._data[key] = vector
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+            self._unsaved += 1
+            should_save = self._should_save()
+        if should_save:
+            self.save()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+class CachedEmbedding(BaseEmbedding[str]):
+    """
+    给嵌入模型加上查询向量缓存
+
+    只缓存单条查询的 embed()；知识库入库走 embed_list() 批量编码，不进入缓存。
+    每个线程最近一次查询的命中情况和编码耗时记录在 last_lookup 中。
+    """
+
+    def __init__(self, embedding_model: BaseEmbedding, cache: EmbeddingCache):
+        self.embedding_model = embedding_model
+        self.cache = cache
+        self._local = threading.local()
+
+    @property
+    def model_id(self):
+        return getattr(self.embedding_model, "model_id", None)
+
+    @property
+    def last_lookup(self) -> dict:
+        return getattr(self._local, "lookup", None)
+
+    def embed(self, obj: str, **kwargs) -> list:
+        key = normalize_query(obj)
+        start = time.perf_counter()
+        vector = self.cache.get(key)
+        hit = vector is not None
+        if not hit:
+            vector = self.embedding_model.embed(obj, **kwargs)
+            self.cache.put(key, vector)
+        self._local.lookup = {"hit": hit, "seconds": time.perf_counter() - start}
+        return vector
+
+    def embed_list(self, objs: list, **kwargs) -> list:
+        return self.embedding_model.embed_list(objs, **kwargs)
+
+    def get_output_dim(self) -> int:
+        return self.embedding_model.get_output_dim()
@@ -0,0 +1,96 @@
+"""
+本地嵌入服务
+
+在一个进程中加载嵌入模型（默认 ONNX Runtime 后端），所有调用方的编码请求进入同一个动态批处理队列，
+多个聊天助手进程/会话同时提问时合并成小批量编码。聊天助手设置 EMBEDDING_BACKEND=service 后使用本服务。
+
+    python embedding_service.py
+    # 批处理队列在进程内，只能单进程多线程部署
+    gunicorn -w 1 --threads 16 -b 0.0.0.0:5004 'embedding_service:create_app()'
+
+接口：
+    POST /embed  {"texts": ["..."]} -> {"status": "success", "model": 模型标识, "vectors": [[...]]}
+    GET  /info   -> 模型标识、向量维度、后端、单次请求的文本数上限和批处理统计
+"""
+import os
+
+from dotenv import load_dotenv
+from flask import Blueprint, Flask, jsonify, request
+
+from lifecycle import LazyResource, ServiceLifecycle
+
+load_dotenv()
+
+bp = Blueprint("embedding", __name__)
+
+BACKEND = os.getenv("EMBEDDING_SERVICE_BACKEND", "onnx")
+MAX_TEXTS_PER_REQUEST = int(os.getenv("EMBEDDING_SERVICE_MAX_TEXTS", "256"))
+
+
+def create_embedding_model():
+    """加载编码器并启动批处理线程（放到预热阶段执行）"""
+    from embedding_backend import EMBEDDING_MODEL_NAME, BatchingEmbedding, create_encoder
+
+    encoder, model_id = create_encoder(
+        BACKEND,
+        model_name=os.getenv("EMBEDDING_MODEL", EMBEDDING_MODEL_NAME),
+        quantization=os.getenv("EMBEDDING_QUANTIZATION", "avx2")
+    )
+    model = BatchingEmbedding(
+        encoder,
+        model_id,
+        max_batch=int(os.getenv("EMBEDDING_MAX_BATCH", "32")),
+        max_wait=float(os.getenv("EMBEDDING_MAX_WAIT_MS", "2")) / 1000
+    )
+    # 预热：第一次推理会初始化计算图
+    model.embed("预热")
+    return model
+
+
+embedding_model = LazyResource("embedding_model", create_embedding_model)
+lifecycle = ServiceLifecycle("embedding", resources=[embedding_model])
+
+
+@bp.route("/embed", methods=["POST"])
+def embed():
+    data = request.get_json(silent=True) or {}
+    texts = data.get("texts")
+    if not isinstance(texts, list) or not texts or not all(isinstance(text, str) for text in texts):
+        return jsonify({"status": "error", "message": "请求必须包含非空的texts字符串列表"}), 400
+    if len(texts) > MAX_TEXTS_PER_REQUEST:
+        return jsonify({"status": "error", "message": f"单次请求最多 {MAX_TEXTS_PER_REQUEST} 条文本"}), 400
+    try:
+        model = embedding_model.get()
+        return jsonify({"status": "success", "model": model.model_id, "vectors": model.embed_list(texts)})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"编码失败: {str(e)}"}), 500
+
+
+@bp.route("/info")
+def info():
+    try:
+        model = embedding_model.get()
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"模型加载失败: {str(e)}"}), 503
+    return jsonify({
+        "status": "success",
+        "model": model.model_id,
+        "dim": model.get_output_dim(),
+        "backend": BACKEND,
+        "max_texts": MAX_TEXTS_PER_REQUEST,
+        "batcher": model.stats(),
+    })
+
+
+def create_app(warm_up: bool = True) -> Flask:
+    """应用工厂，只能单进程部署：gunicorn -w 1 --threads 16 'embedding_service:create_app()'"""
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    lifecycle.install(app)
+    if warm_up:
+        lifecycle.warm_up(background=True)
+    return app
+
+
+if __name__ == "__main__":
+    create_app().run(host="0.0.0.0", port=5004, threaded=True)
@@ -3,45 +3,26 @@ import json
 import re
 import time
 import hashlib
-from flask import Flask, request, jsonify
+from contextlib import nullcontext
+from flask import Flask, Blueprint, request, jsonify
 import requests
-import tenacity
-from tenacity import retry, stop_after_attempt, wait_exponential
-
-from camel.configs import QwenConfig
-from camel.models import ModelFactory
-from camel.types import ModelPlatformType   
-from camel.toolkits import SearchToolkit
-from camel.agents import ChatAgent
+
 from dotenv import load_dotenv
+import llm_cache
+from lifecycle import LazyResource, ServiceLifecycle
+from metrics import external_call, stage
+from settings import STORAGE_DIR
 
 load_dotenv()
 
-app = Flask(__name__)
-
-# 环境变量
-os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
-os.environ["SEARCH_ENGINE_ID"] = os.getenv("SEARCH_ENGINE_ID")
+bp = Blueprint("generate", __name__)
 
 # 确保存储目录存在
-os.makedirs("storage", exist_ok=True)
-os.makedirs("storage/cache", exist_ok=True)
-
-# 模型初始化
-try:
-    model = ModelFactory.create(
-            model_platform=ModelPlatformType.OPENAI_COMPATIBLE_MODEL,
-            model_type="deepseek-ai/DeepSeek-V3",
-            url='https://api.siliconflow.cn/v1',
-            model_config_dict={"max_tokens": 8192},
-            api_key=os.getenv('FIRST_DEEPSEEK_API_KEY')
-    )
-
-    tools_list = [
-        *SearchToolkit().get_tools(),
-    ]
+CACHE_DIR = os.path.join(STORAGE_DIR, "cache")
+os.makedirs(STORAGE_DIR, exist_ok=True)
+os.makedirs(CACHE_DIR, exist_ok=True)
 
-    sys_msg = """
+sys_msg = """
     你是一位专业的旅游规划师。请你根据用户输入的旅行需求，包括旅行天数、景点/美食的距离、描述、图片URL、预计游玩/就餐时长等信息，为用户提供一个详细的行程规划。
 
     请遵循以下要求：
@@ -57,6 +38,24 @@ try:
     6. 保持回复简洁、有条理，但必须包含用户想要的所有信息。
     """
 
+def create_itinerary_agent():
+    """创建行程规划智能体（camel 导入较慢，放到预热阶段执行）"""
+    from camel.toolkits import SearchToolkit
+    from camel.agents import ChatAgent
+    from llm_gateway import create_model
+
+    # 环境变量
+    for name in ["GOOGLE_API_KEY", "SEARCH_ENGINE_ID"]:
+        if os.getenv(name):
+            os.environ[name] = os.getenv(name)
+
+    model = create_model("deepseek-ai/DeepSeek-V3", "FIRST_DEEPSEEK_API_KEY",
+                         model_config_dict={"max_tokens": 8192})
+
+    tools_list = [
+        *SearchToolkit().get_tools(),
+    ]
+
     agent = ChatAgent(
         system_message=sys_msg,
         model=model,
@@ -66,9 +65,10 @@ try:
     )
     
     print("模型和工具初始化成功")
-except Exception as e:
-    print(f"模型初始化失败: {str(e)}")
-    agent = None
+    return agent
+
+itinerary_agent = LazyResource("itinerary_agent", create_itinerary_agent)
+lifecycle = ServiceLifecycle("generate", resources=[itinerary_agent])
 
 # 生成缓存键
 def generate_cache_key(data):
@@ -79,7 +79,7 @@ def generate_cache_key(data):
 # 检查缓存
 def get_from_cache(cache_key):
     """从缓存获取数据"""
-    cache_file = f"storage/cache/{cache_key}.json"
+    cache_file = os.path.join(CACHE_DIR, f"{cache_key}.json")
     if os.path.exists(cache_file):
         try:
             with open(cache_file, 'r', encoding='utf-8') as f:
@@ -93,7 +93,7 @@ def get_from_cache(cache_key):
 # 保存到缓存
 def save_to_cache(cache_key, data):
     """保存数据到缓存"""
-    cache_file = f"storage/cache/{cache_key}.json"
+    cache_file = os.path.join(CACHE_DIR, f"{cache_key}.json")
     try:
         with open(cache_file, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False)
@@ -390,7 +390,7 @@ def save_html_file(city: str, days: str, html_content: str) -> str:
         str: 保存的文件路径
     """
     # 确保storage目录存在
-    storage_dir = "storage"
+    storage_dir = STORAGE_DIR
     if not os.path.exists(storage_dir):
         os.makedirs(storage_dir)
         
@@ -403,39 +403,38 @@ def save_html_file(city: str, days: str, html_content: str) -> str:
         
     return filename
 
-# 使用重试装饰器的函数
-@retry(
-    stop=stop_after_attempt(3),  # 最多重试3次
-    wait=wait_exponential(multiplier=2, min=4, max=20),  # 指数退避，最小等待4秒，最大20秒
-    reraise=True  # 重试失败后重新抛出原始异常
-)
-def generate_itinerary_with_retry(usr_msg):
-    """使用重试机制调用大模型生成行程"""
-    if not agent:
-        raise ValueError("模型未初始化成功，无法生成行程")
+def generate_itinerary(usr_msg):
+    """调用大模型生成行程（限流和重试由 llm_gateway 统一处理）"""
+    try:
+        agent = itinerary_agent.get()
+    except Exception as e:
+        raise ValueError(f"模型未初始化成功，无法生成行程: {str(e)}")
     
     print("开始调用大模型生成行程...")
     try:
-        response = agent.step(usr_msg)
+        with external_call("llm"):
+            response = agent.step(usr_msg)
         print("大模型调用成功")
         return response
     except Exception as e:
-        print(f"大模型调用失败，准备重试: {str(e)}")
+        print(f"大模型调用失败: {str(e)}")
         raise
 
-@app.route("/generate_itinerary_html", methods=["POST"])
+@bp.route("/generate_itinerary_html", methods=["POST"])
 def generate_itinerary_html():
     """
     请求 JSON 格式：
     {
       "city": "成都",
-      "days": "3"
+      "days": "3",
+      "force_refresh": false
     }
-    返回生成的HTML文件路径和内容
+    返回生成的HTML文件路径和内容，force_refresh 为 true 时跳过缓存重新生成
     """
     req_data = request.json or {}
     city = req_data.get("city", "")
     days = req_data.get("days", "1")
+    force_refresh = bool(req_data.get("force_refresh", False))
     
     print(f"收到请求：生成{city}{days}天旅游攻略HTML")
 
@@ -443,12 +442,13 @@ def generate_itinerary_html():
     cache_key = generate_cache_key({"city": city, "days": days})
     
     # 检查缓存
-    cached_result = get_from_cache(cache_key)
+    with stage("cache_lookup"):
+        cached_result = None if force_refresh else get_from_cache(cache_key)
     if cached_result:
         print(f"使用缓存结果：{cache_key}")
         return jsonify(cached_result), 200
 
-    json_filename = f"storage/{city}{days}天旅游信息.json"
+    json_filename = os.path.join(STORAGE_DIR, f"{city}{days}天旅游信息.json")
     if not os.path.exists(json_filename):
         print(f"错误：文件 {json_filename} 不存在")
         # 尝试在当前目录和上级目录查找文件
@@ -482,10 +482,12 @@ def generate_itinerary_html():
         usr_msg = create_usr_msg(data)
         print("已生成用户输入")
         
-        # 2. 调用大模型（带重试机制）
+        # 2. 调用大模型（限流时在网关中排队重试）
         try:
             print("开始调用大模型...")
-            response = generate_itinerary_with_retry(usr_msg)
+            # 强制刷新时同样跳过大模型响应缓存
+            with stage("llm_generate"), (llm_cache.bypass() if force_refresh else nullcontext()):
+                response = generate_itinerary(usr_msg)
             model_output = response.msgs[0].content
             print("大模型调用成功")
         except Exception as e:
@@ -496,23 +498,25 @@ def generate_itinerary_html():
         
         # 3. 将模型输出中的图片URL替换成 <img ... />
         print("处理图片URL")
-        end_output = convert_picurl_to_img_tag(model_output)
+        with stage("render"):
+            end_output = convert_picurl_to_img_tag(model_output)
 
-        # 4. 生成完整 HTML 报告
-        print("生成HTML报告")
-        html_content = generate_html_report(end_output, data)
+            # 4. 生成完整 HTML 报告
+            print("生成HTML报告")
+            html_content = generate_html_report(end_output, data)
 
         # 5. 保存HTML文件
         print("保存HTML文件")
-        saved_file = save_html_file(city, days, html_content)
+        with stage("save"):
+            saved_file = save_html_file(city, days, html_content)
 
-        # 6. 保存结果到缓存
-        result = {
-            "file_path": saved_file,
-            "html_content": html_content
-        }
-        print(f"保存结果到缓存：{cache_key}")
-        save_to_cache(cache_key, result)
+            # 6. 保存结果到缓存
+            result = {
+                "file_path": saved_file,
+                "html_content": html_content
+            }
+            print(f"保存结果到缓存：{cache_key}")
+            save_to_cache(cache_key, result)
 
         # 7. 返回文件路径和HTML内容
         print(f"成功生成HTML：{saved_file}")
@@ -593,5 +597,17 @@ def generate_fallback_itinerary(data):
     
     return "\n".join(itinerary)
 
+def create_app(warm_up: bool = True) -> Flask:
+    """应用工厂：多进程部署时每个工作进程各自创建并预热，例如 gunicorn -w 4 'generate:create_app()'"""
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    lifecycle.install(app)
+    if warm_up:
+        lifecycle.warm_up(background=True)
+    return app
+
+# 兼容 flask run 和 gunicorn generate:app：模块级应用不预热，资源在首个请求时初始化
+app = create_app(warm_up=False)
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5003, debug=True)
\ No newline at end of file
+    create_app().run(host="0.0.0.0", port=5003, debug=True)
\ No newline at end of file
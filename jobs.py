@@ -0,0 +1,186 @@
+import itertools
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from metrics import current_request_id, new_request_id, request_context
+
+# 任务优先级：数字越小越先执行，交互请求总是排在预取任务之前
+PRIORITY_INTERACTIVE = 0
+PRIORITY_PREFETCH = 10
+
+# 任务状态
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_SUCCESS = "success"
+STATUS_NEED_MORE_INFO = "need_more_info"
+STATUS_ERROR = "error"
+
+FINISHED_STATUSES = (STATUS_SUCCESS, STATUS_NEED_MORE_INFO, STATUS_ERROR)
+
+
+class Job:
+    """一个后台任务及其阶段进度"""
+
+    def __init__(self, func, args, kind: str, priority: int, meta: dict = None, request_id: str = None):
+        self.job_id = uuid.uuid4().hex
+        # 提交任务的请求的ID，任务中的分阶段耗时和服务间调用沿用该ID
+        self.request_id = request_id or new_request_id()
+        self.func = func
+        self.args = args
+        self.kind = kind
+        self.priority = priority
+        self.meta = meta or {}
+        self.status = STATUS_QUEUED
+        self.stage = "queued"
+        self.events = []
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def to_dict(self, since: int = 0) -> dict:
+        """转换为可JSON序列化的字典，since 之后的事件才会返回"""
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "request_id": self.request_id,
+            "status": self.status,
+            "stage": self.stage,
+            "meta": self.meta,
+            "events": [event for event in self.events if event["seq"] > since],
+            "result": self.result,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """
+    基于优先级队列的后台任务管理器
+
+    任务函数签名为 func(*args, progress=callback)，返回与 CentralService.process_user_query
+    相同格式的结果字典；callback(stage, message) 用于上报阶段进度。
+    """
+
+    def __init__(self, max_workers: int = 2, max_jobs: int = 500, service: str = "jobs"):
+        self.max_workers = max_workers
+        self.service = service
+        self.max_jobs = max_jobs
+        self._queue = queue.PriorityQueue()
+        self._jobs = OrderedDict()
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._workers = []
+        self._running = {}
+
+    def _ensure_workers(self):
+        # 工作线程在第一次提交任务时才启动，避免在多进程部署fork之前创建线程
+        if self._workers:
+            return
+        for i in range(self.max_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"job-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, func, *args, kind: str = "interactive",
+               priority: int = PRIORITY_INTERACTIVE, meta: dict = None) -> Job:
+        """提交任务，立即返回Job对象"""
+        job = Job(func, args, kind, priority, meta, request_id=current_request_id())
+        with self._cond:
+            self._jobs[job.job_id] = job
+            self._evict_finished()
+            self._ensure_workers()
+        self._add_event(job, "queued", "任务已提交，等待处理...")
+        self._queue.put((priority, next(self._counter), job.job_id))
+        return job
+
+    def get(self, job_id: str):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def wait_for_update(self, job_id: str, last_seq: int, timeout: float) -> bool:
+        """阻塞直到任务出现 last_seq 之后的新事件或任务结束，超时返回False"""
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    return False
+                if job.finished or (job.events and job.events[-1]["seq"] > last_seq):
+                    return True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+
+    def pending_count(self, kind: str = None) -> int:
+        """排队中的任务数，kind 为空时统计全部"""
+        with self._cond:
+            return sum(1 for job in self._jobs.values()
+                       if job.status == STATUS_QUEUED and (kind is None or job.kind == kind))
+
+    def running_count(self, kind: str = None) -> int:
+        """正在执行的任务数，kind 为空时统计全部"""
+        with self._cond:
+            return sum(1 for job in self._running.values() if kind is None or job.kind == kind)
+
+    def is_idle(self, kind: str = "interactive") -> bool:
+        """没有指定类型的任务在排队或执行时视为空闲"""
+        return self.pending_count(kind) == 0 and self.running_count(kind) == 0
+
+    def _add_event(self, job: Job, stage: str, message: str):
+        with self._cond:
+            seq = job.events[-1]["seq"] + 1 if job.events else 1
+            job.stage = stage
+            job.events.append({"seq": seq, "time": time.time(), "stage": stage, "message": message})
+            self._cond.notify_all()
+
+    def _evict_finished(self):
+        # 只保留最近 max_jobs 个任务，优先淘汰最早完成的任务
+        while len(self._jobs) > self.max_jobs:
+            for job_id, job in self._jobs.items():
+                if job.finished:
+                    del self._jobs[job_id]
+                    break
+            else:
+                break
+
+    def _worker_loop(self):
+        while True:
+            _, _, job_id = self._queue.get()
+            job = self.get(job_id)
+            if job is None:
+                continue
+            with self._cond:
+                job.status = STATUS_RUNNING
+                job.started_at = time.time()
+                self._running[job_id] = job
+
+            def progress(stage, message, _job=job):
+                self._add_event(_job, stage, message)
+
+            try:
+                with request_context(self.service, job.request_id, name=job.kind):
+                    result = job.func(*job.args, progress=progress)
+            except Exception as e:
+                result = {"error": f"处理请求时发生错误: {str(e)}"}
+
+            with self._cond:
+                self._running.pop(job_id, None)
+                job.result = result
+                job.finished_at = time.time()
+                if "error" in result:
+                    job.status = STATUS_ERROR
+                elif result.get("status") == "need_more_info":
+                    job.status = STATUS_NEED_MORE_INFO
+                else:
+                    job.status = STATUS_SUCCESS
+            self._add_event(job, "done", result.get("error") or result.get("message") or "任务完成")
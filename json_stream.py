@@ -0,0 +1,338 @@
+"""
+从大模型输出中增量提取JSON
+
+原来 search.py 的 extract_json_from_response / clean_json_string 和 user.py 都要等完整回复返回后，
+再按 "```json\\n" 之类的代码块标记切出JSON交给 json.loads，标记少一个换行、多一句说明文字，
+或者输出被 max_tokens 截断，整个结果就丢了。这里逐字符扫描：
+- 跳过第一个 { 或 [ 之前的任何内容（代码块标记、说明文字）；说明文字里的括号（如“根据[搜索结果]”、
+  没有闭合的“第[1步”）解析失败或遇到反引号时从下一个括号重新开始，后面出现 ```json 代码块时以代码块中的内容为准；
+- 数组中的每个元素（例如一个景点、一种美食）一结束就通过 on_item(路径, 序号, 值) 交给调用方，
+  不必等整个回复生成完，图片查找等后续步骤可以提前开始；
+- 结束时容忍数组/对象末尾多余的逗号和相邻元素之间缺少的逗号（与 on_item 收到的元素一致）；
+  输出被截断时保留最后一个完整的值并补全括号。
+"""
+import json
+import re
+import time
+
+_TRAILING_COMMA = re.compile(r",(\s*[\]}])")
+_CLOSERS = {"{": "}", "[": "]"}
+_FENCE_PATTERN = re.compile(r"```\s*json", re.I)
+
+# 流式调用的智能体的创建参数：部分响应只带新增文本（camel-ai 0.2.90 的默认值，显式设置以免版本间变化）
+STREAM_AGENT_OPTIONS = {"stream_accumulate": False}
+
+
+class JSONStreamExtractor:
+    """
+    增量JSON提取器：feed(文本片段) 逐段输入，close() 返回完整的根值
+
+    on_item(path, index, value) 在数组元素结束时调用。path 为该数组在根值中的位置，
+    由对象键和外层数组序号组成，例如 {"foods": [...]} 中的元素路径为 ("foods",)，根数组为 ()。
+    缺少逗号的相邻元素在回调和 close() 中一致地按多个元素处理；根值中出现不合法的元素后不再回调。
+    只有完整、合法的根值被后面的 ```json 代码块取代时，之前回调的元素才与 close() 的结果不一致。
+    """
+
+    def __init__(self, on_item=None):
+        self.on_item = on_item
+        self._data = ""
+        self._reset(0)
+
+    def _reset(self, position: int, fenced: bool = False):
+        """从 position 开始重新查找根值"""
+        self.items = 0
+        self._pos = self._seek_from = position
+        self._fenced = fenced
+        self._started = False
+        self._root_start = 0
+        self._root_end = 0
+        self._done = False
+        self._stopped = False
+        self._value = None
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._scalar_start = None
+        self._safe = None
+        # 相邻的值之间缺少逗号的位置，解析时在这些位置补上逗号
+        self._missing_commas = []
+        # 根值中出现过不是合法JSON的元素（多半是说明文字中的括号），不再回调 on_item
+        self._invalid = False
+
+    @property
+    def started(self) -> bool:
+        return self._started
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    def _path(self) -> tuple:
+        path = []
+        for frame in self._stack[:-1]:
+            path.append(frame["key"] if frame["type"] == "{" else frame["count"])
+        return tuple(path)
+
+    def _text(self, start: int, end: int) -> str:
+        """[start, end) 的文本，补上缺少的逗号"""
+        parts, last = [], start
+        for position in self._missing_commas:
+            if start < position < end:
+                parts.extend((self._data[last:position], ","))
+                last = position
+        parts.append(self._data[last:end])
+        return "".join(parts)
+
+    def _start_value(self, position: int):
+        """一个值（或对象的键）从 position 开始；前一个值后面缺少逗号时按有逗号处理"""
+        if not self._stack or self._stack[-1]["expect"] != "comma":
+            return
+        frame = self._stack[-1]
+        self._missing_commas.append(position)
+        if frame["type"] == "[":
+            frame["count"] += 1
+            frame["expect"] = "value"
+        else:
+            frame["expect"] = "key"
+
+    def _mark_safe(self, end: int):
+        """记录最后一个完整值之后的位置，以及此时需要补的右括号"""
+        closers = "".join(_CLOSERS[frame["type"]] for frame in reversed(self._stack))
+        self._safe = (end, closers)
+
+    def _value_done(self, start: int, end: int):
+        """一个值（字符串、标量或容器）在 [start, end) 结束"""
+        if not self._stack:
+            return
+        frame = self._stack[-1]
+        if frame["type"] == "[":
+            if self.on_item is not None and not self._invalid:
+                try:
+                    value = json.loads(_TRAILING_COMMA.sub(r"\1", self._text(start, end)))
+                except ValueError:
+                    self._invalid = True
+                else:
+                    self.on_item(self._path(), frame["count"], value)
+            self.items += 1
+        frame["expect"] = "comma"
+        self._mark_safe(end)
+
+    def _end_scalar(self, end: int):
+        if self._scalar_start is not None:
+            start, self._scalar_start = self._scalar_start, None
+            self._value_done(start, end)
+
+    def _root_closed(self, end: int) -> bool:
+        """根值在 end 处闭合：能解析时记录结果并返回True"""
+        text = self._text(self._root_start, end)
+        for candidate in (self._data[self._root_start:end], text, _TRAILING_COMMA.sub(r"\1", text)):
+            try:
+                self._value = json.loads(candidate)
+            except ValueError:
+                continue
+            self._done = True
+            self._root_end = end
+            self._mark_safe(end)
+            return True
+        return False
+
+    def feed(self, chunk: str):
+        if not chunk:
+            return
+        self._data += chunk
+        self._scan()
+
+    def _scan(self):
+        data = self._data
+        i = self._pos
+        while i < len(data) and not self._stopped:
+            if self._done:
+                # 根值不在代码块中时继续留意后面的 ```json，出现时以代码块中的内容为准
+                match = None if self._fenced else _FENCE_PATTERN.search(data, self._root_end)
+                if match is None:
+                    i = len(data)
+                    break
+                self._reset(match.end(), fenced=True)
+                i = self._pos
+                continue
+            char = data[i]
+            if not self._started:
+                if char not in "{[":
+                    i += 1
+                    continue
+                self._started = True
+                self._root_start = i
+                self._fenced = self._fenced or _FENCE_PATTERN.search(data, self._seek_from, i) is not None
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    frame = self._stack[-1]
+                    if frame["type"] == "{" and frame["expect"] == "key":
+                        try:
+                            frame["key"] = json.loads(data[self._string_start:i + 1])
+                        except ValueError:
+                            frame["key"] = data[self._string_start + 1:i]
+                        frame["expect"] = "colon"
+                    else:
+                        self._value_done(self._string_start, i + 1)
+                i += 1
+                continue
+            if char == '"':
+                self._end_scalar(i)
+                self._start_value(i)
+                self._in_string = True
+                self._string_start = i
+            elif char == "`":
+                # 反引号不会出现在JSON字符串之外。代码块中的根值遇到反引号说明代码块已经结束（输出不完整），
+                # 按截断处理；否则前面的括号属于说明文字，从这里重新查找（可能是代码块开头）
+                if self._fenced:
+                    self._stopped = True
+                    i = len(data)
+                    break
+                self._reset(i)
+                continue
+            elif char in "{[":
+                self._end_scalar(i)
+                self._start_value(i)
+                self._stack.append({"type": char, "start": i, "key": None, "count": 0,
+                                    "expect": "key" if char == "{" else "value"})
+            elif char in "}]":
+                self._end_scalar(i)
+                frame = self._stack.pop()
+                if not self._stack:
+                    if not self._root_closed(i + 1):
+                        # 例如说明文字中的“[搜索结果]”，从下一个字符重新查找根值
+                        self._reset(self._root_start + 1, fenced=self._fenced)
+                        i = self._pos
+                        continue
+                else:
+                    self._value_done(frame["start"], i + 1)
+            elif char == ",":
+                self._end_scalar(i)
+                frame = self._stack[-1]
+                if frame["type"] == "[" and frame["expect"] == "comma":
+                    frame["count"] += 1
+                frame["expect"] = "key" if frame["type"] == "{" else "value"
+            elif char == ":":
+                self._stack[-1]["expect"] = "value"
+            elif char.isspace():
+                # 标量（数字、true/false/null）中没有空白
+                self._end_scalar(i)
+            elif self._scalar_start is None:
+                self._start_value(i)
+                self._scalar_start = i
+            i += 1
+        self._pos = i
+
+    def close(self):
+        """
+        输入结束，返回根值；没有找到JSON时返回None
+
+        根值未闭合且补全后仍无法解析时（例如说明文字中没有闭合的括号），从下一个括号重新查找。
+        """
+        while True:
+            try:
+                return self._close_root()
+            except ValueError:
+                self._reset(self._root_start + 1, fenced=self._fenced)
+                self._scan()
+                if not self._started:
+                    return None
+
+    def _close_root(self):
+        if not self._started:
+            return None
+        if self._done:
+            return self._value
+        # 被截断：标量可能已经完整（如数组最后一个数字），否则退回最后一个完整的值
+        if self._scalar_start is not None and not self._in_string:
+            try:
+                json.loads(self._data[self._scalar_start:])
+                self._end_scalar(len(self._data))
+            except ValueError:
+                pass
+        root = self._data[self._root_start]
+        end, closers = self._safe or (self._root_start + 1, _CLOSERS[root])
+        text = self._text(self._root_start, end) + closers
+        try:
+            value = json.loads(text)
+        except ValueError:
+            value = json.loads(_TRAILING_COMMA.sub(r"\1", text))
+        print(f"大模型输出的JSON不完整，保留前 {end - self._root_start} 个字符并补全括号")
+        return value
+
+
+def extract_json(text: str, default=None, on_item=None):
+    """从完整文本中提取第一个JSON对象或数组，失败时返回 default"""
+    extractor = JSONStreamExtractor(on_item=on_item)
+    extractor.feed(text or "")
+    try:
+        value = extractor.close()
+    except ValueError as e:
+        print(f"解析JSON失败: {str(e)}")
+        return default
+    return default if value is None else value
+
+
+def stream_text(response, stats=None):
+    """
+    把 camel 智能体的响应转换为逐段增量文本
+
+    流式调用的智能体应以 stream_accumulate=False 创建（见 STREAM_AGENT_OPTIONS），每个部分响应只带
+    新增的文本；最后一个非部分响应是汇总，已经收到文本时跳过。响应注明了累积模式时按累积内容取新增部分。
+    非流式响应（包括不支持流式返回的 camel 版本给出的完整响应）只产生一段完整文本。
+    camel 在流式调用失败时返回带 error 的响应而不抛出异常，这里改为抛出 RuntimeError。
+    stats 中记录首段文本和全部完成的耗时（秒）。
+    """
+    from camel.responses import ChatAgentResponse
+
+    start = time.perf_counter()
+    streaming = hasattr(response, "__iter__") and not isinstance(response, ChatAgentResponse)
+    chunks = response if streaming else [response]
+    received = ""
+    for chunk in chunks:
+        info = getattr(chunk, "info", None) or {}
+        if info.get("error"):
+            raise RuntimeError(f"大模型调用失败: {info['error']}")
+        if not chunk or not getattr(chunk, "msgs", None):
+            continue
+        content = chunk.msgs[0].content or ""
+        if info.get("stream_accumulate_mode") == "accumulate":
+            delta = content[len(received):]
+        elif streaming and info.get("partial") is False and received:
+            delta = ""
+        else:
+            delta = content
+        if not delta:
+            continue
+        if stats is not None and "first_token" not in stats:
+            stats["first_token"] = time.perf_counter() - start
+        received += delta
+        yield delta
+    if stats is not None:
+        stats["total"] = time.perf_counter() - start
+
+
+def extract_json_stream(response, on_item=None, default=None) -> tuple:
+    """
+    边接收大模型的流式输出边提取JSON
+
+    Returns:
+        (根值或 default, 完整文本)
+    """
+    extractor = JSONStreamExtractor(on_item=on_item)
+    parts = []
+    for delta in stream_text(response):
+        parts.append(delta)
+        extractor.feed(delta)
+    try:
+        value = extractor.close()
+    except ValueError as e:
+        print(f"解析JSON失败: {str(e)}")
+        value = None
+    return (default if value is None else value), "".join(parts)
@@ -0,0 +1,144 @@
+"""
+知识库近似最近邻（HNSW）索引
+
+本地嵌入式Qdrant把向量保存在SQLite中，查询时逐条暴力计算，耗时随知识库规模线性增长。
+HNSWIndex 在 QuantizedIndex 的基础上增加一张 HNSW 图（使用 hnswlib），查询复杂度约为对数级：
+- 向量数量不超过 exact_threshold 时仍使用精确（或量化+重排）查询，小知识库没有召回损失；
+- 新入库的向量直接插入图中，删除的向量只做标记，不需要重建；
+- 图和ID映射与向量一起保存在 storage_travel_kb/ann_index/ 下。
+未安装 hnswlib 时自动退回到精确查询。
+"""
+import json
+import os
+
+import numpy as np
+
+from kb_index import QuantizedIndex, normalize_vectors
+from settings import KB_PATH, KB_VECTOR_DIM
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+ANN_INDEX_DIR = os.path.join(KB_PATH, "ann_index")
+
+
+class HNSWIndex(QuantizedIndex):
+    """HNSW 近似最近邻索引，接口与 QuantizedIndex 相同"""
+
+    def __init__(self, dim: int = KB_VECTOR_DIM, mode: str = "none", oversampling: float = 4.0,
+                 path: str = ANN_INDEX_DIR, quantile: float = 0.99, exact_threshold: int = 20000,
+                 m: int = 16, ef_construction: int = 200, ef_search: int = 64):
+        super().__init__(dim=dim, mode=mode, oversampling=oversampling, path=path, quantile=quantile)
+        self.exact_threshold = exact_threshold
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.graph = None
+        # hnswlib 只接受整数标签，删除后标签不会复用
+        self._labels = {}
+        self._label_ids = {}
+        self._next_label = 0
+        if hnswlib is None:
+            print("未安装 hnswlib，知识库将使用精确查询（pip install hnswlib）")
+
+    def _new_graph(self, capacity: int):
+        graph = hnswlib.Index(space="ip", dim=self.dim)
+        graph.init_index(max_elements=capacity, ef_construction=self.ef_construction, M=self.m,
+                         allow_replace_deleted=True)
+        return graph
+
+    def _graph_add(self, ids: list, vectors):
+        """把还没有标签的向量插入图中（向量已归一化，内积即余弦相似度）"""
+        if hnswlib is None:
+            return
+        pending = [(str(point_id), row) for row, point_id in enumerate(ids) if str(point_id) not in self._labels]
+        if not pending:
+            return
+        if self.graph is None:
+            self.graph = self._new_graph(max(1024, len(pending) * 2))
+        needed = self.graph.get_current_count() + len(pending)
+        if needed > self.graph.get_max_elements():
+            self.graph.resize_index(max(needed, self.graph.get_max_elements() * 2))
+        labels = np.arange(self._next_label, self._next_label + len(pending))
+        rows = [row for _, row in pending]
+        self.graph.add_items(np.asarray(vectors[rows], dtype=np.float32), labels, replace_deleted=True)
+        for (point_id, _), label in zip(pending, labels):
+            self._labels[point_id] = int(label)
+            self._label_ids[int(label)] = point_id
+        self._next_label += len(pending)
+
+    def build(self, ids: list, vectors):
+        with self._lock:
+            super().build(ids, vectors)
+            self.graph = None
+            self._labels, self._label_ids, self._next_label = {}, {}, 0
+            self._graph_add(self.ids, self.vectors)
+
+    def add(self, ids: list, vectors):
+        if not ids:
+            return
+        vectors = normalize_vectors(vectors)
+        with self._lock:
+            super().add(ids, vectors)
+            self._graph_add(ids, vectors)
+
+    def remove(self, ids: list):
+        with self._lock:
+            super().remove(ids)
+            for point_id in ids:
+                label = self._labels.pop(str(point_id), None)
+                if label is not None:
+                    self._label_ids.pop(label, None)
+                    self.graph.mark_deleted(label)
+
+    def search(self, query_vector, top_k: int = 3) -> list:
+        with self._lock:
+            if self.graph is None or len(self.ids) <= self.exact_threshold:
+                return super().search(query_vector, top_k)
+            k = min(top_k, len(self._labels))
+            self.graph.set_ef(max(self.ef_search, k))
+            labels, distances = self.graph.knn_query(normalize_vectors(query_vector), k=k)
+            # ip 空间的距离为 1 - 内积
+            return [(self._label_ids[int(label)], float(1 - distance))
+                    for label, distance in zip(labels[0], distances[0])]
+
+    def memory_bytes(self) -> dict:
+        result = super().memory_bytes()
+        # hnswlib 在内存中保存一份 float32 向量和每个节点的邻接表
+        result["graph"] = len(self._labels) * (self.dim * 4 + self.m * 2 * 4) if self.graph else 0
+        return result
+
+    def save(self):
+        with self._lock:
+            super().save()
+            if self.graph is None:
+                return
+            tmp_path = os.path.join(self.path, "hnsw.bin.tmp")
+            self.graph.save_index(tmp_path)
+            os.replace(tmp_path, os.path.join(self.path, "hnsw.bin"))
+            tmp_path = os.path.join(self.path, "hnsw_labels.json.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"labels": self._labels, "next_label": self._next_label}, f)
+            os.replace(tmp_path, os.path.join(self.path, "hnsw_labels.json"))
+
+    @classmethod
+    def load(cls, path: str = ANN_INDEX_DIR, oversampling: float = 4.0, **kwargs):
+        index = super().load(path, oversampling=oversampling, **kwargs)
+        if index is None or hnswlib is None:
+            return index
+        graph_path = os.path.join(path, "hnsw.bin")
+        labels_path = os.path.join(path, "hnsw_labels.json")
+        if os.path.exists(graph_path) and os.path.exists(labels_path):
+            with open(labels_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            index.graph = hnswlib.Index(space="ip", dim=index.dim)
+            index.graph.load_index(graph_path, allow_replace_deleted=True)
+            index._labels = data["labels"]
+            index._label_ids = {label: point_id for point_id, label in index._labels.items()}
+            index._next_label = data["next_label"]
+        else:
+            # 只有向量没有图（例如之前没有安装 hnswlib），直接重建图
+            index._graph_add(index.ids, index.vectors)
+        return index
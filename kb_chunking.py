@@ -0,0 +1,191 @@
+"""
+面向中文文档的分块
+
+camel VectorRetriever 默认用 Unstructured IO 按标题分块，切分规则针对英文：中文 PDF 中
+每行末尾的换行会被当成段落边界，句子常在“。”之外的位置被截断。这里：
+1. PDF 按页并行抽取文本（pypdf，多进程；未安装时退回 Unstructured IO）；
+2. 合并 PDF 排版造成的行内换行（包括跨页），按中文标点（。！？；…）和英文句末标点切句；
+3. 按句子贪心拼成不超过 chunk_size 个字符的分块，相邻分块重叠约 overlap 个字符，
+   遇到“1. 天安门广场”这类编号标题且当前分块已过半时另起一块。
+ChineseChunker 可以直接作为 KnowledgeBaseIngestor 的 chunker。
+"""
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+TEXT_EXTENSIONS = {".txt", ".md", ".markdown", ".csv", ".json"}
+
+# 句末标点（含紧跟的右引号/括号），英文句点后须有空白，避免切开小数和网址
+_SENTENCE_PATTERN = re.compile(r".*?(?:[。！？；…!?;]+[”’」』）)]*|\.(?=\s)|\n|$)", re.S)
+_TERMINAL_PUNCTUATION = "。！？；…!?;:：”’」』）)"
+_HEADING_PATTERN = re.compile(r"^\s*(\d{1,3}[\.、．]\s*\S|第[一二三四五六七八九十百\d]+[章节部分天]|[一二三四五六七八九十]+、)")
+_BULLET_PATTERN = re.compile(r"^\s*[•·\-*]\s*")
+# 切句时被英文句点切开的编号（“1. 天安门广场”中的“1.”），与后面的标题合并
+_NUMBER_PATTERN = re.compile(r"^\s*\d{1,3}\.$")
+
+
+def _extract_page_range(path: str, start: int, end: int) -> list:
+    reader = PdfReader(path)
+    return [(number + 1, reader.pages[number].extract_text() or "") for number in range(start, end)]
+
+
+def extract_pdf_pages(path: str, workers: int = 4, min_pages_per_worker: int = 8) -> list:
+    """
+    按页抽取PDF文本，返回 [(页码, 文本)]
+
+    pypdf 是纯 Python 实现，多线程受 GIL 限制，这里按页码区间分给多个进程；页数较少时直接串行。
+    """
+    reader = PdfReader(path)
+    total = len(reader.pages)
+    workers = max(1, min(workers, total // min_pages_per_worker))
+    if workers == 1:
+        return [(number + 1, page.extract_text() or "") for number, page in enumerate(reader.pages)]
+    step = (total + workers - 1) // workers
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_extract_page_range, path, start, min(total, start + step))
+                   for start in range(0, total, step)]
+        return [page for future in futures for page in future.result()]
+
+
+def _unstructured_pages(path: str) -> list:
+    """其他格式交给 Unstructured IO 解析，按元素的页码归并"""
+    from camel.loaders import UnstructuredIO
+
+    pages = {}
+    for element in UnstructuredIO().parse_file_or_url(path) or []:
+        number = getattr(element.metadata, "page_number", None) or 1
+        pages.setdefault(number, []).append(str(element))
+    return [(number, "\n".join(texts)) for number, texts in sorted(pages.items())]
+
+
+def extract_pages(path: str, workers: int = 4) -> list:
+    """抽取文档文本，返回 [(页码, 文本)]，非分页格式只有一页"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".pdf" and PdfReader is not None:
+        return extract_pdf_pages(path, workers)
+    if extension in TEXT_EXTENSIONS:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            return [(1, f.read())]
+    return _unstructured_pages(path)
+
+
+def _display_width(text: str) -> float:
+    """排版宽度：ASCII字符按半个汉字计算"""
+    return sum(0.5 if char.isascii() else 1.0 for char in text)
+
+
+def merge_wrapped_lines(pages: list) -> list:
+    """
+    合并排版换行，返回 [(页码, 段落)]
+
+    一行几乎排满（不小于大多数行宽度的85%）且不以句末标点结尾时，视为与下一行同属一个段落，
+    跨页也一样合并；段落的页码取第一行所在的页。中文之间直接拼接，英文单词之间补一个空格。
+    """
+    lines = [(page, line.strip()) for page, text in pages for line in text.splitlines() if line.strip()]
+    if not lines:
+        return []
+    widths = sorted(_display_width(line) for _, line in lines)
+    full_width = widths[int(len(widths) * 0.75)] * 0.85
+    merged = []
+    previous_full = False
+    for page, line in lines:
+        if (merged and previous_full and merged[-1][1][-1] not in _TERMINAL_PUNCTUATION
+                and not _HEADING_PATTERN.match(line) and not _BULLET_PATTERN.match(line)):
+            previous = merged[-1][1]
+            joiner = " " if previous[-1].isascii() and line[0].isascii() else ""
+            merged[-1] = (merged[-1][0], previous + joiner + line)
+        else:
+            merged.append((page, line))
+        previous_full = _display_width(line) >= full_width
+    return merged
+
+
+def split_sentences(text: str) -> list:
+    """按中英文句末标点和换行切句，保留标点和句后的换行/空格，直接拼接即可还原"""
+    sentences = []
+    pending = ""
+    for sentence in _SENTENCE_PATTERN.findall(text):
+        if not sentence.strip():
+            continue
+        if _NUMBER_PATTERN.match(sentence):
+            pending += sentence
+            continue
+        sentences.append(pending + sentence)
+        pending = ""
+    if pending:
+        sentences.append(pending)
+    return sentences
+
+
+def _hard_split(sentence: str, size: int) -> list:
+    """超长的句子（表格、列表合并后的行）按固定长度切开"""
+    return [sentence[i:i + size] for i in range(0, len(sentence), size)]
+
+
+def chunk_sentences(sentences: list, chunk_size: int = 400, overlap: int = 80) -> list:
+    """
+    把 [(页码, 句子)] 贪心拼成分块，返回 [(起始页码, 文本)]
+
+    新分块以上一分块末尾不超过 overlap 个字符的完整句子开头；重叠部分加上下一句会超过 chunk_size
+    （例如下一句是被硬切开的长句）时缩短重叠，重叠覆盖了整个上一分块时不重叠。
+    """
+    units = []
+    for page, sentence in sentences:
+        units.extend((page, piece) for piece in _hard_split(sentence, chunk_size))
+
+    chunks = []
+    current, length, fresh = [], 0, 0
+    for page, sentence in units:
+        is_heading = bool(_HEADING_PATTERN.match(sentence.lstrip()))
+        if current and fresh and (length + len(sentence) > chunk_size
+                                  or (is_heading and length >= chunk_size // 2)):
+            chunks.append((current[0][0], "".join(text for _, text in current).strip()))
+            tail, tail_length = [], 0
+            if not is_heading:
+                for item in reversed(current):
+                    if (tail_length + len(item[1]) > overlap
+                            or tail_length + len(item[1]) + len(sentence) > chunk_size):
+                        break
+                    tail.insert(0, item)
+                    tail_length += len(item[1])
+                if len(tail) == len(current):
+                    tail, tail_length = [], 0
+            current, length, fresh = tail, tail_length, 0
+        current.append((page, sentence))
+        length += len(sentence)
+        fresh += 1
+    if current and fresh:
+        chunks.append((current[0][0], "".join(text for _, text in current).strip()))
+    return chunks
+
+
+class ChineseChunker:
+    """按中文句子边界分块，接口与 kb_ingest.unstructured_chunks 相同：chunker(path) -> [{"text", "metadata"}]"""
+
+    def __init__(self, chunk_size: int = 400, overlap: int = 80, workers: int = 4):
+        if overlap >= chunk_size:
+            raise ValueError("overlap must be smaller than chunk_size.")
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.workers = workers
+
+    @property
+    def chunker_id(self) -> str:
+        """分块方式标识，写入入库清单；参数或切分规则变化后同一文件会重新分块"""
+        return f"chinese:{self.chunk_size}:{self.overlap}:2"
+
+    def __call__(self, path: str) -> list:
+        sentences = []
+        for page, paragraph in merge_wrapped_lines(extract_pages(path, self.workers)):
+            sentences.extend((page, sentence) for sentence in split_sentences(paragraph + "\n"))
+        filename = os.path.basename(path)
+        filetype = os.path.splitext(path)[1].lstrip(".").lower()
+        return [
+            {"text": text, "metadata": {"filename": filename, "filetype": filetype, "page_number": page}}
+            for page, text in chunk_sentences(sentences, self.chunk_size, self.overlap)
+        ]
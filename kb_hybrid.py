@@ -0,0 +1,326 @@
+"""
+知识库混合检索：BM25关键词检索 + 向量检索，倒数排名融合（RRF）
+
+e5-large-v2 以英文语料为主，对中文专有名词（景点名、菜名、地名）的区分能力有限，
+关键词检索可以补上这部分召回。中文分词优先使用 jieba（可选依赖），未安装时退回到
+单字 + 相邻双字切分。
+
+倒排索引保存在 storage_travel_kb/bm25/ 下：
+- snapshot.json：某一时刻的全部文档词频；
+- log.jsonl：之后的增删操作，每次入库只追加几行，加载时按顺序重放，
+  日志过长时自动合并进快照。
+"""
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+
+from camel.storages import VectorDBQuery
+
+from embedding_cache import normalize_query
+from kb_index import IndexedVectorRetriever, collection_size
+from settings import KB_PATH
+
+try:
+    import jieba
+    jieba.setLogLevel(logging.WARNING)
+except ImportError:
+    jieba = None
+
+BM25_DIR = os.path.join(KB_PATH, "bm25")
+TOKENIZER_NAME = "jieba" if jieba else "bigram"
+
+_TOKEN_PATTERN = re.compile(r"[\u4e00-\u9fff]+|[a-z0-9]+")
+_CJK_PATTERN = re.compile(r"[\u4e00-\u9fff]")
+
+# 高频但没有区分度的词，不参与打分
+STOPWORDS = {
+    "的", "了", "是", "在", "和", "与", "有", "也", "就", "都", "而", "及", "或", "等",
+    "我", "你", "他", "她", "它", "我们", "你们", "吗", "呢", "吧", "啊", "呀",
+    "什么", "怎么", "怎样", "如何", "哪些", "哪里", "哪个", "一个", "一下", "可以", "这个", "那个",
+    "请问", "推荐", "一些", "有没有", "是否",
+}
+
+
+def tokenize(text: str) -> list:
+    """中文分词（jieba 搜索引擎模式，或单字+双字），英文和数字按词切分"""
+    tokens = []
+    for piece in _TOKEN_PATTERN.findall(normalize_query(text)):
+        if not _CJK_PATTERN.match(piece):
+            tokens.append(piece)
+        elif jieba:
+            tokens.extend(word for word in jieba.cut_for_search(piece) if word.strip())
+        else:
+            tokens.extend(piece)
+            tokens.extend(piece[i:i + 2] for i in range(len(piece) - 1))
+    return [token for token in tokens if token not in STOPWORDS]
+
+
+class BM25Index:
+    """可增量更新的BM25倒排索引"""
+
+    def __init__(self, path: str = BM25_DIR, k1: float = 1.5, b: float = 0.75, compact_after: int = 5000):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.compact_after = compact_after
+        self.tokenizer = TOKENIZER_NAME
+        self.docs = {}
+        self.postings = {}
+        self.total_length = 0
+        self._log_entries = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.docs)
+
+    def _index_doc(self, doc_id: str, length: int, term_freqs: dict):
+        self._unindex_doc(doc_id)
+        self.docs[doc_id] = (length, term_freqs)
+        self.total_length += length
+        for term, freq in term_freqs.items():
+            self.postings.setdefault(term, {})[doc_id] = freq
+
+    def _unindex_doc(self, doc_id: str):
+        entry = self.docs.pop(doc_id, None)
+        if entry is None:
+            return
+        length, term_freqs = entry
+        self.total_length -= length
+        for term in term_freqs:
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self.postings[term]
+
+    @staticmethod
+    def _term_freqs(text: str):
+        tokens = tokenize(text)
+        term_freqs = {}
+        for token in tokens:
+            term_freqs[token] = term_freqs.get(token, 0) + 1
+        return len(tokens), term_freqs
+
+    def _append_log(self, entries: list):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, "log.jsonl"), "a", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._log_entries += len(entries)
+        if self._log_entries >= self.compact_after:
+            self._write_snapshot()
+
+    def _write_snapshot(self):
+        os.makedirs(self.path, exist_ok=True)
+        snapshot = {
+            "tokenizer": self.tokenizer,
+            "docs": {doc_id: [length, term_freqs] for doc_id, (length, term_freqs) in self.docs.items()},
+        }
+        tmp_path = os.path.join(self.path, "snapshot.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.path, "snapshot.json"))
+        # 快照已经包含日志中的全部操作
+        open(os.path.join(self.path, "log.jsonl"), "w").close()
+        self._log_entries = 0
+
+    def build(self, items: list):
+        """用 [(文档ID, 文本)] 重建索引并写入快照"""
+        with self._lock:
+            self.docs, self.postings, self.total_length = {}, {}, 0
+            for doc_id, text in items:
+                self._index_doc(str(doc_id), *self._term_freqs(text))
+            self._write_snapshot()
+
+    def add(self, items: list):
+        """增量加入 [(文档ID, 文本)]，已有的ID会被覆盖"""
+        if not items:
+            return
+        with self._lock:
+            entries = []
+            for doc_id, text in items:
+                length, term_freqs = self._term_freqs(text)
+                self._index_doc(str(doc_id), length, term_freqs)
+                entries.append({"op": "add", "id": str(doc_id), "len": length, "tf": term_freqs})
+            self._append_log(entries)
+
+    def remove(self, ids: list):
+        with self._lock:
+            entries = []
+            for doc_id in ids:
+                if str(doc_id) in self.docs:
+                    self._unindex_doc(str(doc_id))
+                    entries.append({"op": "del", "id": str(doc_id)})
+            if entries:
+                self._append_log(entries)
+
+    def search(self, query: str, top_k: int = 10) -> list:
+        """返回 [(文档ID, BM25分数)]，按分数从高到低排列"""
+        terms = set(tokenize(query))
+        with self._lock:
+            total = len(self.docs)
+            if not total or not terms:
+                return []
+            average_length = self.total_length / total or 1.0
+            scores = {}
+            for term in terms:
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, freq in postings.items():
+                    length = self.docs[doc_id][0]
+                    norm = self.k1 * (1 - self.b + self.b * length / average_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * freq * (self.k1 + 1) / (freq + norm)
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+    @classmethod
+    def load(cls, path: str = BM25_DIR, **kwargs):
+        """加载快照并重放增量日志；不存在或分词方式不一致时返回None"""
+        snapshot_path = os.path.join(path, "snapshot.json")
+        if not os.path.exists(snapshot_path):
+            return None
+        with open(snapshot_path, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+        if snapshot.get("tokenizer") != TOKENIZER_NAME:
+            print(f"BM25索引的分词方式（{snapshot.get('tokenizer')}）与当前环境（{TOKENIZER_NAME}）不一致，需要重建")
+            return None
+        index = cls(path=path, **kwargs)
+        for doc_id, (length, term_freqs) in snapshot["docs"].items():
+            index._index_doc(doc_id, length, term_freqs)
+        log_path = os.path.join(path, "log.jsonl")
+        if os.path.exists(log_path):
+            with open(log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 写入中断留下的半行，忽略
+                        continue
+                    if entry["op"] == "add":
+                        index._index_doc(entry["id"], entry["len"], entry["tf"])
+                    else:
+                        index._unindex_doc(entry["id"])
+                    index._log_entries += 1
+        return index
+
+
+def load_collection_texts(storage, batch_size: int = 256) -> list:
+    """从Qdrant集合中读出全部 (向量ID, 文本)"""
+    items = []
+    offset = None
+    while True:
+        points, offset = storage.client.scroll(
+            collection_name=storage.collection_name,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=False,
+        )
+        items.extend((str(point.id), (point.payload or {}).get("text", "")) for point in points)
+        if offset is None:
+            break
+    return items
+
+
+def open_bm25_index(storage, path: str = BM25_DIR) -> BM25Index:
+    """加载BM25索引，不存在或文档数量与集合不一致时从知识库集合构建"""
+    index = BM25Index.load(path)
+    if index is not None:
+        points = collection_size(storage)
+        if len(index) == points:
+            return index
+        print(f"BM25索引有 {len(index)} 个文档，知识库集合有 {points} 个，需要重建")
+    print("正在从知识库集合构建BM25索引...")
+    index = BM25Index(path=path)
+    index.build(load_collection_texts(storage))
+    return index
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = 60) -> list:
+    """倒数排名融合：score = Σ 1 / (k + 排名)，rankings 为多个 [(ID, 分数)] 列表"""
+    fused = {}
+    for ranking in rankings:
+        for rank, (doc_id, _) in enumerate(ranking, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+class HybridRetriever(IndexedVectorRetriever):
+    """
+    BM25 + 向量混合检索，返回格式与 camel VectorRetriever.query 相同
+
+    index 为 None 时向量检索直接查询Qdrant，否则使用 kb_index / kb_ann 的索引。
+    相似度阈值只用于过滤仅由向量检索召回的结果，关键词命中的分块总是保留。
+    """
+
+    def __init__(self, embedding_model, storage, lexical_index: BM25Index, index=None,
+                 dense_top_k: int = 3, lexical_top_k: int = 10, rrf_k: int = 60):
+        super().__init__(embedding_model, storage, index)
+        self.lexical_index = lexical_index
+        self.dense_top_k = dense_top_k
+        self.lexical_top_k = lexical_top_k
+        self.rrf_k = rrf_k
+        self._local = threading.local()
+
+    @property
+    def last_timings(self) -> dict:
+        """当前线程最近一次查询各步骤的耗时（秒）"""
+        return getattr(self._local, "timings", None)
+
+    def dense_search(self, query_vector, top_k: int) -> list:
+        if self.index is not None:
+            return self.index.search(query_vector, top_k=top_k)
+        results = self.storage.query(VectorDBQuery(query_vector=query_vector, top_k=top_k))
+        return [(str(result.record.id), result.similarity) for result in results]
+
+    def query(self, query: str, top_k: int = 1, similarity_threshold: float = 0.7) -> list:
+        if top_k <= 0:
+            raise ValueError("top_k must be a positive integer.")
+        timings = {}
+
+        start = time.perf_counter()
+        lexical_hits = self.lexical_index.search(query, top_k=self.lexical_top_k)
+        timings["bm25"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        query_vector = self.embedding_model.embed(obj=query)
+        timings["embed"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        dense_hits = self.dense_search(query_vector, max(top_k, self.dense_top_k))
+        timings["vector"] = time.perf_counter() - start
+
+        dense_scores = dict(dense_hits)
+        lexical_ids = {doc_id for doc_id, _ in lexical_hits}
+        fused = [
+            (doc_id, score) for doc_id, score in reciprocal_rank_fusion([dense_hits, lexical_hits], k=self.rrf_k)
+            if doc_id in lexical_ids or dense_scores.get(doc_id, 0.0) >= similarity_threshold
+        ][:top_k]
+
+        start = time.perf_counter()
+        payloads = self.fetch_payloads([doc_id for doc_id, _ in fused])
+        timings["payload"] = time.perf_counter() - start
+        self._local.timings = timings
+
+        results = []
+        for doc_id, score in fused:
+            payload = payloads.get(doc_id)
+            if payload is None:
+                continue
+            results.append({
+                'similarity score': str(dense_scores.get(doc_id, 0.0)),
+                'rrf score': score,
+                'content path': payload.get('content path', ''),
+                'metadata': payload.get('metadata', {}),
+                'extra_info': payload.get('extra_info', {}),
+                'text': payload.get('text', ''),
+            })
+        if not results:
+            return [{'text': f"No suitable information retrieved with similarity_threshold = {similarity_threshold}."}]
+        return results
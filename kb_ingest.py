@@ -0,0 +1,314 @@
+"""
+知识库增量入库：按文件内容哈希和分块哈希去重
+
+入库清单（manifest）记录每个文档的文件哈希、分块哈希和对应的向量ID：
+- 文件内容没变：直接跳过；
+- 同名文件内容或分块方式变了：只给新增的分块编码，删除已经不存在的分块的旧向量；
+- 内容相同但文件名不同：视为重复文件，跳过。
+清单还记录生成知识库向量的嵌入模型，换用向量不同的模型（如 onnx-int8 后端）后拒绝入库，避免两种向量混在同一个集合中。
+写入向量库的 payload 与 camel VectorRetriever.process 的格式一致，检索代码不需要改动。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from camel.storages import VectorRecord
+
+from settings import KB_PATH, KB_COLLECTION_NAME, KB_VECTOR_DIM
+
+MANIFEST_PATH = os.path.join(KB_PATH, "ingest_manifest.json")
+
+# 向量ID命名空间，保证同一文档的同一分块总是得到相同的ID
+POINT_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "camel-travelplanagent/kb")
+
+
+def file_sha256(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def chunk_sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def point_id(doc_key: str, chunk_hash: str) -> str:
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, f"{doc_key}|{chunk_hash}"))
+
+
+def unstructured_chunks(path: str, max_characters: int = 500) -> list:
+    """使用 Unstructured IO 解析并按标题分块（与 VectorRetriever 默认行为一致）"""
+    from camel.loaders import UnstructuredIO
+
+    uio = UnstructuredIO()
+    elements = uio.parse_file_or_url(path) or []
+    chunks = uio.chunk_elements(elements=elements, chunk_type="chunk_by_title",
+                                max_characters=max_characters)
+    results = []
+    for chunk in chunks:
+        metadata = chunk.metadata.to_dict()
+        metadata.pop("orig_elements", None)
+        results.append({"text": str(chunk), "metadata": metadata})
+    return results
+
+
+class IngestionManifest:
+    """入库清单，保存在知识库目录下的JSON文件中"""
+
+    def __init__(self, path: str = MANIFEST_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.documents = {}
+        # 生成知识库向量的嵌入模型标识（embedding_backend.create_encoder 返回的模型标识）
+        self.embedding_model = None
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self.documents = data.get("documents", {})
+                self.embedding_model = data.get("embedding_model")
+            except Exception as e:
+                print(f"读取入库清单失败: {str(e)}")
+
+    def get(self, doc_key: str):
+        with self._lock:
+            return self.documents.get(doc_key)
+
+    def find_by_hash(self, file_hash: str, exclude: str = None):
+        """返回内容相同的已入库文档名（不包括 exclude），没有则返回None"""
+        with self._lock:
+            for doc_key, entry in self.documents.items():
+                if entry["file_hash"] == file_hash and doc_key != exclude:
+                    return doc_key
+        return None
+
+    def version(self) -> str:
+        """知识库内容版本：全部文档文件哈希的摘要，文档增删改后随之变化"""
+        with self._lock:
+            pairs = sorted((doc_key, entry["file_hash"]) for doc_key, entry in self.documents.items())
+        return hashlib.sha256(json.dumps(pairs).encode("utf-8")).hexdigest()[:16]
+
+    def update(self, doc_key: str, entry: dict, embedding_model: str = None):
+        with self._lock:
+            self.documents[doc_key] = entry
+            self.embedding_model = self.embedding_model or embedding_model
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"embedding_model": self.embedding_model, "documents": self.documents}, f,
+                          ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+class KnowledgeBaseIngestor:
+    """把文档增量写入向量库"""
+
+    def __init__(self, embedding_model, storage, manifest: IngestionManifest = None,
+                 chunker=unstructured_chunks, embed_batch: int = 128, index=None, lexical_index=None,
+                 partitions=None):
+        self.embedding_model = embedding_model
+        self.model_id = getattr(embedding_model, "model_id", None)
+        self.storage = storage
+        # 可选的 kb_index.QuantizedIndex 和 kb_hybrid.BM25Index，与向量库同步增删
+        self.index = index
+        self.lexical_index = lexical_index
+        # 可选的 kb_partition.CityPartitions，按文档所属城市同步增删
+        self.partitions = partitions
+        self.manifest = manifest or IngestionManifest()
+        self.chunker = chunker
+        # 分块方式记录在清单中，换了分块方式后内容没变的文件也会重新分块
+        self.chunker_id = getattr(chunker, "chunker_id", getattr(chunker, "__name__", "custom"))
+        self.embed_batch = embed_batch
+        # 同一时间只处理一个文档，避免清单和向量库状态交错
+        self._lock = threading.Lock()
+
+    def ingest_file(self, path: str, doc_key: str = None, progress=None) -> dict:
+        """
+        增量入库一个文件
+
+        Args:
+            path: 文件路径（通常位于 local_data/ 下）
+            doc_key: 文档标识，默认为文件名
+            progress: 可选回调 progress(done, total)，分块完成后以 done=0 调用一次，之后每写入一批分块调用一次
+
+        Returns:
+            dict: 入库统计，status 为 skipped / duplicate / added / updated
+        """
+        doc_key = doc_key or os.path.basename(path)
+        file_hash = file_sha256(path)
+
+        with self._lock:
+            existing = self.manifest.get(doc_key)
+            if (existing and existing["file_hash"] == file_hash
+                    and existing.get("chunker", "unstructured_chunks") == self.chunker_id):
+                return {"status": "skipped", "doc": doc_key, "chunks_total": len(existing["chunks"]),
+                        "chunks_new": 0, "chunks_removed": 0}
+            duplicate_of = self.manifest.find_by_hash(file_hash, exclude=doc_key)
+            if duplicate_of:
+                return {"status": "duplicate", "doc": doc_key, "duplicate_of": duplicate_of,
+                        "chunks_total": 0, "chunks_new": 0, "chunks_removed": 0}
+
+            self._check_embedding_model()
+            start = time.perf_counter()
+            chunks = {}
+            for piece_num, chunk in enumerate(self.chunker(path), start=1):
+                chunk_hash = chunk_sha256(chunk["text"])
+                if chunk_hash not in chunks:
+                    chunk["metadata"]["piece_num"] = piece_num
+                    chunks[chunk_hash] = chunk
+
+            old_chunks = existing["chunks"] if existing else {}
+            new_hashes = [h for h in chunks if h not in old_chunks]
+            removed_ids = [pid for h, pid in old_chunks.items() if h not in chunks]
+
+            city = None
+            if self.partitions is not None:
+                from kb_partition import detect_document_city
+
+                city = detect_document_city(doc_key, [chunk["text"] for chunk in chunks.values()])
+                if existing and existing.get("city") != city:
+                    # 所属城市变了，未变的分块也要移到新城市的分区中（向量从向量库中取回，不重新编码）
+                    self.partitions.remove(list(old_chunks.values()))
+                    self._move_to_partition(doc_key, city, [pid for h, pid in old_chunks.items() if h in chunks])
+
+            if progress:
+                progress(0, len(new_hashes))
+
+            legacy_ids = []
+            if not existing:
+                # 清单建立之前通过 VectorRetriever.process 写入的旧向量没有记录ID，按来源路径查出后删除
+                legacy_ids = self._delete_legacy_points(path)
+
+            for i in range(0, len(new_hashes), self.embed_batch):
+                batch = new_hashes[i:i + self.embed_batch]
+                vectors = self.embedding_model.embed_list([chunks[h]["text"] for h in batch])
+                records = [
+                    VectorRecord(
+                        id=point_id(doc_key, h),
+                        vector=vector,
+                        payload={
+                            "content path": path[:100],
+                            "metadata": chunks[h]["metadata"],
+                            "extra_info": {"doc": doc_key, "city": city},
+                            "text": chunks[h]["text"],
+                        },
+                    )
+                    for h, vector in zip(batch, vectors)
+                ]
+                self.storage.add(records=records)
+                if self.index is not None:
+                    self.index.add([record.id for record in records], vectors)
+                if self.lexical_index is not None:
+                    self.lexical_index.add([(record.id, record.payload["text"]) for record in records])
+                if self.partitions is not None:
+                    self.partitions.add(city, [record.id for record in records], vectors,
+                                        [record.payload["text"] for record in records])
+                if progress:
+                    progress(min(i + len(batch), len(new_hashes)), len(new_hashes))
+
+            if removed_ids:
+                self.storage.delete(ids=removed_ids)
+                if self.index is not None:
+                    self.index.remove(removed_ids)
+                if self.lexical_index is not None:
+                    self.lexical_index.remove(removed_ids)
+                if self.partitions is not None:
+                    self.partitions.remove(removed_ids)
+            if self.index is not None and (new_hashes or removed_ids or legacy_ids):
+                self.index.save()
+            if self.partitions is not None:
+                self.partitions.save()
+
+            self.manifest.update(doc_key, {
+                "file_hash": file_hash,
+                "path": path,
+                "chunks": {h: point_id(doc_key, h) for h in chunks},
+                "chunker": self.chunker_id,
+                "city": city,
+                "ingested_at": time.time(),
+            }, embedding_model=self.model_id)
+
+        stats = {
+            "status": "updated" if existing else "added",
+            "doc": doc_key,
+            "chunks_total": len(chunks),
+            "chunks_new": len(new_hashes),
+            "chunks_removed": len(removed_ids),
+            "city": city,
+            "seconds": time.perf_counter() - start,
+        }
+        print(f"知识库入库完成: {stats}")
+        return stats
+
+    def _check_embedding_model(self):
+        """当前嵌入模型与生成知识库向量的模型不一致时拒绝入库"""
+        recorded = self.manifest.embedding_model
+        if recorded is None and (self.manifest.documents or self.storage.status().vector_count):
+            # 清单开始记录嵌入模型之前入库的文档（包括清单建立之前的旧向量），按默认的 torch 后端生成
+            from embedding_backend import EMBEDDING_MODEL_NAME
+
+            recorded = EMBEDDING_MODEL_NAME
+        if self.model_id and recorded and recorded != self.model_id:
+            raise RuntimeError(
+                f"知识库向量由 {recorded} 生成，当前嵌入模型为 {self.model_id}，两种向量不能混用。"
+                f"请把 EMBEDDING_BACKEND 改回生成知识库时的后端后再上传，或删除 {KB_PATH} 后重新入库全部文档"
+            )
+
+    def _move_to_partition(self, doc_key: str, city: str, ids: list):
+        """把未变的分块改为新的所属城市：更新 payload，并加入该城市的分区"""
+        if not ids:
+            return
+        self.storage.client.set_payload(collection_name=self.storage.collection_name,
+                                        payload={"extra_info": {"doc": doc_key, "city": city}}, points=ids)
+        if not city:
+            return
+        points = self.storage.client.retrieve(collection_name=self.storage.collection_name, ids=ids,
+                                              with_vectors=True)
+        self.partitions.add(city, [str(point.id) for point in points], [point.vector for point in points],
+                            [(point.payload or {}).get("text", "") for point in points])
+
+    def _delete_legacy_points(self, path: str) -> list:
+        """
+        删除来源路径为 path 的旧向量，返回删除的ID
+
+        这些向量在首次启动时已经进入了向量索引、BM25索引和城市分区，只按条件删除集合中的点会让
+        索引里留下失效的ID，占用检索名额后又在读取 payload 时被丢弃，所以先查出ID再逐一同步删除。
+        """
+        from qdrant_client.http.models import FieldCondition, Filter, MatchValue
+
+        # 键名中有空格，必须加引号，否则Qdrant报 Invalid path
+        condition = Filter(must=[FieldCondition(key='"content path"', match=MatchValue(value=path[:100]))])
+        ids = []
+        try:
+            offset = None
+            while True:
+                points, offset = self.storage.client.scroll(
+                    collection_name=self.storage.collection_name,
+                    scroll_filter=condition,
+                    limit=256,
+                    offset=offset,
+                    with_payload=False,
+                    with_vectors=False,
+                )
+                ids.extend(str(point.id) for point in points)
+                if offset is None:
+                    break
+            if ids:
+                self.storage.delete(ids=ids)
+        except Exception as e:
+            print(f"清理旧向量失败（可忽略）: {str(e)}")
+            return []
+        if self.index is not None:
+            self.index.remove(ids)
+        if self.lexical_index is not None:
+            self.lexical_index.remove(ids)
+        if self.partitions is not None:
+            self.partitions.remove(ids)
+        if ids:
+            print(f"已删除 {len(ids)} 个旧向量: {path}")
+        return ids
@@ -0,0 +1,292 @@
+"""
+按城市划分的知识库分区和查询路由
+
+所有上传的攻略都在同一个集合“旅游知识库”中，问北京的问题也要和其他城市的全部分块比较。这里：
+- 入库时根据文件名（如“北京旅游.pdf”）或正文中出现最多的城市确定文档所属城市，
+  写入入库清单和 payload（extra_info.city）；
+- 每个城市在 storage_travel_kb/partitions/<城市>/ 下维护自己的向量索引和 BM25 索引，
+  查询时只扫描该城市的分块；
+- 问题中只出现一个已知城市、且该城市有分区时路由到分区，分区没有结果时退回全局检索；
+  没有识别到城市或提到多个城市时直接全局检索。
+全局集合和原有的索引保持不变，分区只是额外的一份按城市划分的索引。
+"""
+import json
+import os
+import re
+import shutil
+import threading
+from collections import Counter
+
+from kb_hybrid import BM25Index, HybridRetriever
+from kb_index import QuantizedIndex, collection_size
+from settings import KB_PATH
+
+PARTITION_DIR = os.path.join(KB_PATH, "partitions")
+
+# 常见旅游目的地，按名称长度从长到短匹配（“乌鲁木齐”优先于“乌鲁”之类的片段）
+KNOWN_CITIES = (
+    "北京", "上海", "天津", "重庆", "广州", "深圳", "杭州", "南京", "苏州", "无锡", "扬州", "宁波", "绍兴",
+    "成都", "西安", "武汉", "长沙", "郑州", "洛阳", "开封", "济南", "青岛", "烟台", "威海", "泰安",
+    "大连", "沈阳", "哈尔滨", "长春", "吉林", "呼和浩特", "包头", "太原", "大同", "平遥", "石家庄", "承德",
+    "秦皇岛", "合肥", "黄山", "南昌", "景德镇", "福州", "厦门", "泉州", "南宁", "桂林", "北海",
+    "海口", "三亚", "昆明", "大理", "丽江", "西双版纳", "香格里拉", "贵阳", "遵义", "拉萨", "林芝",
+    "西宁", "兰州", "敦煌", "嘉峪关", "张掖", "银川", "乌鲁木齐", "喀什", "伊犁", "吐鲁番", "张家界",
+    "凤凰", "九寨沟", "乐山", "峨眉山", "珠海", "澳门", "香港", "台北", "高雄",
+    "东京", "大阪", "京都", "首尔", "曼谷", "清迈", "新加坡", "吉隆坡", "巴厘岛", "巴黎", "伦敦",
+    "罗马", "巴塞罗那", "纽约", "洛杉矶", "悉尼", "墨尔本", "迪拜",
+)
+
+# 包含城市名、但指的不是该城市的地名和词语（“北海公园”在北京，“包裹开封后”是拆开包装之后）。
+# 与城市名一起按长度从长到短匹配，先匹配到这些词时整个词跳过
+NON_CITY_TERMS = (
+    "北海公园", "北海道", "未开封", "已开封", "拆开封", "包装开封", "包裹开封", "开封后请", "开封后尽快",
+    "开封后冷藏", "开封后保存", "开封后食用", "大理石", "罗马尼亚", "凤凰卫视", "凤凰传奇",
+)
+
+_CITY_PATTERN = re.compile("|".join(sorted(KNOWN_CITIES + NON_CITY_TERMS, key=len, reverse=True)))
+_NON_CITY_TERMS = set(NON_CITY_TERMS)
+
+
+def find_cities(text: str) -> list:
+    """文本中出现的已知城市（按出现顺序，可重复），不包括 NON_CITY_TERMS 中的词"""
+    return [city for city in _CITY_PATTERN.findall(text or "") if city not in _NON_CITY_TERMS]
+
+
+def detect_query_city(query: str):
+    """问题中只提到一个城市时返回该城市，否则返回None"""
+    cities = set(find_cities(query))
+    return cities.pop() if len(cities) == 1 else None
+
+
+def detect_document_city(filename: str, texts: list, min_share: float = 0.6, min_mentions: int = 3):
+    """
+    确定文档所属城市
+
+    文件名中只有一个城市时直接使用；否则统计正文中各城市的出现次数，出现最多的城市
+    至少占全部城市提及的 min_share 且不少于 min_mentions 次才算，综合性攻略返回None。
+    """
+    cities = set(find_cities(os.path.basename(filename or "")))
+    if len(cities) == 1:
+        return cities.pop()
+    counts = Counter(city for text in texts for city in find_cities(text))
+    if not counts:
+        return None
+    city, count = counts.most_common(1)[0]
+    if count >= min_mentions and count / sum(counts.values()) >= min_share:
+        return city
+    return None
+
+
+def load_collection_points(storage, batch_size: int = 256):
+    """从Qdrant集合中读出全部 (向量ID, 向量, payload)"""
+    offset = None
+    while True:
+        points, offset = storage.client.scroll(
+            collection_name=storage.collection_name,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True,
+        )
+        for point in points:
+            yield str(point.id), point.vector, point.payload or {}
+        if offset is None:
+            break
+
+
+class CityPartitions:
+    """
+    每个城市一份向量索引和 BM25 索引
+
+    与 kb_index.QuantizedIndex / kb_hybrid.BM25Index 一样可以由 KnowledgeBaseIngestor 同步增删：
+    add(city, ids, vectors, texts)、remove(ids)、save()。
+    """
+
+    def __init__(self, embedding_model, storage, path: str = PARTITION_DIR, mode: str = "none",
+                 oversampling: float = 4.0, dense_top_k: int = 3, lexical_top_k: int = 10):
+        self.embedding_model = embedding_model
+        self.storage = storage
+        self.path = path
+        self.mode = mode
+        self.oversampling = oversampling
+        self.dense_top_k = dense_top_k
+        self.lexical_top_k = lexical_top_k
+        self.retrievers = {}
+        self._city_of = {}
+        self._lock = threading.RLock()
+
+    def _city_dir(self, city: str) -> str:
+        return os.path.join(self.path, city)
+
+    def _new_retriever(self, city: str, index: QuantizedIndex = None, lexical_index: BM25Index = None):
+        index = index or QuantizedIndex(dim=self.storage.vector_dim, mode=self.mode, oversampling=self.oversampling,
+                                        path=os.path.join(self._city_dir(city), "vector_index"))
+        lexical_index = lexical_index or BM25Index(path=os.path.join(self._city_dir(city), "bm25"))
+        return HybridRetriever(self.embedding_model, self.storage, lexical_index, index=index,
+                               dense_top_k=self.dense_top_k, lexical_top_k=self.lexical_top_k)
+
+    def retriever(self, city: str):
+        """城市分区的检索器，分区不存在或为空时返回None"""
+        with self._lock:
+            retriever = self.retrievers.get(city)
+            return retriever if retriever is not None and len(retriever.index) else None
+
+    def add(self, city: str, ids: list, vectors: list, texts: list):
+        if not city or not ids:
+            return
+        ids = [str(point_id) for point_id in ids]
+        with self._lock:
+            retriever = self.retrievers.get(city)
+            if retriever is None:
+                retriever = self.retrievers[city] = self._new_retriever(city)
+            # 新分区用第一批数据建索引（确定量化范围、写入BM25快照），之后增量加入
+            if len(retriever.index) == 0:
+                retriever.index.build(ids, vectors)
+            else:
+                retriever.index.add(ids, vectors)
+            if len(retriever.lexical_index) == 0:
+                retriever.lexical_index.build(list(zip(ids, texts)))
+            else:
+                retriever.lexical_index.add(list(zip(ids, texts)))
+            for point_id in ids:
+                self._city_of[point_id] = city
+
+    def remove(self, ids: list):
+        with self._lock:
+            by_city = {}
+            for point_id in ids:
+                city = self._city_of.pop(str(point_id), None)
+                if city:
+                    by_city.setdefault(city, []).append(str(point_id))
+            for city, city_ids in by_city.items():
+                retriever = self.retrievers[city]
+                retriever.index.remove(city_ids)
+                retriever.lexical_index.remove(city_ids)
+
+    def save(self):
+        """保存各城市的向量索引，并记录此时全局集合的向量数量，用于下次启动时判断分区是否过时"""
+        with self._lock:
+            for retriever in self.retrievers.values():
+                retriever.index.save()
+            os.makedirs(self.path, exist_ok=True)
+            tmp_path = os.path.join(self.path, "meta.json.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"collection_points": collection_size(self.storage)}, f)
+            os.replace(tmp_path, os.path.join(self.path, "meta.json"))
+
+    def _saved_collection_points(self):
+        try:
+            with open(os.path.join(self.path, "meta.json"), "r", encoding="utf-8") as f:
+                return json.load(f).get("collection_points")
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def build(self):
+        """从全局集合重建全部分区：payload 中没有城市时按文档名和该文档的全部分块判断"""
+        documents = {}
+        for point_id, vector, payload in load_collection_points(self.storage):
+            extra_info = payload.get("extra_info") or {}
+            doc = extra_info.get("doc") or payload.get("content path", "")
+            entry = documents.setdefault(doc, {"city": extra_info.get("city"), "points": []})
+            entry["points"].append((point_id, vector, payload.get("text", "")))
+        points_by_city = {}
+        for doc, entry in documents.items():
+            city = entry["city"] or detect_document_city(doc, [text for _, _, text in entry["points"]])
+            if city:
+                points_by_city.setdefault(city, []).extend(entry["points"])
+        with self._lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path, exist_ok=True)
+            self.retrievers, self._city_of = {}, {}
+            for city, points in points_by_city.items():
+                ids, vectors, texts = (list(column) for column in zip(*points))
+                self.add(city, ids, vectors, texts)
+            self.save()
+
+    @classmethod
+    def open(cls, embedding_model, storage, path: str = PARTITION_DIR, **kwargs):
+        """
+        加载已有分区；不存在、分词方式或量化方式不一致，或者保存之后全局集合有变化
+        （例如关闭分区期间入库了文档）时从全局集合重建
+        """
+        partitions = cls(embedding_model, storage, path=path, **kwargs)
+        saved_points, points = partitions._saved_collection_points(), collection_size(storage)
+        if saved_points is not None and saved_points != points:
+            print(f"城市分区保存时知识库集合有 {saved_points} 个向量，现在有 {points} 个，需要重建")
+        elif saved_points is not None and os.path.isdir(path):
+            cities = sorted(name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name)))
+            for city in cities:
+                index = QuantizedIndex.load(os.path.join(partitions._city_dir(city), "vector_index"),
+                                            oversampling=partitions.oversampling)
+                lexical_index = BM25Index.load(os.path.join(partitions._city_dir(city), "bm25"))
+                if index is None or lexical_index is None or index.mode != partitions.mode:
+                    break
+                partitions.retrievers[city] = partitions._new_retriever(city, index, lexical_index)
+                partitions._city_of.update((point_id, city) for point_id in index.ids)
+            else:
+                return partitions
+        print("正在从知识库集合构建城市分区...")
+        partitions.build()
+        return partitions
+
+    def stats(self) -> dict:
+        """{城市: 分块数}"""
+        with self._lock:
+            return {city: len(retriever.index) for city, retriever in self.retrievers.items()}
+
+
+class PartitionedRetriever:
+    """
+    按问题中的城市路由到分区检索器，返回格式与 camel VectorRetriever.query 相同
+
+    global_retriever 为原来的全局检索器；embedding_model / index / lexical_index 等属性都取自全局检索器，
+    入库时继续同步全局索引。每个线程最近一次查询的路由情况记录在 last_route 中。
+    """
+
+    def __init__(self, global_retriever, partitions: CityPartitions):
+        self.global_retriever = global_retriever
+        self.partitions = partitions
+        self._local = threading.local()
+
+    @property
+    def embedding_model(self):
+        return self.global_retriever.embedding_model
+
+    @property
+    def storage(self):
+        return self.global_retriever.storage
+
+    @property
+    def index(self):
+        return getattr(self.global_retriever, "index", None)
+
+    @property
+    def lexical_index(self):
+        return getattr(self.global_retriever, "lexical_index", None)
+
+    @property
+    def last_route(self) -> dict:
+        return getattr(self._local, "route", None)
+
+    @property
+    def last_timings(self) -> dict:
+        return getattr(self._local, "timings", None)
+
+    def query(self, query: str, top_k: int = 1, similarity_threshold: float = 0.7) -> list:
+        city = detect_query_city(query)
+        retriever = self.partitions.retriever(city) if city else None
+        route = {"city": city, "partition": False, "chunks": 0, "fallback": None}
+        if retriever is not None:
+            results = retriever.query(query, top_k=top_k, similarity_threshold=similarity_threshold)
+            if any('content path' in result for result in results):
+                route.update(partition=True, chunks=len(retriever.index))
+                self._local.route = route
+                self._local.timings = retriever.last_timings
+                return results
+            route["fallback"] = "分区没有符合条件的结果"
+        elif city:
+            route["fallback"] = "该城市还没有分区"
+        self._local.route = route
+        results = self.global_retriever.query(query, top_k=top_k, similarity_threshold=similarity_threshold)
+        self._local.timings = getattr(self.global_retriever, "last_timings", None)
+        return results
@@ -0,0 +1,144 @@
+"""
+知识库后台入库队列
+
+上传的PDF放入队列后立即返回，由一个后台线程依次解析、批量编码并写入向量库，
+用户可以在入库过程中继续聊天。每个文件的进度、编码速度和队列长度可以随时查询。
+"""
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# 入库任务状态
+STATUS_QUEUED = "queued"
+STATUS_PARSING = "parsing"
+STATUS_EMBEDDING = "embedding"
+STATUS_DONE = "done"
+STATUS_ERROR = "error"
+
+FINISHED_STATUSES = (STATUS_DONE, STATUS_ERROR)
+
+
+class IngestionTask:
+    """一个文件的入库任务"""
+
+    def __init__(self, path: str, doc_key: str):
+        self.task_id = uuid.uuid4().hex
+        self.path = path
+        self.doc_key = doc_key
+        self.status = STATUS_QUEUED
+        self.chunks_done = 0
+        self.chunks_total = 0
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.embed_started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    @property
+    def chunks_per_second(self) -> float:
+        if not self.embed_started_at or not self.chunks_done:
+            return 0.0
+        elapsed = (self.finished_at or time.time()) - self.embed_started_at
+        return self.chunks_done / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "task_id": self.task_id,
+            "doc": self.doc_key,
+            "status": self.status,
+            "chunks_done": self.chunks_done,
+            "chunks_total": self.chunks_total,
+            "chunks_per_second": self.chunks_per_second,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class IngestionWorker:
+    """
+    单线程的入库队列
+
+    嵌入模型本身会占满CPU/GPU，多个文件并行编码并不会更快，所以只用一个工作线程；
+    批量大小由 KnowledgeBaseIngestor.embed_batch 控制。
+    """
+
+    def __init__(self, ingestor, max_history: int = 50):
+        self.ingestor = ingestor
+        self.max_history = max_history
+        self._queue = queue.Queue()
+        self._tasks = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="kb-ingest", daemon=True)
+            self._thread.start()
+
+    def submit(self, path: str, doc_key: str = None) -> str:
+        """把文件加入入库队列，返回任务ID"""
+        task = IngestionTask(path, doc_key or os.path.basename(path))
+        with self._lock:
+            self._tasks[task.task_id] = task
+            self._trim_history()
+        self._queue.put(task)
+        self._ensure_thread()
+        return task.task_id
+
+    def _trim_history(self):
+        # 只清理已完成的旧任务，排队和运行中的任务始终保留
+        finished = [task_id for task_id, task in self._tasks.items() if task.finished]
+        for task_id in finished[:max(0, len(self._tasks) - self.max_history)]:
+            del self._tasks[task_id]
+
+    def get(self, task_id: str):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            return task.to_dict() if task else None
+
+    def tasks(self) -> list:
+        """最近的任务，新提交的在前"""
+        with self._lock:
+            return [task.to_dict() for task in reversed(self._tasks.values())]
+
+    def queue_depth(self) -> int:
+        """排队中和正在处理的文件数"""
+        with self._lock:
+            return sum(1 for task in self._tasks.values() if not task.finished)
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            task.started_at = time.time()
+            task.status = STATUS_PARSING
+
+            def progress(done, total, task=task):
+                if task.embed_started_at is None:
+                    task.embed_started_at = time.time()
+                    task.status = STATUS_EMBEDDING
+                task.chunks_done = done
+                task.chunks_total = total
+
+            try:
+                task.result = self.ingestor.ingest_file(task.path, doc_key=task.doc_key, progress=progress)
+                task.status = STATUS_DONE
+            except Exception as e:
+                print(f"知识库入库失败 {task.path}: {str(e)}")
+                task.error = str(e)
+                task.status = STATUS_ERROR
+            finally:
+                task.finished_at = time.time()
+                self._queue.task_done()
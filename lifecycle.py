@@ -0,0 +1,172 @@
+"""
+服务启动生命周期：按进程懒加载的资源、预热和就绪检查
+
+启动分为两个阶段：
+1. 导入阶段：只导入轻量模块、注册路由，不创建模型和智能体；
+2. 预热阶段：在工作进程内（fork之后）创建模型、工具和智能体。
+
+直接运行本文件可以测量各服务的导入耗时和预热耗时：
+    python lifecycle.py user search generate web_central
+"""
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from flask import g, jsonify, request
+
+import metrics
+
+
+class LazyResource:
+    """按进程懒加载的资源，fork出的子进程会在第一次使用时重新初始化"""
+
+    def __init__(self, name: str, factory):
+        self.name = name
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self._pid = None
+        self.init_seconds = None
+        self.error = None
+
+    @property
+    def ready(self) -> bool:
+        return self._pid == os.getpid()
+
+    def get(self):
+        if self._pid == os.getpid():
+            return self._value
+        with self._lock:
+            if self._pid != os.getpid():
+                start = time.perf_counter()
+                try:
+                    self._value = self.factory()
+                except Exception as e:
+                    self.error = str(e)
+                    print(f"{self.name} 初始化失败: {self.error}")
+                    raise
+                self.init_seconds = time.perf_counter() - start
+                self.error = None
+                self._pid = os.getpid()
+                print(f"{self.name} 初始化完成，耗时 {self.init_seconds:.2f} 秒")
+        return self._value
+
+    def status(self) -> dict:
+        return {"ready": self.ready, "init_seconds": self.init_seconds, "error": self.error}
+
+
+class ServiceLifecycle:
+    """管理一个服务的预热、就绪状态和首个请求延迟"""
+
+    def __init__(self, name: str, resources: list = None):
+        self.name = name
+        self.resources = resources or []
+        self.created_at = time.time()
+        self.warmup_seconds = None
+        self.first_request_seconds = None
+        self._warmup_pid = None
+        self._first_request_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return all(resource.ready for resource in self.resources)
+
+    def _warm_up(self):
+        start = time.perf_counter()
+        for resource in self.resources:
+            try:
+                resource.get()
+            except Exception:
+                # 失败的资源在下一次使用或就绪检查时重试
+                pass
+        self.warmup_seconds = time.perf_counter() - start
+        print(f"{self.name} 预热结束，耗时 {self.warmup_seconds:.2f} 秒，就绪: {self.ready}")
+
+    def warm_up(self, background: bool = True):
+        """在当前进程中预热所有资源，每个进程只启动一次"""
+        with self._lock:
+            if self._warmup_pid == os.getpid():
+                return
+            self._warmup_pid = os.getpid()
+        if background:
+            threading.Thread(target=self._warm_up, name=f"{self.name}-warmup", daemon=True).start()
+        else:
+            self._warm_up()
+
+    def status(self) -> dict:
+        return {
+            "service": self.name,
+            "pid": os.getpid(),
+            "ready": self.ready,
+            "warmup_seconds": self.warmup_seconds,
+            "first_request_seconds": self.first_request_seconds,
+            "resources": {resource.name: resource.status() for resource in self.resources},
+        }
+
+    def install(self, app):
+        """注册 /healthz、/readyz、/metrics 接口和首个请求延迟统计"""
+        metrics.install(app, self.name)
+
+        @app.route("/healthz")
+        def healthz():
+            return jsonify({"service": self.name, "status": "ok"})
+
+        @app.route("/readyz")
+        def readyz():
+            if not self.ready:
+                # 例如 fork 后预热线程没有带到子进程，或者上次初始化失败
+                if self._warmup_pid != os.getpid() or any(r.error for r in self.resources):
+                    with self._lock:
+                        self._warmup_pid = None
+                    self.warm_up(background=True)
+                return jsonify(self.status()), 503
+            return jsonify(self.status())
+
+        @app.before_request
+        def _record_start():
+            g._lifecycle_start = time.perf_counter()
+
+        @app.after_request
+        def _record_first_request(response):
+            if self._first_request_pid != os.getpid() and request.endpoint not in ("healthz", "readyz"):
+                self._first_request_pid = os.getpid()
+                self.first_request_seconds = time.perf_counter() - g._lifecycle_start
+                print(f"{self.name} 首个请求耗时 {self.first_request_seconds:.2f} 秒")
+            return response
+
+        return app
+
+
+def measure_startup(module_name: str) -> dict:
+    """在子进程中测量模块的导入耗时和预热耗时"""
+    code = (
+        "import json, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module_name} as m\n"
+        "import_seconds = time.perf_counter() - start\n"
+        "start = time.perf_counter()\n"
+        "m.lifecycle.warm_up(background=False)\n"
+        "warmup_seconds = time.perf_counter() - start\n"
+        "print(json.dumps({'import_seconds': import_seconds, 'warmup_seconds': warmup_seconds,"
+        " 'ready': m.lifecycle.ready}))\n"
+    )
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if output.returncode != 0:
+        return {"error": output.stderr.strip().splitlines()[-1] if output.stderr.strip() else "未知错误"}
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    modules = sys.argv[1:] or ["user", "search", "generate", "web_central"]
+    for module_name in modules:
+        result = measure_startup(module_name)
+        if "error" in result:
+            print(f"{module_name}: 测量失败 - {result['error']}")
+        else:
+            print(f"{module_name}: 导入 {result['import_seconds']:.2f} 秒，"
+                  f"预热 {result['warmup_seconds']:.2f} 秒，就绪: {result['ready']}")
@@ -0,0 +1,284 @@
+"""
+按内容寻址的大模型响应缓存
+
+相同的提示词经常被重复发送：同一批搜索结果的重排提示词、同一份 travel_info 的抽取提示词、
+同样的 create_usr_msg 输出。这里在 llm_gateway 包装的模型后端上缓存响应：
+- 缓存键为 模型名 + 完整消息列表（含系统提示词和历史）+ 模型参数 + 工具定义 的 SHA-256，
+  不包含服务地址，同一份录制可以在不同的接口地址上回放；
+- 每个键一个 JSON 文件（storage/llm_cache/<前两位>/<键>.json），多个服务进程可以共用同一个目录；
+- 条目超过 ttl 秒后失效；条目数或总大小超过上限时删除最久未使用的文件；
+- 命中缓存的调用不经过网关，不占用限流额度。
+
+模式（LLM_CACHE）：
+- on：先查缓存，未命中时调用大模型并写入；
+- record：总是调用大模型并写入（覆盖旧条目，不过期、不淘汰），用于录制；
+- replay：只从缓存读取，不过期，未命中时抛出 LLMCacheMiss，不访问网络，用于离线确定性回放；
+- off：不使用缓存。
+流式请求在输出完整接收后写入，命中时作为只有一个数据块的流返回；结构化输出（response_format）不缓存。
+带工具调用（tool_calls）的响应不缓存：camel 收到后会实际执行工具（例如 generate 智能体的 SearchToolkit 搜索），
+回放这类响应仍会访问网络，工具结果也不确定。因此 replay 模式下会调用工具的请求总是未命中、抛出 LLMCacheMiss，
+只有模型没有调用工具、直接给出回答的请求可以离线回放。
+with bypass(): 中的调用跳过读取、照常写入，用于强制刷新。
+只用于攻略流程的 Flask 服务；聊天助手的模型通过 create_model(cache=False) 创建，不经过缓存。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from metrics import REGISTRY, Counter
+from settings import STORAGE_DIR
+
+LLM_CACHE_PATH = os.path.join(STORAGE_DIR, "llm_cache")
+
+MODE_OFF = "off"
+MODE_ON = "on"
+MODE_RECORD = "record"
+MODE_REPLAY = "replay"
+
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "travel_llm_cache_total", "LLM response cache lookups by result", ("result",)))
+
+_local = threading.local()
+
+
+class LLMCacheMiss(RuntimeError):
+    """回放模式下没有录制的响应"""
+
+
+@contextmanager
+def bypass():
+    """其中的调用不读缓存（强制重新生成），结果照常写入；回放模式下不生效"""
+    previous = getattr(_local, "bypass", False)
+    _local.bypass = True
+    try:
+        yield
+    finally:
+        _local.bypass = previous
+
+
+def _schema(response_format):
+    if response_format is None:
+        return None
+    model_json_schema = getattr(response_format, "model_json_schema", None)
+    return model_json_schema() if model_json_schema else str(response_format)
+
+
+def make_key(model_type: str, messages: list, params: dict = None, tools: list = None,
+             response_format=None) -> str:
+    """缓存键：模型名、消息、参数、工具定义和输出格式的 SHA-256"""
+    payload = {
+        "model": str(model_type),
+        "messages": messages,
+        "params": {name: value for name, value in (params or {}).items() if name not in ("stream", "stream_options")},
+        "tools": tools or [],
+        "response_format": _schema(response_format),
+    }
+    text = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _replay_stream(completion):
+    """把缓存的完整响应作为只有一个数据块的流返回（camel-ai 0.2.90 的模型后端接受生成器形式的流）"""
+    from openai.types.chat import ChatCompletionChunk
+
+    choice = completion.choices[0]
+    yield ChatCompletionChunk.model_validate({
+        "id": completion.id,
+        "object": "chat.completion.chunk",
+        "created": completion.created,
+        "model": completion.model,
+        "choices": [{"index": 0, "finish_reason": choice.finish_reason or "stop",
+                     "delta": {"role": "assistant", "content": choice.message.content or ""}}],
+        "usage": completion.usage.model_dump(mode="json") if completion.usage is not None else None,
+    })
+
+
+class LLMResponseCache:
+    """线程安全的持久化响应缓存，每个条目一个文件"""
+
+    def __init__(self, path: str = LLM_CACHE_PATH, mode: str = MODE_ON, ttl: float = 24 * 3600,
+                 max_entries: int = 2000, max_bytes: int = 200 * 1024 * 1024):
+        if mode not in (MODE_ON, MODE_RECORD, MODE_REPLAY):
+            raise ValueError(f"不支持的缓存模式: {mode}")
+        self.path = path
+        self.mode = mode
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._index = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self._load_index()
+
+    @classmethod
+    def from_env(cls):
+        """按环境变量创建，LLM_CACHE=off 时返回None"""
+        mode = os.getenv("LLM_CACHE", MODE_ON)
+        if mode == MODE_OFF:
+            return None
+        return cls(
+            path=os.getenv("LLM_CACHE_DIR", LLM_CACHE_PATH),
+            mode=mode,
+            ttl=float(os.getenv("LLM_CACHE_TTL_HOURS", "24")) * 3600,
+            max_entries=int(os.getenv("LLM_CACHE_SIZE", "2000")),
+            max_bytes=int(float(os.getenv("LLM_CACHE_MAX_MB", "200")) * 1024 * 1024),
+        )
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], f"{key}.json")
+
+    def _load_index(self):
+        """按修改时间（最近使用时间）排列已有条目"""
+        if not os.path.isdir(self.path):
+            return
+        files = []
+        for directory, _, names in os.walk(self.path):
+            for name in names:
+                if name.endswith(".json"):
+                    stat = os.stat(os.path.join(directory, name))
+                    files.append((stat.st_mtime, name[:-5], stat.st_size))
+        for _, key, size in sorted(files):
+            self._index[key] = size
+            self._bytes += size
+        if files:
+            print(f"已加载 {len(files)} 条大模型响应缓存（{self._bytes / 1024 / 1024:.1f} MB）")
+
+    def _forget(self, key: str):
+        """调用方持有锁"""
+        self._bytes -= self._index.pop(key, 0)
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str):
+        """返回缓存的响应数据，未命中或已过期时返回None"""
+        path = self._file(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        with self._lock:
+            if self.mode != MODE_REPLAY and time.time() - entry["created"] > self.ttl:
+                self._forget(key)
+                return None
+            # 其他进程写入的文件也加入索引，参与淘汰
+            if key not in self._index:
+                self._index[key] = os.path.getsize(path)
+                self._bytes += self._index[key]
+            self._index.move_to_end(key)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry["response"]
+
+    def put(self, key: str, model_type: str, response: dict):
+        path = self._file(key)
+        data = json.dumps({"key": key, "model": str(model_type), "created": time.time(), "response": response},
+                          ensure_ascii=False)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"保存大模型响应缓存失败: {str(e)}")
+            return
+        size = len(data.encode("utf-8"))
+        with self._lock:
+            self._bytes += size - self._index.pop(key, 0)
+            self._index[key] = size
+            if self.mode == MODE_RECORD:
+                return
+            while self._index and (len(self._index) > self.max_entries or self._bytes > self.max_bytes):
+                self._forget(next(iter(self._index)))
+
+    def fetch(self, model_type: str, messages: list, params: dict, call, tools: list = None,
+              response_format=None) -> tuple:
+        """
+        查缓存，未命中时执行 call() 并写入
+
+        Returns:
+            (响应, 缓存结果)，缓存结果为 "hit" / "miss" / "bypass"（不可缓存的请求）
+        """
+        from openai.types.chat import ChatCompletion
+
+        if response_format is not None:
+            CACHE_LOOKUPS.inc(result="bypass")
+            return call(), "bypass"
+        stream = bool(params.get("stream"))
+        key = make_key(model_type, messages, params, tools, response_format)
+        skip_read = self.mode == MODE_RECORD or (self.mode == MODE_ON and getattr(_local, "bypass", False))
+        cached = None if skip_read else self.get(key)
+        if cached is not None:
+            with self._lock:
+                self.hits += 1
+            CACHE_LOOKUPS.inc(result="hit")
+            completion = ChatCompletion.model_validate(cached)
+            return (_replay_stream(completion) if stream else completion), "hit"
+        if self.mode == MODE_REPLAY:
+            CACHE_LOOKUPS.inc(result="miss")
+            with self._lock:
+                self.misses += 1
+            hint = "；带工具调用的响应不会录制" if tools else ""
+            raise LLMCacheMiss(f"回放模式下没有录制的响应（{model_type}，键 {key[:12]}{hint}）")
+        with self._lock:
+            if skip_read:
+                self.bypassed += 1
+            else:
+                self.misses += 1
+        CACHE_LOOKUPS.inc(result="refresh" if skip_read else "miss")
+        response = call()
+        if isinstance(response, ChatCompletion):
+            if not any(choice.message.tool_calls for choice in response.choices):
+                self.put(key, model_type, response.model_dump(mode="json"))
+        elif stream:
+            response = self._record_stream(key, model_type, response)
+        return response, "miss"
+
+    def _record_stream(self, key: str, model_type: str, chunks):
+        """原样转发流式数据块，完整接收（有结束原因、没有工具调用）后写入缓存"""
+        parts, finish_reason, usage, last, tool_calls = [], None, None, None, False
+        for chunk in chunks:
+            yield chunk
+            last = chunk
+            usage = getattr(chunk, "usage", None) or usage
+            if chunk.choices:
+                choice = chunk.choices[0]
+                parts.append(choice.delta.content or "")
+                tool_calls = tool_calls or bool(choice.delta.tool_calls)
+                finish_reason = choice.finish_reason or finish_reason
+        if last is None or finish_reason is None or tool_calls:
+            return
+        self.put(key, model_type, {
+            "id": last.id,
+            "object": "chat.completion",
+            "created": last.created,
+            "model": last.model,
+            "choices": [{"index": 0, "finish_reason": finish_reason,
+                         "message": {"role": "assistant", "content": "".join(parts)}}],
+            "usage": usage.model_dump(mode="json") if usage is not None else None,
+        })
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "mode": self.mode,
+                "entries": len(self._index),
+                "megabytes": self._bytes / 1024 / 1024,
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshed": self.bypassed,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
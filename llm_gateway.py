@@ -0,0 +1,398 @@
+"""
+统一的大模型调用网关
+
+原来每个模块各自用 ModelFactory.create 创建模型，限流靠各自的补救：generate.py 用 tenacity 重试，
+chat_ui.py 捕获 openai.RateLimitError 后 sleep。多个攻略流程同时运行时一起打满服务商的限额，
+一起收到 429，再一起重试。这里所有模型都通过 create_model 创建，调用都经过同一个网关：
+- 按 API Key 限制每分钟请求数（RPM）、每分钟 token 数（TPM）和同时进行的请求数；
+- 额度不够时排队，不同请求（按 metrics 的请求ID区分）轮流获得额度，一个流程的大量调用不会饿死其他流程；
+- 收到 429 时该 Key 整体暂停（优先使用 Retry-After），然后指数退避重试；5xx 和连接错误同样退避重试；
+- 排队时间、受限原因、429 次数等计入 /metrics，也可以通过 stats() 和 last_call() 查看。
+- 每次请求服务商（包括重试）计入当前请求的大模型调用次数（metrics.count_call），中枢据此扣除预取预算。
+
+token 数在请求前按 context_packer.estimate_tokens 估算（提示词 + 预计输出），非流式请求完成后按实际用量修正。
+流式请求在连接建立、开始返回后就释放并发名额。额度在进程内统计，多进程部署时请按进程数分配额度。
+网关创建时按 LLM_CACHE 等环境变量附带 llm_cache 响应缓存，命中缓存的调用不占用额度；
+create_model(cache=False) 创建的模型（聊天助手的模型）不使用缓存。
+"""
+import inspect
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+from context_packer import estimate_tokens
+from llm_cache import LLMResponseCache
+from metrics import REGISTRY, Counter, Gauge, Histogram, count_call, current_request_id
+from settings import LLM_API_BASE
+
+WINDOW_SECONDS = 60.0
+
+QUEUE_WAIT = REGISTRY.register(Histogram(
+    "travel_llm_queue_wait_seconds", "Time LLM calls waited in the gateway queue", ("key",)))
+THROTTLED = REGISTRY.register(Counter(
+    "travel_llm_throttled_total", "LLM calls that waited for a local budget, by reason", ("key", "reason")))
+RATE_LIMITED = REGISTRY.register(Counter(
+    "travel_llm_rate_limited_total", "429 responses returned by the provider", ("key",)))
+RETRIES = REGISTRY.register(Counter(
+    "travel_llm_retries_total", "LLM calls retried by the gateway", ("key", "reason")))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    "travel_llm_in_flight", "LLM calls currently running", ("key",)))
+QUEUED = REGISTRY.register(Gauge(
+    "travel_llm_queued", "LLM calls waiting in the gateway queue", ("key",)))
+TOKENS = REGISTRY.register(Counter(
+    "travel_llm_tokens_total", "Tokens charged against the per-key budget", ("key",)))
+
+
+class LLMQueueTimeout(RuntimeError):
+    """排队超过 queue_timeout 仍未获得额度"""
+
+
+class KeyLimiter:
+    """
+    一个 API Key 的额度：60 秒滑动窗口内的请求数和 token 数，以及同时进行的请求数
+
+    rpm / tpm / concurrency 为 0 表示不限制。等待中的请求按调用方分组，各组轮流获得额度，组内先来先得。
+    """
+
+    def __init__(self, name: str, rpm: int = 0, tpm: int = 0, concurrency: int = 0):
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.concurrency = concurrency
+        self._cond = threading.Condition()
+        self._window = deque()
+        self._window_tokens = 0
+        self._queues = OrderedDict()
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.throttled = {}
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    def _expire(self, now: float):
+        while self._window and self._window[0][0] <= now - WINDOW_SECONDS:
+            self._window_tokens -= self._window.popleft()[1]
+
+    def _next_ticket(self):
+        for queue in self._queues.values():
+            return queue[0]
+        return None
+
+    def _blocked(self, tokens: int, now: float) -> tuple:
+        """返回 (受限原因, 最多需要等待的秒数)；可以发出请求时原因为None，等待时间为None表示等待其他请求结束"""
+        self._expire(now)
+        if now < self.cooldown_until:
+            return "cooldown", self.cooldown_until - now
+        if self.concurrency and self.in_flight >= self.concurrency:
+            return "concurrency", None
+        if self.rpm and len(self._window) >= self.rpm:
+            return "rpm", self._window[0][0] + WINDOW_SECONDS - now
+        # 单个请求超过整个 TPM 时只要求窗口为空，否则永远发不出去
+        if self.tpm and self._window and self._window_tokens + tokens > self.tpm:
+            freed = 0
+            for started, entry_tokens in self._window:
+                freed += entry_tokens
+                if self._window_tokens - freed + tokens <= self.tpm:
+                    return "tpm", started + WINDOW_SECONDS - now
+            return "tpm", self._window[-1][0] + WINDOW_SECONDS - now
+        return None, 0.0
+
+    def acquire(self, tokens: int, caller: str, timeout: float = None) -> tuple:
+        """
+        等待额度，返回 (窗口记录, 排队秒数, 受限原因集合)
+
+        窗口记录在 release 时用于按实际 token 数修正。
+        """
+        ticket = object()
+        start = time.monotonic()
+        deadline = start + timeout if timeout else None
+        reasons = set()
+        with self._cond:
+            self._queues.setdefault(caller, deque()).append(ticket)
+            QUEUED.inc(key=self.name)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = None
+                    if self._next_ticket() is ticket:
+                        reason, wait = self._blocked(tokens, now)
+                        if reason is None:
+                            break
+                        reasons.add(reason)
+                    if deadline is not None:
+                        if now >= deadline:
+                            for reason in reasons:
+                                self.throttled[reason] = self.throttled.get(reason, 0) + 1
+                                THROTTLED.inc(key=self.name, reason=reason)
+                            raise LLMQueueTimeout(f"大模型调用排队超过 {timeout:g} 秒（{self.name}）")
+                        wait = deadline - now if wait is None else min(wait, deadline - now)
+                    self._cond.wait(wait)
+            finally:
+                queue = self._queues[caller]
+                queue.remove(ticket)
+                if queue:
+                    self._queues.move_to_end(caller)
+                else:
+                    del self._queues[caller]
+                QUEUED.dec(key=self.name)
+                self._cond.notify_all()
+            entry = [time.monotonic(), tokens]
+            self._window.append(entry)
+            self._window_tokens += tokens
+            self.in_flight += 1
+            self.requests += 1
+            waited = time.monotonic() - start
+            self.queue_wait_total += waited
+            self.queue_wait_max = max(self.queue_wait_max, waited)
+            for reason in reasons:
+                self.throttled[reason] = self.throttled.get(reason, 0) + 1
+        IN_FLIGHT.inc(key=self.name)
+        QUEUE_WAIT.observe(waited, key=self.name)
+        for reason in reasons:
+            THROTTLED.inc(key=self.name, reason=reason)
+        return entry, waited, reasons
+
+    def release(self, entry: list, actual_tokens: int = None):
+        with self._cond:
+            self.in_flight -= 1
+            if actual_tokens is not None and entry in self._window:
+                self._window_tokens += actual_tokens - entry[1]
+                entry[1] = actual_tokens
+            self._cond.notify_all()
+        IN_FLIGHT.dec(key=self.name)
+        TOKENS.inc(actual_tokens if actual_tokens is not None else entry[1], key=self.name)
+
+    def pause(self, seconds: float):
+        """服务商返回 429 后，该 Key 的所有请求暂停 seconds 秒"""
+        with self._cond:
+            self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+            self.rate_limited += 1
+            self._cond.notify_all()
+        RATE_LIMITED.inc(key=self.name)
+
+    def stats(self) -> dict:
+        with self._cond:
+            self._expire(time.monotonic())
+            return {
+                "limits": {"rpm": self.rpm, "tpm": self.tpm, "concurrency": self.concurrency},
+                "requests": self.requests,
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+                "throttled": dict(self.throttled),
+                "in_flight": self.in_flight,
+                "queued": sum(len(queue) for queue in self._queues.values()),
+                "requests_last_minute": len(self._window),
+                "tokens_last_minute": self._window_tokens,
+                "mean_queue_wait": self.queue_wait_total / self.requests if self.requests else 0.0,
+                "max_queue_wait": self.queue_wait_max,
+                "cooldown_seconds": max(0.0, self.cooldown_until - time.monotonic()),
+            }
+
+
+def _message_tokens(messages) -> int:
+    total = 0
+    for message in messages or []:
+        content = message.get("content") if isinstance(message, dict) else getattr(message, "content", "")
+        if isinstance(content, list):
+            # 多模态消息：只估算文字部分，图片按固定开销计
+            total += sum(estimate_tokens(part.get("text", "")) if part.get("type") == "text" else 800
+                         for part in content if isinstance(part, dict))
+        else:
+            total += estimate_tokens(str(content or ""))
+        total += 4
+    return total
+
+
+def _classify_error(error: Exception):
+    """返回 "rate_limit"（429）、"transient"（5xx、超时、连接错误）或None（不重试）"""
+    status = getattr(error, "status_code", None)
+    if status == 429 or type(error).__name__ == "RateLimitError":
+        return "rate_limit"
+    if (isinstance(status, int) and status >= 500) or type(error).__name__ in (
+            "APIConnectionError", "APITimeoutError", "InternalServerError"):
+        return "transient"
+    return None
+
+
+def _retry_after(error: Exception):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        value = float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+    return value if value >= 0 else None
+
+
+class LLMGateway:
+    """
+    所有大模型调用共用的网关
+
+    每个 API Key（以保存它的环境变量名区分，不记录 Key 本身）一个 KeyLimiter；
+    默认额度来自 LLM_RPM / LLM_TPM / LLM_CONCURRENCY，可以用 <环境变量名>_RPM 等为单个 Key 覆盖。
+    """
+
+    def __init__(self, rpm: int = 0, tpm: int = 0, concurrency: int = 0, max_retries: int = 4,
+                 base_backoff: float = 2.0, max_backoff: float = 60.0, completion_tokens: int = 1024,
+                 queue_timeout: float = 300.0, cache: LLMResponseCache = None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.completion_tokens = completion_tokens
+        self.queue_timeout = queue_timeout
+        self.cache = cache
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            rpm=int(os.getenv("LLM_RPM", "120")),
+            tpm=int(os.getenv("LLM_TPM", "200000")),
+            concurrency=int(os.getenv("LLM_CONCURRENCY", "4")),
+            max_retries=int(os.getenv("LLM_MAX_RETRIES", "4")),
+            completion_tokens=int(os.getenv("LLM_COMPLETION_TOKENS", "1024")),
+            queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", "300")),
+            cache=LLMResponseCache.from_env(),
+        )
+
+    def limiter(self, key: str) -> KeyLimiter:
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                limiter = self._limiters[key] = KeyLimiter(
+                    key,
+                    rpm=int(os.getenv(f"{key}_RPM", str(self.rpm))),
+                    tpm=int(os.getenv(f"{key}_TPM", str(self.tpm))),
+                    concurrency=int(os.getenv(f"{key}_CONCURRENCY", str(self.concurrency))),
+                )
+            return limiter
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.max_backoff, self.base_backoff * (2 ** attempt))
+        return delay * random.uniform(0.5, 1.0)
+
+    def call(self, key: str, func, messages=None, max_tokens: int = None):
+        """在 key 的额度内调用 func()，429 和临时错误按退避策略重试"""
+        limiter = self.limiter(key)
+        tokens = _message_tokens(messages) + min(max_tokens or self.completion_tokens, self.completion_tokens)
+        caller = current_request_id() or threading.current_thread().name
+        record = {"key": key, "tokens": tokens, "queue_wait": 0.0, "throttled": set(), "attempts": 0,
+                  "rate_limited": 0, "cache": None}
+        self._local.last_call = record
+        for attempt in range(self.max_retries + 1):
+            entry, waited, reasons = limiter.acquire(tokens, caller, timeout=self.queue_timeout)
+            record["queue_wait"] += waited
+            record["throttled"] |= reasons
+            record["attempts"] += 1
+            count_call("llm")
+            actual_tokens = None
+            try:
+                result = func()
+                usage = getattr(result, "usage", None)
+                actual_tokens = getattr(usage, "total_tokens", None)
+                return result
+            except Exception as e:
+                kind = _classify_error(e)
+                if kind is None or attempt == self.max_retries:
+                    raise
+                delay = _retry_after(e) or self._backoff(attempt)
+                with limiter._cond:
+                    limiter.retries += 1
+                RETRIES.inc(key=key, reason=kind)
+                if kind == "rate_limit":
+                    record["rate_limited"] += 1
+                    limiter.pause(delay)
+                    print(f"大模型限流（{key}），{delay:.1f} 秒后重试（第 {attempt + 1} 次）")
+                else:
+                    print(f"大模型调用失败（{key}）: {str(e)}，{delay:.1f} 秒后重试（第 {attempt + 1} 次）")
+            finally:
+                limiter.release(entry, actual_tokens)
+            # 429 的等待通过暂停整个 Key 实现，其他错误只有本次调用等待
+            if kind != "rate_limit":
+                time.sleep(delay)
+
+    def wrap(self, model, key: str, cache: bool = True):
+        """让模型后端的 run 经过网关（保持原来的类型，ChatAgent 照常使用），cache=False 时不使用响应缓存"""
+        original_run = model.run
+        response_cache = self.cache if cache else None
+
+        def run(messages, *args, **kwargs):
+            config = getattr(model, "model_config_dict", None) or {}
+
+            def call():
+                return self.call(key, lambda: original_run(messages, *args, **kwargs), messages,
+                                 config.get("max_tokens"))
+
+            if response_cache is None:
+                return call()
+            response, status = response_cache.fetch(
+                getattr(model, "model_type", ""), messages, config, call,
+                tools=kwargs.get("tools", args[1] if len(args) > 1 else None),
+                response_format=kwargs.get("response_format", args[0] if args else None),
+            )
+            if status == "hit":
+                self._local.last_call = {"key": key, "tokens": 0, "queue_wait": 0.0, "throttled": set(),
+                                         "attempts": 0, "rate_limited": 0, "cache": "hit"}
+            return response
+
+        model.run = run
+        model.gateway_key = key
+        return model
+
+    def last_call(self) -> dict:
+        """当前线程最近一次调用的排队和重试情况"""
+        return getattr(self._local, "last_call", None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {key: limiter.stats() for key, limiter in limiters.items()}
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway() -> LLMGateway:
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = LLMGateway.from_env()
+        return _gateway
+
+
+def create_model(model_type: str, api_key_env: str = "FIRST_DEEPSEEK_API_KEY", url: str = LLM_API_BASE,
+                 model_config_dict: dict = None, cache: bool = True):
+    """
+    创建经过网关的 OpenAI 兼容模型
+
+    Args:
+        api_key_env: 保存 API Key 的环境变量名，同一个 Key 的模型共用额度
+        cache: 是否使用网关的大模型响应缓存（LLM_CACHE 未关闭时）
+    """
+    from camel.models import ModelFactory
+    from camel.types import ModelPlatformType
+
+    kwargs = {}
+    # 重试由网关统一处理，关闭 openai 客户端自带的重试，避免 429 时在网关之外重复请求
+    if "max_retries" in inspect.signature(ModelFactory.create).parameters:
+        kwargs["max_retries"] = 0
+    model = ModelFactory.create(
+        model_platform=ModelPlatformType.OPENAI_COMPATIBLE_MODEL,
+        model_type=model_type,
+        url=url,
+        api_key=os.getenv(api_key_env),
+        model_config_dict=model_config_dict or {"max_tokens": 4096},
+        **kwargs
+    )
+    return get_gateway().wrap(model, api_key_env, cache=cache)
@@ -0,0 +1,397 @@
+"""
+服务指标和分阶段计时
+
+user / search / generate / web_central 原来只用 print 报告进度，无法知道一次攻略生成的时间花在哪里。
+这里提供各服务共用的指标（Prometheus 文本格式，不依赖 prometheus_client）：
+- HTTP 请求延迟直方图、请求数（按状态码，可计算错误率）、正在处理的请求数；
+- 分阶段计时 stage(名称)：搜索、重排、信息提取、图片查找、大模型生成、渲染、保存等；
+- 外部接口调用 external_call(名称)：Google、Pixabay、Unsplash、大模型的调用次数、失败次数和延迟。
+
+每个请求有一个请求ID：优先使用调用方传入的 X-Request-ID 请求头，没有时新建，并写回响应头；
+服务间调用通过 request_id_headers() 带上同一个ID。分阶段耗时按请求ID汇总，请求结束时打印一行，
+最近的请求可以通过 /metrics/requests?request_id=... 查询。请求中实际发出的大模型调用次数
+（count_call，网关每次请求服务商时计一次，缓存命中不计）写入响应头 X-LLM-Calls，调用方可据此计算消耗。
+
+ServiceLifecycle.install 会调用 install(app, 服务名)，各服务自动提供 /metrics。
+指标保存在进程内存中，gunicorn 多进程部署时每个工作进程各自统计。
+"""
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+from flask import Response, g, jsonify, request
+
+REQUEST_ID_HEADER = "X-Request-ID"
+LLM_CALLS_HEADER = "X-LLM-Calls"
+
+# 秒；攻略生成的单个阶段可能长达数分钟
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["buckets"][i] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def snapshot(self) -> dict:
+        """{标签值元组: {"count", "sum"}}"""
+        with self._lock:
+            return {key: {"count": entry["count"], "sum": entry["sum"]} for key, entry in self._values.items()}
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, entry in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, entry["buckets"]):
+                    le = f'le="{_format_value(bound)}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {count}")
+                le = 'le="+Inf"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {entry['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(entry['sum'])}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {entry['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    "travel_http_requests_total", "HTTP requests by endpoint and status code",
+    ("service", "endpoint", "method", "status")))
+HTTP_SECONDS = REGISTRY.register(Histogram(
+    "travel_http_request_duration_seconds", "HTTP request latency in seconds",
+    ("service", "endpoint", "method")))
+HTTP_IN_FLIGHT = REGISTRY.register(Gauge(
+    "travel_http_requests_in_flight", "HTTP requests currently being handled", ("service",)))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "travel_stage_duration_seconds", "Pipeline stage latency in seconds", ("service", "stage")))
+STAGE_ERRORS = REGISTRY.register(Counter(
+    "travel_stage_errors_total", "Pipeline stages that raised an exception", ("service", "stage")))
+STAGE_IN_FLIGHT = REGISTRY.register(Gauge(
+    "travel_stage_in_flight", "Pipeline stages currently running", ("service", "stage")))
+EXTERNAL_CALLS = REGISTRY.register(Counter(
+    "travel_external_calls_total", "External API calls by outcome", ("service", "api", "outcome")))
+EXTERNAL_SECONDS = REGISTRY.register(Histogram(
+    "travel_external_call_duration_seconds", "External API call latency in seconds", ("service", "api")))
+
+# 最近请求的分阶段耗时，按请求ID查询
+RECENT_REQUESTS = deque(maxlen=200)
+_recent_lock = threading.Lock()
+
+_local = threading.local()
+_calls_lock = threading.Lock()
+
+# 不计入请求统计的内部接口
+_INTERNAL_ENDPOINTS = ("metrics", "recent_requests", "healthz", "readyz")
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def _current() -> dict:
+    return getattr(_local, "context", None)
+
+
+def current_request_id() -> str:
+    context = _current()
+    return context["request_id"] if context else None
+
+
+def current_service() -> str:
+    context = _current()
+    return context["service"] if context else "unknown"
+
+
+def request_id_headers() -> dict:
+    """服务间调用时带上当前请求ID"""
+    request_id = current_request_id()
+    return {REQUEST_ID_HEADER: request_id} if request_id else {}
+
+
+def _begin(service: str, request_id: str = None, name: str = "") -> dict:
+    context = {
+        "request_id": request_id or new_request_id(),
+        "service": service,
+        "name": name,
+        "started_at": time.time(),
+        "start": time.perf_counter(),
+        "stages": [],
+        "calls": {},
+        "parent": _current(),
+    }
+    _local.context = context
+    return context
+
+
+def _finish(context: dict, status=None) -> dict:
+    _local.context = context["parent"]
+    seconds = time.perf_counter() - context["start"]
+    totals = {}
+    for name, stage_seconds in context["stages"]:
+        total = totals.setdefault(name, {"count": 0, "seconds": 0.0})
+        total["count"] += 1
+        total["seconds"] += stage_seconds
+    record = {
+        "request_id": context["request_id"],
+        "service": context["service"],
+        "name": context["name"],
+        "status": status,
+        "started_at": context["started_at"],
+        "seconds": seconds,
+        "stages": totals,
+        "calls": dict(context["calls"]),
+    }
+    with _recent_lock:
+        RECENT_REQUESTS.append(record)
+    if totals:
+        summary = "，".join(
+            f"{name} {total['seconds']:.2f} 秒" + (f"（{total['count']} 次）" if total["count"] > 1 else "")
+            for name, total in totals.items()
+        )
+        print(f"[{context['request_id']}] {context['service']} {context['name']} 共 {seconds:.2f} 秒：{summary}")
+    return record
+
+
+@contextmanager
+def request_context(service: str, request_id: str = None, name: str = ""):
+    """在后台线程中延续（或新建）一个请求ID，例如 web_central 的后台任务"""
+    context = _begin(service, request_id, name)
+    status = "ok"
+    try:
+        yield context
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        _finish(context, status)
+
+
+def current_context() -> dict:
+    return _current()
+
+
+@contextmanager
+def use_context(context: dict):
+    """在工作线程中沿用调用方的请求上下文：阶段耗时记入同一个请求，不单独打印汇总"""
+    previous = _current()
+    _local.context = context
+    try:
+        yield
+    finally:
+        _local.context = previous
+
+
+@contextmanager
+def stage(name: str):
+    """记录一个阶段的耗时，同时计入当前请求的分阶段汇总"""
+    service = current_service()
+    context = _current()
+    STAGE_IN_FLIGHT.inc(service=service, stage=name)
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(service=service, stage=name)
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_IN_FLIGHT.dec(service=service, stage=name)
+        STAGE_SECONDS.observe(seconds, service=service, stage=name)
+        if context is not None:
+            context["stages"].append((name, seconds))
+
+
+@contextmanager
+def external_call(api: str):
+    """记录一次外部接口调用，代码块抛出异常时计为失败"""
+    service = current_service()
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        EXTERNAL_SECONDS.observe(time.perf_counter() - start, service=service, api=api)
+        EXTERNAL_CALLS.inc(service=service, api=api, outcome=outcome)
+
+
+def count_call(api: str, amount: int = 1):
+    """把实际发出的外部调用计入当前请求（工作线程通过 use_context 共用同一个计数）"""
+    context = _current()
+    if context is None:
+        return
+    with _calls_lock:
+        context["calls"][api] = context["calls"].get(api, 0) + amount
+
+
+def response_llm_calls(response):
+    """从下游服务的响应头读取它实际发出的大模型调用次数，没有该响应头时返回None"""
+    value = response.headers.get(LLM_CALLS_HEADER, "")
+    return int(value) if value.isdigit() else None
+
+
+def stage_summary(service: str = None) -> dict:
+    """{服务: {阶段: {"count", "seconds"}}}，供基准测试等直接读取"""
+    summary = {}
+    for (stage_service, name), entry in sorted(STAGE_SECONDS.snapshot().items()):
+        if service is None or stage_service == service:
+            summary.setdefault(stage_service, {})[name] = {"count": entry["count"], "seconds": entry["sum"]}
+    return summary
+
+
+def recent_requests(request_id: str = None) -> list:
+    with _recent_lock:
+        records = list(RECENT_REQUESTS)
+    if request_id:
+        records = [record for record in records if record["request_id"] == request_id]
+    return records
+
+
+def install(app, service: str):
+    """注册 /metrics、/metrics/requests 和请求计时；多个服务可以在同一进程中各自注册"""
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+    @app.route("/metrics/requests", endpoint="recent_requests")
+    def recent_requests_view():
+        records = recent_requests(request.args.get("request_id"))
+        return jsonify([record for record in records if record["service"] == service])
+
+    @app.before_request
+    def _metrics_start():
+        if request.endpoint in _INTERNAL_ENDPOINTS:
+            return
+        incoming = request.headers.get(REQUEST_ID_HEADER, "")
+        request_id = incoming if _REQUEST_ID_PATTERN.match(incoming) else None
+        g._metrics_context = _begin(service, request_id, request.endpoint or "unmatched")
+        HTTP_IN_FLIGHT.inc(service=service)
+
+    @app.after_request
+    def _metrics_record(response):
+        context = g.get("_metrics_context")
+        if context is None:
+            return response
+        endpoint = request.endpoint or "unmatched"
+        HTTP_SECONDS.observe(time.perf_counter() - context["start"], service=service,
+                             endpoint=endpoint, method=request.method)
+        HTTP_REQUESTS.inc(service=service, endpoint=endpoint, method=request.method,
+                          status=response.status_code)
+        response.headers[REQUEST_ID_HEADER] = context["request_id"]
+        response.headers[LLM_CALLS_HEADER] = str(context["calls"].get("llm", 0))
+        context["finished"] = True
+        _finish(context, response.status_code)
+        return response
+
+    @app.teardown_request
+    def _metrics_teardown(exc):
+        # after_request 没有执行到时（例如其他钩子出错）也要减少在途请求数
+        context = g.pop("_metrics_context", None)
+        if context is None:
+            return
+        HTTP_IN_FLIGHT.dec(service=service)
+        if not context.get("finished"):
+            _finish(context, 500)
+
+    return app
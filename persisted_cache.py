@@ -0,0 +1,74 @@
+"""
+持久化到JSON文件的进程内缓存
+
+查询向量缓存、图片描述缓存和语义回答缓存都在内存中保存条目，每新增 save_every 条（以及进程退出时）
+整体写入一个JSON文件。多个 Streamlit 会话可能同时触发保存：快照和写入在同一把保存锁内依次进行，
+较旧的快照不会覆盖较新的；临时文件名带进程号和线程号，多个进程共用同一个缓存文件时也不会互相写坏。
+"""
+import atexit
+import json
+import os
+import threading
+
+
+class PersistedCache:
+    """
+    持久化缓存的基类
+
+    子类在调用 super().__init__ 之前准备好自己的数据结构，并实现：
+    - _restore(data)：从读出的JSON恢复条目（配置不一致时忽略旧缓存）；
+    - _snapshot()：在 self._lock 内调用，返回要写入的可JSON序列化的数据。
+    子类修改条目时在 self._lock 内增加 self._unsaved，达到 save_every 时调用 save()。
+    """
+
+    # 出错提示中的缓存名称
+    label = "缓存"
+
+    def __init__(self, path: str = None, save_every: int = 5):
+        self.path = path
+        self.save_every = save_every
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._unsaved = 0
+        if path:
+            self._load()
+            atexit.register(self.save)
+
+    def _restore(self, data: dict):
+        raise NotImplementedError
+
+    def _snapshot(self) -> dict:
+        raise NotImplementedError
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._restore(data)
+        except Exception as e:
+            print(f"读取{self.label}失败: {str(e)}")
+
+    def _should_save(self) -> bool:
+        """在 self._lock 内调用：未保存的修改是否已经达到 save_every"""
+        return bool(self.path) and self._unsaved >= self.save_every
+
+    def save(self):
+        """写入磁盘（先写临时文件再替换）"""
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                if self._unsaved == 0:
+                    return
+                data = self._snapshot()
+                self._unsaved = 0
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                print(f"保存{self.label}失败: {str(e)}")
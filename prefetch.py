@@ -0,0 +1,170 @@
+import json
+import os
+import threading
+import time
+
+from jobs import PRIORITY_PREFETCH
+from settings import STORAGE_DIR
+
+# 攻略有效期：超过该时间的攻略视为过期，需要重新生成
+GUIDE_TTL_SECONDS = float(os.getenv("GUIDE_TTL_HOURS", "168")) * 3600
+
+
+class PopularityTracker:
+    """记录每个(城市, 天数)组合的请求次数，并持久化到JSON文件"""
+
+    def __init__(self, path: str = None):
+        self.path = path or os.path.join(STORAGE_DIR, "popularity.json")
+        self._lock = threading.Lock()
+        self._data = {"requests": {}, "prefetch_log": []}
+        self._load()
+
+    @staticmethod
+    def _key(city: str, days) -> str:
+        return f"{city}|{days}"
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._data.update(json.load(f))
+        except Exception as e:
+            print(f"读取热度统计失败: {str(e)}")
+
+    def _save(self):
+        # 先写临时文件再替换，避免写入中断导致文件损坏
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def record(self, city: str, days):
+        """记录一次交互请求"""
+        with self._lock:
+            entry = self._data["requests"].setdefault(
+                self._key(city, days), {"city": city, "days": days, "count": 0}
+            )
+            entry["count"] += 1
+            entry["last_requested"] = time.time()
+            self._save()
+
+    def top(self, n: int) -> list:
+        """按请求次数返回最热门的 n 个组合"""
+        with self._lock:
+            entries = sorted(
+                self._data["requests"].values(),
+                key=lambda e: (e["count"], e.get("last_requested", 0)),
+                reverse=True,
+            )
+            return [dict(e) for e in entries[:n]]
+
+    def record_prefetch(self, city: str, days, api_calls: int):
+        """记录一次预取消耗的API调用数，只保留最近24小时"""
+        with self._lock:
+            now = time.time()
+            log = [e for e in self._data["prefetch_log"] if now - e["time"] < 86400]
+            log.append({"time": now, "city": city, "days": days, "api_calls": api_calls})
+            self._data["prefetch_log"] = log
+            self._save()
+
+    def prefetch_calls_last_day(self) -> int:
+        with self._lock:
+            now = time.time()
+            return sum(e["api_calls"] for e in self._data["prefetch_log"] if now - e["time"] < 86400)
+
+
+class PrefetchScheduler:
+    """
+    热门攻略预取调度器
+
+    在没有交互请求时，按热度把 top-N 的(城市, 天数)攻略预先生成到 storage/，
+    并在过期前刷新。预取任务以低优先级提交到 JobManager，且同一时间只运行一个，
+    每天的API调用数不超过预算：提交前按 calls_per_build 估计下一份攻略的消耗，
+    任务完成后按下游服务报告的实际大模型调用次数记账（服务没有报告时才按估计值记）。
+    """
+
+    def __init__(self, central_service, job_manager, tracker: PopularityTracker,
+                 top_n: int = 10, api_budget_per_day: int = 200, calls_per_build: int = 12,
+                 refresh_margin_seconds: float = 12 * 3600, check_interval: float = 60):
+        self.central_service = central_service
+        self.job_manager = job_manager
+        self.tracker = tracker
+        self.top_n = top_n
+        self.api_budget_per_day = api_budget_per_day
+        self.calls_per_build = calls_per_build
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.check_interval = check_interval
+        self._thread = None
+        self._stop = threading.Event()
+
+    @classmethod
+    def from_env(cls, central_service, job_manager, tracker):
+        """从环境变量读取预取配置"""
+        return cls(
+            central_service, job_manager, tracker,
+            top_n=int(os.getenv("PREFETCH_TOP_N", "10")),
+            api_budget_per_day=int(os.getenv("PREFETCH_API_BUDGET", "200")),
+            calls_per_build=int(os.getenv("PREFETCH_CALLS_PER_BUILD", "12")),
+            refresh_margin_seconds=float(os.getenv("PREFETCH_REFRESH_MARGIN_HOURS", "12")) * 3600,
+            check_interval=float(os.getenv("PREFETCH_CHECK_INTERVAL", "60")),
+        )
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="prefetch-scheduler", daemon=True)
+        self._thread.start()
+        print(f"预取调度器已启动：top{self.top_n}，每日API预算 {self.api_budget_per_day}")
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.check_interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"预取调度出错: {str(e)}")
+
+    def needs_build(self, city: str, days) -> bool:
+        """攻略不存在或即将过期时需要（重新）生成"""
+        path = self.central_service.guide_path(city, days)
+        if not os.path.exists(path):
+            return True
+        age = time.time() - os.path.getmtime(path)
+        return age > GUIDE_TTL_SECONDS - self.refresh_margin_seconds
+
+    def build(self, city, days, progress=None):
+        """预取任务：生成攻略，结束后（包括失败）把实际消耗的调用数计入预算"""
+        result = {}
+        try:
+            result = self.central_service.build_guide(city, days, progress=progress)
+            return result
+        finally:
+            api_calls = result.get("llm_calls")
+            self.tracker.record_prefetch(city, days, self.calls_per_build if api_calls is None else api_calls)
+
+    def run_once(self):
+        """检查一次是否可以提交预取任务，返回提交的Job或None"""
+        # 交互请求优先：有交互任务排队或执行时不做预取
+        if not self.job_manager.is_idle("interactive"):
+            return None
+        if not self.job_manager.is_idle("prefetch"):
+            return None
+        if self.tracker.prefetch_calls_last_day() + self.calls_per_build > self.api_budget_per_day:
+            return None
+
+        for entry in self.tracker.top(self.top_n):
+            city, days = entry["city"], entry["days"]
+            if not self.needs_build(city, days):
+                continue
+            print(f"预取攻略：{city}{days}天（已请求 {entry['count']} 次）")
+            return self.job_manager.submit(
+                self.build, city, days,
+                kind="prefetch", priority=PRIORITY_PREFETCH,
+                meta={"city": city, "days": days},
+            )
+        return None
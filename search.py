@@ -1,46 +1,71 @@
-from camel.toolkits import SearchToolkit
-from camel.agents import ChatAgent
-from camel.models import ModelFactory
-from camel.types import ModelPlatformType
-from camel.loaders import Firecrawl
 from typing import List, Dict, Any
-from flask import Flask, request, jsonify
+from flask import Flask, Blueprint, request, jsonify
+import inspect
 import json
 import os
 from dotenv import load_dotenv
 import requests
 import time
 import random
-from duckduckgo_search.exceptions import RatelimitException
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from json_stream import STREAM_AGENT_OPTIONS, extract_json, extract_json_stream
+from lifecycle import LazyResource, ServiceLifecycle
+from metrics import (count_call, current_context, external_call, request_id_headers, response_llm_calls,
+                     stage, use_context)
+from settings import (GOOGLE_SEARCH_URL, PIXABAY_API_URL, UNSPLASH_API_URL,
+                      GENERATE_SERVICE_URL, STORAGE_DIR)
 
 load_dotenv()
 
-os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
-os.environ["SEARCH_ENGINE_ID"] = os.getenv("SEARCH_ENGINE_ID")
-os.environ["FIRECRAWL_API_KEY"] = os.getenv("FIRECRAWL_API_KEY")
-os.environ["FIRST_DEEPSEEK_API_KEY"] = os.getenv("FIRST_DEEPSEEK_API_KEY")
-os.environ["PIXABAY_API_KEY"] = os.getenv("PIXABAY_API_KEY")
-os.environ["UNSPLASH_ACCESS_KEY"] = os.getenv("UNSPLASH_ACCESS_KEY")
+bp = Blueprint("search", __name__)
 
-app = Flask(__name__)
+def create_search_model(stream: bool = False):
+    """创建搜索服务共用的模型客户端（camel 导入较慢，放到预热阶段执行）"""
+    from llm_gateway import create_model
+
+    model_config_dict = {"max_tokens": 4096}
+    if stream:
+        model_config_dict["stream"] = True
+    return create_model("deepseek-ai/DeepSeek-V3", "FIRST_DEEPSEEK_API_KEY", model_config_dict=model_config_dict)
+
+# 景点和美食的抽取结果以流式返回，每个条目生成完就开始查找图片；SEARCH_STREAMING=0 时等完整结果
+SEARCH_STREAMING = os.getenv("SEARCH_STREAMING", "1") == "1"
+
+# 抽取结果中的数组 -> (结果中的分类名, 图片搜索关键词后缀)
+ITEM_CATEGORIES = {
+    "attractions": ("景点", ""),
+    "foods": ("美食", " food"),
+    "food_shop": ("美食店铺", " restaurant"),
+}
+
+def create_search_toolkit():
+    from camel.toolkits import SearchToolkit
+
+    return SearchToolkit()
+
+search_model = LazyResource("search_model", create_search_model)
+search_stream_model = LazyResource("search_stream_model", lambda: create_search_model(stream=True))
+search_toolkit = LazyResource("search_toolkit", create_search_toolkit)
+lifecycle = ServiceLifecycle(
+    "search",
+    resources=[search_model]
+    + ([search_stream_model] if SEARCH_STREAMING else [])
+    + ([] if GOOGLE_SEARCH_URL else [search_toolkit])
+)
 
 class TravelPlanner:
     def __init__(self, city: str, days: int):
+        from camel.agents import ChatAgent
         
         #定义地点和时间，设置默认值
         self.city = city
         self.days = days
         self.res = None        
 
-        # 初始化模型和智能体
-        self.model = ModelFactory.create(
-            model_platform=ModelPlatformType.OPENAI_COMPATIBLE_MODEL,
-            model_type="deepseek-ai/DeepSeek-V3",
-            url='https://api.siliconflow.cn/v1',
-            model_config_dict={"max_tokens": 4096},
-            api_key=os.getenv('FIRST_DEEPSEEK_API_KEY')
-        )
+        # 模型客户端在进程内共享，智能体按请求创建（智能体带有对话状态）
+        self.model = search_model.get()
+        extract_model = search_stream_model.get() if SEARCH_STREAMING else self.model
         # 初始化各种工具
         #重排序模型
         self.reranker_agent = ChatAgent(
@@ -51,14 +76,16 @@ class TravelPlanner:
         #景点抓取agent
         self.attraction_agent = ChatAgent(
             system_message="你是一个旅游信息提取专家，要根据内容提取出景点信息并返回json格式，严格以json格式输出",
-            model=self.model,
-            output_language='中文'
+            model=extract_model,
+            output_language='中文',
+            **STREAM_AGENT_OPTIONS
         )
         #美食抓取agent
         self.food_agent = ChatAgent(
             system_message="你是一个旅游信息提取专家，要根据内容提取出美食信息并返回json格式，严格以json格式输出",
-            model=self.model,
-            output_language='中文'
+            model=extract_model,
+            output_language='中文',
+            **STREAM_AGENT_OPTIONS
         )
         #base攻略生成agent
         self.base_guide_agent = ChatAgent(
@@ -67,7 +94,40 @@ class TravelPlanner:
             output_language='中文'
         )
         # self.firecrawl = Firecrawl()#后续功能
-        self.search_toolkit = SearchToolkit()
+
+    def search_google(self, query: str, num_results: int = 5) -> List[Dict[str, Any]]:
+        """搜索网页：默认使用 camel SearchToolkit；设置了 GOOGLE_SEARCH_URL 时直接请求该地址"""
+        if GOOGLE_SEARCH_URL:
+            return self.search_google_api(query, num_results)
+        toolkit = search_toolkit.get()
+        # 结果数量参数在 camel 版本之间改过名（num_result_pages -> number_of_result_pages）
+        parameters = inspect.signature(toolkit.search_google).parameters
+        name = "number_of_result_pages" if "number_of_result_pages" in parameters else "num_result_pages"
+        with external_call("google"):
+            return toolkit.search_google(query=query, **{name: num_results})
+
+    def search_google_api(self, query: str, num_results: int = 5) -> List[Dict[str, Any]]:
+        """直接请求 GOOGLE_SEARCH_URL（Custom Search 接口格式），返回格式与camel SearchToolkit一致"""
+        params = {
+            "key": os.getenv("GOOGLE_API_KEY"),
+            "cx": os.getenv("SEARCH_ENGINE_ID"),
+            "q": query,
+            "num": num_results,
+        }
+        with external_call("google"):
+            response = requests.get(GOOGLE_SEARCH_URL, params=params, timeout=30)
+            response.raise_for_status()
+        results = []
+        for i, item in enumerate(response.json().get("items", []), start=1):
+            metatags = item.get("pagemap", {}).get("metatags", [{}])
+            results.append({
+                "result_id": i,
+                "title": item.get("title"),
+                "description": item.get("snippet"),
+                "long_description": metatags[0].get("og:description", "N/A") if metatags else "N/A",
+                "url": item.get("link"),
+            })
+        return results
 
     def search_pixabay_image(self, query: str) -> str:
         """通过Pixabay API搜索图片"""
@@ -77,7 +137,7 @@ class TravelPlanner:
                 print("Pixabay API密钥未设置")
                 return ""
             
-            url = "https://pixabay.com/api/"
+            url = PIXABAY_API_URL
             params = {
                 "key": api_key,
                 "q": query,
@@ -91,8 +151,9 @@ class TravelPlanner:
                 "order": "popular"
             }
             
-            response = requests.get(url, params=params, timeout=10)
-            response.raise_for_status()
+            with external_call("pixabay"):
+                response = requests.get(url, params=params, timeout=10)
+                response.raise_for_status()
             
             data = response.json()
             if data.get("hits") and len(data["hits"]) > 0:
@@ -119,7 +180,7 @@ class TravelPlanner:
                 print("Unsplash Access Key未设置")
                 return ""
             
-            url = "https://api.unsplash.com/search/photos"
+            url = UNSPLASH_API_URL
             headers = {
                 "Authorization": f"Client-ID {access_key}"
             }
@@ -131,8 +192,9 @@ class TravelPlanner:
                 "order_by": "relevant"
             }
             
-            response = requests.get(url, headers=headers, params=params, timeout=10)
-            response.raise_for_status()
+            with external_call("unsplash"):
+                response = requests.get(url, headers=headers, params=params, timeout=10)
+                response.raise_for_status()
             
             data = response.json()
             if data.get("results") and len(data["results"]) > 0:
@@ -153,6 +215,10 @@ class TravelPlanner:
 
     def search_image_with_retry(self, query: str, max_retries: int = 3) -> str:
         """通过Pixabay和Unsplash API搜索图片，带重试机制"""
+        with stage("image_lookup"):
+            return self._search_image_with_retry(query, max_retries)
+
+    def _search_image_with_retry(self, query: str, max_retries: int) -> str:
         for attempt in range(max_retries):
             try:
                 print(f"搜索图片 (尝试 {attempt + 1}/{max_retries}): {query}")
@@ -197,37 +263,18 @@ class TravelPlanner:
         return placeholder_images.get(item_type, "https://via.placeholder.com/400x300/gray/white?text=暂无图片")
 
     def extract_json_from_response(self,response_content: str) -> List[Dict[str, Any]]:
-            """从LLM响应中提取JSON内容"""
-            try:
-                # 找到JSON内容的开始和结束位置
-                start = response_content.find('```json\n') + 8
-                end = response_content.find('\n```', start)
-                if start == -1 or end == -1:
-                    print("未找到JSON内容的标记")
-                    return []
-                
-                json_str = response_content[start:end].strip()
-                print(f"提取的JSON字符串: {json_str}")  # 调试信息
-                
-                # 解析 JSON 字符串
-                parsed = json.loads(json_str)
-                
-                # 处理不同的JSON结构
-                if isinstance(parsed, dict) and "related_results" in parsed:
-                    return parsed["related_results"]
-                elif isinstance(parsed, list):
-                    return parsed
-                else:
-                    print("未找到预期的JSON结构")
-                    return []
-                
-            except json.JSONDecodeError as e:
-                print(f"解析JSON失败: {str(e)}")
+            """从LLM响应中提取重排结果（不要求代码块标记的格式，截断的输出保留完整的条目）"""
+            parsed = extract_json(response_content)
+            
+            # 处理不同的JSON结构
+            if isinstance(parsed, dict) and "related_results" in parsed:
+                return parsed["related_results"]
+            elif isinstance(parsed, list):
+                return parsed
+            else:
+                print("未找到预期的JSON结构")
                 print(f"原始内容: {response_content}")
                 return []
-            except Exception as e:
-                print(f"发生错误: {str(e)}")
-                return []
 
     def search_and_rerank(self) -> Dict[str, Any]:
         """多次搜索并重排序，整合信息"""
@@ -238,9 +285,11 @@ class TravelPlanner:
         # 第一次搜索：旅游攻略
         try:
             query = f"{city}{days}天旅游攻略 最佳路线"
-            search_results = self.search_toolkit.search_google(query=query, num_result_pages=5)
+            with stage("search"):
+                search_results = self.search_google(query=query, num_results=5)
             prompt = f"请从以下搜索结果中筛选出最相关的{self.days}条{city}{days}天旅游攻略信息，并按照相关性排序：\n{json.dumps(search_results, ensure_ascii=False, indent=2)}"
-            response = self.reranker_agent.step(prompt)
+            with stage("rerank"), external_call("llm"):
+                response = self.reranker_agent.step(prompt)
             all_results["guides"] = self.extract_json_from_response(response.msgs[0].content)
         except Exception as e:
             print(f"旅游攻略搜索失败: {str(e)}")
@@ -249,9 +298,11 @@ class TravelPlanner:
         # 第二次搜索：必去景点
         try:
             query = f"{city} 必去景点 top10 著名景点"
-            search_results = self.search_toolkit.search_google(query=query, num_result_pages=5)
+            with stage("search"):
+                search_results = self.search_google(query=query, num_results=5)
             prompt = f"请从以下搜索结果中筛选出最多{self.days}条{city}最值得去的景点信息，并按照热门程度排序：\n{json.dumps(search_results, ensure_ascii=False, indent=2)}"
-            response = self.reranker_agent.step(prompt)
+            with stage("rerank"), external_call("llm"):
+                response = self.reranker_agent.step(prompt)
             all_results["attractions"] = self.extract_json_from_response(response.msgs[0].content)
         except Exception as e:
             print(f"景点搜索失败: {str(e)}")
@@ -260,9 +311,11 @@ class TravelPlanner:
         # 第三次搜索：必吃美食
         try:
             query = f"{city} 必吃美食 特色小吃 推荐"
-            search_results = self.search_toolkit.search_google(query=query, num_result_pages=5)
+            with stage("search"):
+                search_results = self.search_google(query=query, num_results=5)
             prompt = f"请从以下搜索结果中筛选出最多{self.days}条{city}最具特色的美食信息，并按照推荐度排序：\n{json.dumps(search_results, ensure_ascii=False, indent=2)}"
-            response = self.reranker_agent.step(prompt)
+            with stage("rerank"), external_call("llm"):
+                response = self.reranker_agent.step(prompt)
             all_results["must_eat"] = self.extract_json_from_response(response.msgs[0].content)
         except Exception as e:
             print(f"必吃美食搜索失败: {str(e)}")
@@ -271,9 +324,11 @@ class TravelPlanner:
         # 第四次搜索：特色美食
         try:
             query = f"{city} 特色美食 地方小吃 传统美食"
-            search_results = self.search_toolkit.search_google(query=query, num_result_pages=5)
+            with stage("search"):
+                search_results = self.search_google(query=query, num_results=5)
             prompt = f"请从以下搜索结果中筛选出最多{self.days}条{city}独特的地方特色美食信息，并按照特色程度排序：\n{json.dumps(search_results, ensure_ascii=False, indent=2)}"
-            response = self.reranker_agent.step(prompt)
+            with stage("rerank"), external_call("llm"):
+                response = self.reranker_agent.step(prompt)
             all_results["local_food"] = self.extract_json_from_response(response.msgs[0].content)
         except Exception as e:
             print(f"特色美食搜索失败: {str(e)}")
@@ -325,7 +380,12 @@ class TravelPlanner:
         
         return final_result
     
-    def extract_attractions_and_food(self) -> Dict:
+    def extract_attractions_and_food(self, on_item=None) -> Dict:
+        """
+        生成base攻略并提取景点、美食，返回解析后的JSON
+
+        on_item(path, index, value) 在景点/美食条目生成完时调用（路径如 ("attractions",)），不必等整个回复结束。
+        """
         travel_info = self.search_and_rerank()
 
         # 提供一个base攻略路线，直接根据整个travel_info生成
@@ -337,7 +397,8 @@ class TravelPlanner:
             "base_guide": "攻略内容"
         }}
         """
-        base_guide = self.base_guide_agent.step(prompt)
+        with stage("base_guide"), external_call("llm"):
+            base_guide = self.base_guide_agent.step(prompt)
         print(f"这是base攻略: {base_guide.msgs[0].content}")
 
         """提取景点和美食信息"""
@@ -375,17 +436,23 @@ class TravelPlanner:
         }}
         """
         
-        # 使用attraction_agent处理提取
-        attractions_response = self.attraction_agent.step(attractions_prompt)
-        foods_response = self.food_agent.step(food_prompt)
+        # 使用attraction_agent处理提取（流式响应在读取时才真正调用大模型）
+        with stage("extract"):
+            with external_call("llm"):
+                attractions_data, attractions_content = extract_json_stream(
+                    self.attraction_agent.step(attractions_prompt), on_item=on_item, default={})
+            with external_call("llm"):
+                foods_data, foods_content = extract_json_stream(
+                    self.food_agent.step(food_prompt), on_item=on_item, default={})
         
-        print(f"这是景点信息: {attractions_response.msgs[0].content}")
-        print(f"这是美食信息: {foods_response.msgs[0].content}")
+        print(f"这是景点信息: {attractions_content}")
+        print(f"这是美食信息: {foods_content}")
         
+        base_guide_content = base_guide.msgs[0].content
         return {
-            "base_guide": base_guide.msgs[0].content,
-            "attractions": attractions_response.msgs[0].content,
-            "foods": foods_response.msgs[0].content
+            "base_guide": extract_json(base_guide_content, default={"base_guide": base_guide_content}),
+            "attractions": attractions_data,
+            "foods": foods_data
         }
     
     def generate_html(self):
@@ -398,12 +465,15 @@ class TravelPlanner:
             }
             
             # 调用generate.py的API
-            generate_url = "http://localhost:5003/generate_itinerary_html"
+            generate_url = GENERATE_SERVICE_URL
             print(f"正在调用generate生成HTML，请求数据: {data}")
             
             # 使用更长的超时时间
-            response = requests.post(generate_url, json=data, timeout=300)
+            with stage("generate_service"):
+                response = requests.post(generate_url, json=data, timeout=300, headers=request_id_headers())
             
+            # generate 服务的大模型调用计入本次请求，调用方按 X-LLM-Calls 计算消耗
+            count_call("llm", response_llm_calls(response) or 0)
             if response.status_code == 200:
                 result = response.json()
                 print(f"HTML生成成功，文件保存在: {result.get('file_path', '未知路径')}")
@@ -414,138 +484,95 @@ class TravelPlanner:
                 return None
         except requests.exceptions.Timeout:
             print("调用generate API超时，可能需要手动生成HTML")
-            print(f"请手动访问: http://localhost:5003/generate_itinerary_html 并提供参数: {{'city': '{self.city}', 'days': '{self.days}'}}")
+            print(f"请手动访问: {GENERATE_SERVICE_URL} 并提供参数: {{'city': '{self.city}', 'days': '{self.days}'}}")
             return None
         except requests.exceptions.ConnectionError:
             print("连接generate服务失败，请确保generate.py正在运行")
-            print(f"请手动访问: http://localhost:5003/generate_itinerary_html 并提供参数: {{'city': '{self.city}', 'days': '{self.days}'}}")
+            print(f"请手动访问: {GENERATE_SERVICE_URL} 并提供参数: {{'city': '{self.city}', 'days': '{self.days}'}}")
             return None
         except Exception as e:
             print(f"生成HTML时发生未知错误: {str(e)}")
             return None
             
-    def process_attractions_and_food(self) -> Dict:
-        def clean_json_string(json_str: str) -> str:
-            """清理JSON字符串，移除markdown代码块标记"""
-            # 移除 ```json 开头
-            if '```json' in json_str:
-                json_str = json_str.split('```json')[-1]
-            # 移除 ``` 结尾
-            if '```' in json_str:
-                json_str = json_str.split('```')[0]
-            return json_str.strip()
-        
-        city = self.city
-        """处理景点和美食信息，添加图片URL"""
-        # 获取原始数据
-        results = self.extract_attractions_and_food()
-        
-        # 解析JSON字符串
-        base_guide = json.loads(clean_json_string(results['base_guide']))
-        attractions_data = json.loads(clean_json_string(results['attractions']))
-        foods_data= json.loads(clean_json_string(results['foods']))
-        foods_list = foods_data['foods']
-        food_shops_list = foods_data['food_shop']
-        
-        # 创建结果字典
-        result = {
-            "city": city,
-            "days": self.days,
-            "base路线": base_guide,
-            "景点": [],
-            "美食": [],
-            "美食店铺": []
+    def item_with_image(self, category: str, item: Dict, delay: bool = False) -> Dict:
+        """为一个景点/美食/美食店铺查找图片（通过Pixabay和Unsplash API），找不到时使用占位符"""
+        item_type, query_suffix = ITEM_CATEGORIES[category]
+        # 在处理项目之间添加延迟（第一个不延迟），避免频率限制
+        if delay:
+            wait = random.uniform(1, 2)  # 1-2秒延迟
+            print(f"等待 {wait:.1f} 秒后处理下一个{item_type}...")
+            time.sleep(wait)
+        print(f"处理{item_type}: {item['name']}")
+        image_url = self.search_image_with_retry(f"{self.city} {item['name']}{query_suffix}")
+        if not image_url:
+            print(f"为 {item['name']} 使用占位符图片")
+            image_url = self.get_placeholder_image(item_type, item['name'])
+        return {
+            "name": item["name"],
+            "describe": item.get("description", ""),
+            "图片url": image_url,
         }
-        
-        print(f"开始处理 {len(attractions_data['attractions'])} 个景点...")
-        
-        # 处理景点信息 - 添加延迟和重试机制
-        for i, attraction in enumerate(attractions_data['attractions']):
-            print(f"处理景点 {i+1}/{len(attractions_data['attractions'])}: {attraction['name']}")
-            
-            # 搜索图片（通过Pixabay和Unsplash API）
-            search_query = f"{city} {attraction['name']}"
-            image_url = self.search_image_with_retry(search_query)
-            
-            # 如果搜索失败，使用占位符
-            if not image_url:
-                print(f"为 {attraction['name']} 使用占位符图片")
-                image_url = self.get_placeholder_image("景点", attraction['name'])
-            
-            attraction_with_image = {
-                "name": attraction['name'],
-                "describe": attraction['description'],
-                "图片url": image_url,
-            }
-            result['景点'].append(attraction_with_image)
-            
-            # 在处理项目之间添加延迟（除了最后一个）
-            if i < len(attractions_data['attractions']) - 1:
-                delay = random.uniform(1, 2)  # 1-2秒延迟
-                print(f"等待 {delay:.1f} 秒后处理下一个景点...")
-                time.sleep(delay)
-        
-        print(f"开始处理 {len(foods_list)} 个美食...")
-        
-        # 处理美食信息 - 添加延迟和重试机制
-        for i, food in enumerate(foods_list):
-            print(f"处理美食 {i+1}/{len(foods_list)}: {food['name']}")
-            
-            # 搜索图片（通过Pixabay和Unsplash API）
-            search_query = f"{city} {food['name']} food"
-            image_url = self.search_image_with_retry(search_query)
-            
-            # 如果搜索失败，使用占位符
-            if not image_url:
-                print(f"为 {food['name']} 使用占位符图片")
-                image_url = self.get_placeholder_image("美食", food['name'])
-            
-            food_with_image = {
-                "name": food["name"],
-                "describe": food["description"],
-                "图片url": image_url,
-            }
-            result['美食'].append(food_with_image)
-            
-            # 在处理项目之间添加延迟（除了最后一个）
-            if i < len(foods_list) - 1:
-                delay = random.uniform(1, 2)  # 1-2秒延迟
-                print(f"等待 {delay:.1f} 秒后处理下一个美食...")
-                time.sleep(delay)
-        
-        print(f"开始处理 {len(food_shops_list)} 个美食店铺...")
-        
-        # 处理美食店铺信息 - 添加延迟和重试机制
-        for i, food_shop in enumerate(food_shops_list):
-            print(f"处理美食店铺 {i+1}/{len(food_shops_list)}: {food_shop['name']}")
-            
-            # 搜索图片（通过Pixabay和Unsplash API）
-            search_query = f"{city} {food_shop['name']} restaurant"
-            image_url = self.search_image_with_retry(search_query)
-            
-            # 如果搜索失败，使用占位符
-            if not image_url:
-                print(f"为 {food_shop['name']} 使用占位符图片")
-                image_url = self.get_placeholder_image("美食店铺", food_shop['name'])
+
+    def process_attractions_and_food(self, generate: bool = True) -> Dict:
+        """
+        处理景点和美食信息，添加图片URL，generate 为 True 时保存后接着调用generate服务生成HTML
+
+        抽取结果中的每个条目一生成完就交给图片查找线程，图片查找与大模型生成重叠进行；
+        图片查找仍逐个进行、条目之间保留延迟。最终以完整解析的结果为准，流式过程中没有收到的条目补查。
+        """
+        city = self.city
+        lookups = {category: {} for category in ITEM_CATEGORIES}
+        submitted = []
+        context = current_context()
+
+        def lookup(category, item, delay):
+            with use_context(context):
+                return self.item_with_image(category, item, delay)
+
+        def submit(category, index, item):
+            if isinstance(item, dict) and item.get("name") and index not in lookups[category]:
+                lookups[category][index] = (item["name"], executor.submit(lookup, category, item, bool(submitted)))
+                submitted.append(category)
+
+        def on_item(path, index, item):
+            if len(path) == 1 and path[0] in ITEM_CATEGORIES:
+                submit(path[0], index, item)
+
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="image_lookup") as executor:
+            # 获取原始数据（已解析）
+            results = self.extract_attractions_and_food(on_item=on_item)
+            attractions_data, foods_data = results['attractions'], results['foods']
             
-            food_shop_with_image = {
-                "name": food_shop["name"],
-                "describe": food_shop["description"],
-                "图片url": image_url,
+            # 创建结果字典
+            result = {
+                "city": city,
+                "days": self.days,
+                "base路线": results['base_guide'],
+                "景点": [],
+                "美食": [],
+                "美食店铺": []
             }
-            result['美食店铺'].append(food_shop_with_image)
             
-            # 在处理项目之间添加延迟（除了最后一个）
-            if i < len(food_shops_list) - 1:
-                delay = random.uniform(1, 2)  # 1-2秒延迟
-                print(f"等待 {delay:.1f} 秒后处理下一个美食店铺...")
-                time.sleep(delay)
+            for category, data in [("attractions", attractions_data), ("foods", foods_data), ("food_shop", foods_data)]:
+                items = [item for item in data.get(category, []) if isinstance(item, dict) and item.get("name")]
+                print(f"共 {len(items)} 个{ITEM_CATEGORIES[category][0]}，"
+                      f"{len(lookups[category])} 个在生成过程中已开始查找图片")
+                for index, item in enumerate(data.get(category, [])):
+                    if not (isinstance(item, dict) and item.get("name")):
+                        continue
+                    pending = lookups[category].get(index)
+                    # 流式过程中的条目与最终结果不一致时（例如截断后补全），按最终结果重新查找
+                    if pending is None or pending[0] != item["name"]:
+                        lookups[category].pop(index, None)
+                        submit(category, index, item)
+                        pending = lookups[category][index]
+                    result[ITEM_CATEGORIES[category][0]].append(pending[1].result())
         
         try:
             # 获取当前脚本所在目录
             current_dir = os.path.dirname(os.path.abspath(__file__))
             # 创建storage目录路径
-            storage_dir = os.path.join(current_dir, "storage")
+            storage_dir = os.path.join(current_dir, STORAGE_DIR)
             # 确保storage目录存在
             os.makedirs(storage_dir, exist_ok=True)
             
@@ -553,18 +580,19 @@ class TravelPlanner:
             filename = os.path.join(storage_dir, f"{self.city}{self.days}天旅游信息.json")
             
             # 将结果写入JSON文件
-            with open(filename, 'w', encoding='utf-8') as f:
+            with stage("save"), open(filename, 'w', encoding='utf-8') as f:
                 json.dump(result, f, ensure_ascii=False, indent=4)
             print(f"旅游攻略已保存到文件：{filename}")
             
-            # 自动调用generate生成HTML
-            self.generate_html()
+            # 自动调用generate生成HTML（由中枢服务接着调用generate时跳过，避免生成两次）
+            if generate:
+                self.generate_html()
         except Exception as e:
             print(f"保存JSON文件时出错: {str(e)}")
         
         return result
 
-@app.route('/get_travel_plan', methods=['POST'])
+@bp.route('/get_travel_plan', methods=['POST'])
 def get_travel_plan():
    try:
        # 获取请求数据
@@ -591,7 +619,7 @@ def get_travel_plan():
            
        # 创建TravelPlanner实例并获取结果
        travel_planner = TravelPlanner(city=city, days=days)
-       results = travel_planner.process_attractions_and_food()
+       results = travel_planner.process_attractions_and_food(generate=data.get('generate', True))
        
        return jsonify({
            'status': 'success',
@@ -604,5 +632,17 @@ def get_travel_plan():
            'message': f'处理请求时发生错误: {str(e)}'
        }), 500
 
+def create_app(warm_up: bool = True) -> Flask:
+   """应用工厂：多进程部署时每个工作进程各自创建并预热，例如 gunicorn -w 4 'search:create_app()'"""
+   app = Flask(__name__)
+   app.register_blueprint(bp)
+   lifecycle.install(app)
+   if warm_up:
+       lifecycle.warm_up(background=True)
+   return app
+
+# 兼容 flask run 和 gunicorn search:app：模块级应用不预热，资源在首个请求时初始化
+app = create_app(warm_up=False)
+
 if __name__ == '__main__':
-   app.run(host='0.0.0.0', port=5002, debug=True)
+   create_app().run(host='0.0.0.0', port=5002, debug=True)
@@ -0,0 +1,33 @@
+"""
+服务地址和存储目录配置，均可通过环境变量覆盖（例如基准测试时指向本地模拟服务）
+"""
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 大模型接口（OpenAI兼容）
+LLM_API_BASE = os.getenv("LLM_API_BASE", "https://api.siliconflow.cn/v1")
+
+# 外部搜索和图片接口
+# 默认由 camel SearchToolkit 调用 Google 搜索；设置后 search 服务直接请求该地址（例如基准测试的本地模拟服务）
+GOOGLE_SEARCH_URL = os.getenv("GOOGLE_SEARCH_URL", "")
+PIXABAY_API_URL = os.getenv("PIXABAY_API_URL", "https://pixabay.com/api/")
+UNSPLASH_API_URL = os.getenv("UNSPLASH_API_URL", "https://api.unsplash.com/search/photos")
+
+# 内部服务地址
+USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://localhost:5001/extract_travel_info")
+SEARCH_SERVICE_URL = os.getenv("SEARCH_SERVICE_URL", "http://localhost:5002/get_travel_plan")
+GENERATE_SERVICE_URL = os.getenv("GENERATE_SERVICE_URL", "http://localhost:5003/generate_itinerary_html")
+
+# 攻略、旅游信息和缓存的存储目录
+STORAGE_DIR = os.getenv("STORAGE_DIR", "storage")
+
+# 本地知识库（嵌入式Qdrant）目录、集合名称和向量维度（e5-large-v2）
+KB_PATH = "storage_travel_kb"
+KB_COLLECTION_NAME = "旅游知识库"
+KB_VECTOR_DIM = 1024
+
+# 本地嵌入服务（embedding_service.py）
+EMBEDDING_SERVICE_URL = os.getenv("EMBEDDING_SERVICE_URL", "http://localhost:5004")
@@ -2,11 +2,16 @@ import os
 import json
 import requests
 import time
-from flask import Flask, request, jsonify, Response
+from typing import TYPE_CHECKING
+from flask import Flask, Blueprint, request, jsonify, Response
 from dotenv import load_dotenv
-from camel.models import ModelFactory
-from camel.types import ModelPlatformType
-from camel.agents import ChatAgent
+from json_stream import extract_json
+from lifecycle import LazyResource, ServiceLifecycle
+from metrics import external_call, request_id_headers, stage
+from settings import SEARCH_SERVICE_URL, GENERATE_SERVICE_URL
+
+if TYPE_CHECKING:
+    from camel.agents import ChatAgent
 
 load_dotenv()
 
@@ -53,20 +58,15 @@ SYSTEM_PROMPT = """
 {"city": "北京", "days": null, "need_more_info": true,"response": "Navigator还不知道您打算去玩几天呢，请补充你计划的行程天数~"}
 """
 
-app = Flask(__name__)
-
-# 服务配置
-SEARCH_SERVICE_URL = "http://localhost:5002/get_travel_plan"
-GENERATE_SERVICE_URL = "http://localhost:5003/generate_itinerary_html"
+bp = Blueprint("user", __name__)
 
 def create_travel_agent():
-    model = ModelFactory.create(
-            model_platform=ModelPlatformType.OPENAI_COMPATIBLE_MODEL,
-            model_type="deepseek-ai/DeepSeek-V3",
-            url='https://api.siliconflow.cn/v1',
-            model_config_dict={"max_tokens": 4096},
-            api_key=os.getenv('FIRST_DEEPSEEK_API_KEY')
-    )
+    # camel 导入较慢，放到预热阶段执行
+    from camel.agents import ChatAgent
+    from llm_gateway import create_model
+
+    model = create_model("deepseek-ai/DeepSeek-V3", "FIRST_DEEPSEEK_API_KEY",
+                         model_config_dict={"max_tokens": 4096})
 
     agent = ChatAgent(
         system_message=SYSTEM_PROMPT,
@@ -76,17 +76,26 @@ def create_travel_agent():
     )
     return agent
 
-travel_agent = create_travel_agent()
+travel_agent = LazyResource("travel_agent", create_travel_agent)
+lifecycle = ServiceLifecycle("user", resources=[travel_agent])
 
-def get_travel_info_camel(user_input: str, agent: ChatAgent) -> dict:
+def get_travel_info_camel(user_input: str, agent: "ChatAgent") -> dict:
     try:
-        response = agent.step(user_input)
+        with stage("parse"), external_call("llm"):
+            response = agent.step(user_input)
         # 回到原始状态
         agent.reset()
         if not response or not response.msgs:
             raise ValueError("模型没有返回任何消息")
-        json_output = response.msgs[0].content.strip().replace("```json", "").replace("```", "").strip()
-        json_output = json.loads(json_output)
+        # 不依赖 ```json 代码块的具体格式，输出被截断时保留已完整的字段
+        content = response.msgs[0].content or ""
+        json_output = extract_json(content)
+        if not isinstance(json_output, dict):
+            raise json.JSONDecodeError("没有找到JSON对象", content, 0)
+        json_output.setdefault("city", None)
+        json_output.setdefault("days", None)
+        json_output.setdefault("need_more_info", not (json_output["city"] and json_output["days"]))
+        json_output.setdefault("response", None)
         json_output["query"] = user_input
         return json_output
     except json.JSONDecodeError:
@@ -118,7 +127,9 @@ def trigger_search_service(city: str, days: int) -> dict:
             "city": city,
             "days": days
         }
-        search_response = requests.post(SEARCH_SERVICE_URL, json=search_data, timeout=300)
+        with stage("search_service"):
+            search_response = requests.post(SEARCH_SERVICE_URL, json=search_data, timeout=300,
+                                            headers=request_id_headers())
         search_response.raise_for_status()
         return search_response.json()
     except requests.exceptions.RequestException as e:
@@ -135,7 +146,9 @@ def trigger_generate_service(city: str, days: int) -> dict:
             "city": city,
             "days": days
         }
-        generate_response = requests.post(GENERATE_SERVICE_URL, json=generate_data, timeout=300)
+        with stage("generate_service"):
+            generate_response = requests.post(GENERATE_SERVICE_URL, json=generate_data, timeout=300,
+                                              headers=request_id_headers())
         generate_response.raise_for_status()
         return generate_response.json()
     except requests.exceptions.RequestException as e:
@@ -170,14 +183,14 @@ def process_complete_pipeline(city: str, days: int) -> dict:
         }
     }
 
-@app.route('/extract_travel_info', methods=['POST'])
+@bp.route('/extract_travel_info', methods=['POST'])
 def extract_travel_info():
     try:
         request_data = request.get_json()
         if not request_data or 'query' not in request_data:
             return jsonify({'error': '请求数据无效'}), 400
 
-        result = get_travel_info_camel(request_data['query'], travel_agent)
+        result = get_travel_info_camel(request_data['query'], travel_agent.get())
         response = {
             'city': result['city'],
             'days': result['days'],
@@ -186,8 +199,9 @@ def extract_travel_info():
             'response': result['response']
         }
         
-        # 如果提取到了完整的信息，自动触发后续流程
-        if not result['need_more_info'] and result['city'] and result['days']:
+        # 如果提取到了完整的信息，自动触发后续流程（调用方可通过 auto_pipeline=false 关闭）
+        auto_pipeline = request_data.get('auto_pipeline', True)
+        if auto_pipeline and not result['need_more_info'] and result['city'] and result['days']:
             pipeline_result = process_complete_pipeline(result['city'], result['days'])
             response['pipeline_result'] = pipeline_result
         
@@ -196,5 +210,17 @@ def extract_travel_info():
     except Exception as e:
         return jsonify({'error': f'服务器内部错误: {str(e)}'}), 500
 
+def create_app(warm_up: bool = True) -> Flask:
+    """应用工厂：多进程部署时每个工作进程各自创建并预热，例如 gunicorn -w 4 'user:create_app()'"""
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    lifecycle.install(app)
+    if warm_up:
+        lifecycle.warm_up(background=True)
+    return app
+
+# 兼容 flask run 和 gunicorn user:app：模块级应用不预热，资源在首个请求时初始化
+app = create_app(warm_up=False)
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5001)
+    create_app().run(host="0.0.0.0", port=5001)
@@ -0,0 +1,195 @@
+"""
+图片预处理和图片描述缓存
+
+原来上传的图片按原始分辨率交给 Qwen2.5-VL-72B，每次提交都重新编码上传（例如 654KB 的
+沙漠图片.jpeg），同一张图片反复提问时也要再调用一次视觉模型。这里：
+1. 上传前把图片缩小到最长边不超过 max_edge，并重新编码为指定质量的JPEG；
+2. 用感知哈希（dHash）识别相同或几乎相同的图片（不同分辨率、重新压缩、轻微裁剪调色），
+   命中缓存时直接返回之前的描述，不再调用视觉模型。
+缓存可选持久化到 storage/vision_cache.json，换了提示词后旧缓存自动失效。
+"""
+import io
+import os
+import time
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+from camel.messages import BaseMessage as bm
+
+from agent_pool import AgentPool
+from persisted_cache import PersistedCache
+from settings import STORAGE_DIR
+
+VISION_CACHE_PATH = os.path.join(STORAGE_DIR, "vision_cache.json")
+
+# 缓存命中方式
+CACHE_EXACT = "exact"
+CACHE_NEAR = "near"
+CACHE_MISS = "miss"
+
+
+def preprocess_image(image: Image.Image, max_edge: int = 1280, quality: int = 85):
+    """
+    缩小图片并重新编码为JPEG
+
+    Returns:
+        (处理后的图片, JPEG字节数)。返回的图片 format 为 JPEG，camel 会按该格式编码上传。
+    """
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ("RGBA", "LA", "P"):
+        # 透明背景铺白色，避免转成JPEG后变黑
+        rgba = image.convert("RGBA")
+        background = Image.new("RGB", rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    if max(image.size) > max_edge:
+        image = image.copy()
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    size = buffer.tell()
+    buffer.seek(0)
+    result = Image.open(buffer)
+    result.load()
+    return result, size
+
+
+def perceptual_hash(image: Image.Image, hash_size: int = 8) -> int:
+    """差值哈希（dHash）：缩成 (hash_size+1)×hash_size 的灰度图，逐行比较相邻像素明暗，得到 hash_size² 位整数"""
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(gray.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class VisionCache(PersistedCache):
+    """线程安全的LRU缓存：感知哈希 -> 图片描述，汉明距离不超过 max_distance 视为同一张图片"""
+
+    label = "图片描述缓存"
+
+    def __init__(self, max_size: int = 256, path: str = None, max_distance: int = 5,
+                 prompt: str = "", save_every: int = 5):
+        self.max_size = max_size
+        self.max_distance = max_distance
+        self.prompt = prompt
+        self._data = OrderedDict()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        super().__init__(path, save_every)
+
+    def _restore(self, data: dict):
+        # 提示词变了，旧描述的侧重点可能不同
+        if data.get("prompt") != self.prompt:
+            print(f"图片描述缓存的提示词不一致，忽略旧缓存: {self.path}")
+            return
+        for key, description in data.get("entries", [])[-self.max_size:]:
+            self._data[int(key, 16)] = description
+        print(f"已加载 {len(self._data)} 条图片描述缓存")
+
+    def _snapshot(self) -> dict:
+        return {"prompt": self.prompt,
+                "entries": [[f"{key:x}", description] for key, description in self._data.items()]}
+
+    def get(self, image_hash: int):
+        """返回 (描述或None, 命中方式, 汉明距离)"""
+        with self._lock:
+            description = self._data.get(image_hash)
+            if description is not None:
+                self._data.move_to_end(image_hash)
+                self.hits += 1
+                return description, CACHE_EXACT, 0
+            best_key, best_distance = None, self.max_distance + 1
+            for key in self._data:
+                distance = hamming_distance(key, image_hash)
+                if distance < best_distance:
+                    best_key, best_distance = key, distance
+            if best_key is None:
+                self.misses += 1
+                return None, CACHE_MISS, None
+            self._data.move_to_end(best_key)
+            self.near_hits += 1
+            return self._data[best_key], CACHE_NEAR, best_distance
+
+    def put(self, image_hash: int, description: str):
+        with self._lock:
+            self._data[image_hash] = description
+            self._data.move_to_end(image_hash)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+            self._unsaved += 1
+            should_save = self._should_save()
+        if should_save:
+            self.save()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.near_hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.near_hits) / total if total else 0.0,
+            }
+
+
+class CachedVisionAnalyzer:
+    """
+    预处理图片、查询描述缓存，未命中时调用视觉模型
+
+    视觉智能体从池中取用（传入单个智能体时按需克隆），取出时清空对话记忆（否则之前上传的图片会随
+    每次请求一起重发），不同会话的图片可以同时分析。
+    """
+
+    def __init__(self, vision_agent, cache: VisionCache = None, prompt: str = "",
+                 max_edge: int = 1280, quality: int = 85):
+        self.agents = vision_agent if isinstance(vision_agent, AgentPool) else AgentPool.from_agent(vision_agent)
+        self.cache = cache
+        self.prompt = prompt
+        self.max_edge = max_edge
+        self.quality = quality
+
+    def image_key(self, image: Image.Image) -> str:
+        """图片的感知哈希（十六进制），与 analyze 使用相同的预处理，可作为其他缓存的键"""
+        processed, _ = preprocess_image(image, self.max_edge, self.quality)
+        return f"{perceptual_hash(processed):016x}"
+
+    def analyze(self, image: Image.Image) -> dict:
+        """
+        Returns:
+            dict: description（视觉模型返回为空时为None）、cache（命中方式）、distance、
+                  size（原始尺寸）、upload_size（处理后尺寸）、upload_bytes、seconds
+        """
+        start = time.perf_counter()
+        processed, upload_bytes = preprocess_image(image, self.max_edge, self.quality)
+        result = {"size": image.size, "upload_size": processed.size, "upload_bytes": upload_bytes,
+                  "cache": CACHE_MISS, "distance": None}
+        image_hash = perceptual_hash(processed)
+
+        description = None
+        if self.cache is not None:
+            description, result["cache"], result["distance"] = self.cache.get(image_hash)
+        if description is None:
+            vision_msg = bm.make_user_message(role_name="User", content=self.prompt, image_list=[processed])
+            with self.agents.acquire() as agent:
+                response = agent.step(vision_msg)
+            if response and getattr(response, 'msgs', None):
+                description = response.msgs[0].content
+                if self.cache is not None and description:
+                    self.cache.put(image_hash, description)
+        result["description"] = description
+        result["seconds"] = time.perf_counter() - start
+        return result
@@ -2,32 +2,55 @@ import requests
 import json
 import time
 import os
-from flask import Flask, request, jsonify, render_template, redirect, url_for
+from flask import Flask, Blueprint, request, jsonify, render_template, redirect, url_for, Response
+from jobs import JobManager
+from prefetch import PopularityTracker, PrefetchScheduler, GUIDE_TTL_SECONDS
+from lifecycle import ServiceLifecycle
+from metrics import request_id_headers, response_llm_calls, stage
+from settings import USER_SERVICE_URL, SEARCH_SERVICE_URL, GENERATE_SERVICE_URL, STORAGE_DIR
 
-app = Flask(__name__)
+bp = Blueprint("web_central", __name__)
+
+# SSE连接最长保持时间（秒），超时后由浏览器自动重连，避免长期占用工作线程
+SSE_MAX_SECONDS = 25
 
 class CentralService:
     def __init__(self):
         # 服务地址
-        self.user_service_url = "http://localhost:5001/extract_travel_info"
-        self.search_service_url = "http://localhost:5002/get_travel_plan"
-        self.generate_service_url = "http://localhost:5003/generate_itinerary_html"
+        self.user_service_url = USER_SERVICE_URL
+        self.search_service_url = SEARCH_SERVICE_URL
+        self.generate_service_url = GENERATE_SERVICE_URL
         
         # 确保存储目录存在
-        os.makedirs("storage", exist_ok=True)
+        os.makedirs(STORAGE_DIR, exist_ok=True)
         
         # 创建templates目录
         os.makedirs("templates", exist_ok=True)
     
-    def process_user_query(self, user_query):
-        """处理用户查询并协调三个服务"""
+    def guide_path(self, city, days):
+        """攻略HTML文件路径，与generate服务保存的文件名一致"""
+        return os.path.join(STORAGE_DIR, f"{city}{days}天旅游攻略.html")
+
+    def get_fresh_guide(self, city, days):
+        """返回未过期的已生成攻略路径，没有则返回None"""
+        path = self.guide_path(city, days)
+        if os.path.exists(path) and time.time() - os.path.getmtime(path) < GUIDE_TTL_SECONDS:
+            return path
+        return None
+
+    def process_user_query(self, user_query, progress=None):
+        """处理用户查询并协调三个服务，progress(stage, message) 用于上报阶段进度"""
+        if progress is None:
+            progress = lambda stage, message: None
         print(f"接收到用户查询: {user_query}")
         
         try:
-            # 第一步：发送到user服务
+            # 第一步：发送到user服务（后续流程由中枢负责，不让user服务重复触发）
             print("1. 发送查询到用户服务...")
-            user_data = {"query": user_query}
-            user_response = requests.post(self.user_service_url, json=user_data)
+            progress("user", "正在解析您的旅行需求...")
+            user_data = {"query": user_query, "auto_pipeline": False}
+            with stage("user_service"):
+                user_response = requests.post(self.user_service_url, json=user_data, headers=request_id_headers())
             
             if user_response.status_code != 200:
                 return {"error": f"用户服务请求失败: {user_response.status_code}", "details": user_response.text}
@@ -39,57 +62,137 @@ class CentralService:
             if user_result.get("need_more_info", True):
                 return {"status": "need_more_info", "message": user_result.get("response"), "missing": user_result}
             
+            city = user_result.get("city")
+            days = user_result.get("days")
+            popularity_tracker.record(city, days)
+
+            # 已有未过期的攻略（例如预取生成的）时直接返回
+            fresh_path = self.get_fresh_guide(city, days)
+            if fresh_path:
+                print(f"使用已生成的攻略: {fresh_path}")
+                progress("generate", "已找到最新生成的攻略，无需重新生成")
+                return {
+                    "status": "success",
+                    "message": f"已为您生成{city}{days}天的旅游攻略",
+                    "file_path": fresh_path,
+                    "city": city,
+                    "days": days,
+                    "from_cache": True
+                }
+
+            build_result = self.build_guide(city, days, progress=progress)
+            if "error" in build_result:
+                return build_result
+            
+            # 返回最终结果
+            return {
+                "status": "success",
+                "message": f"已为您生成{city}{days}天的旅游攻略",
+                "file_path": build_result.get("file_path"),
+                "html_content": build_result.get("html_content"),
+                "city": city,
+                "days": days
+            }
+            
+        except requests.exceptions.ConnectionError as e:
+            return {"error": f"连接服务失败，请确保所有服务都已启动: {str(e)}"}
+        except Exception as e:
+            return {"error": f"处理请求时发生错误: {str(e)}"}
+
+    def build_guide(self, city, days, progress=None):
+        """
+        调用search和generate服务生成（或刷新）指定城市和天数的攻略
+
+        结果中的 llm_calls 为两个服务实际发出的大模型调用次数（来自响应头，失败时也会返回已知部分）；
+        有服务没有返回调用次数时为None。
+        """
+        if progress is None:
+            progress = lambda stage, message: None
+        llm_calls = 0
+
+        def count(response):
+            nonlocal llm_calls
+            calls = response_llm_calls(response)
+            llm_calls = None if calls is None or llm_calls is None else llm_calls + calls
+
+        try:
             # 第二步：发送到search服务
             print("2. 发送到搜索服务...")
             print("这可能需要较长时间，请耐心等待...")
+            progress("search", f"正在搜索{city}的攻略、景点和美食信息...")
+            # HTML由下面的第三步生成，search服务不再自己调用generate
             search_data = {
-                "city": user_result.get("city"),
-                "days": user_result.get("days")
+                "city": city,
+                "days": days,
+                "generate": False
             }
             
-            search_response = requests.post(self.search_service_url, json=search_data)
+            with stage("search_service"):
+                search_response = requests.post(self.search_service_url, json=search_data,
+                                                headers=request_id_headers())
+            count(search_response)
             
             if search_response.status_code != 200:
-                return {"error": f"搜索服务请求失败: {search_response.status_code}", "details": search_response.text}
+                return {"error": f"搜索服务请求失败: {search_response.status_code}", "details": search_response.text,
+                        "llm_calls": llm_calls}
             
             search_result = search_response.json()
             print(f"搜索服务返回成功，已生成旅游信息JSON文件")
             
-            # 第三步：发送到generate服务
+            # 第三步：发送到generate服务，旅游信息刚刚更新，跳过generate服务的缓存
             print("3. 发送到生成服务...")
             print("正在生成HTML页面，请耐心等待...")
+            progress("generate", "正在生成攻略页面...")
             generate_data = {
-                "city": user_result.get("city"),
-                "days": str(user_result.get("days"))
+                "city": city,
+                "days": str(days),
+                "force_refresh": True
             }
             
-            generate_response = requests.post(self.generate_service_url, json=generate_data)
+            with stage("generate_service"):
+                generate_response = requests.post(self.generate_service_url, json=generate_data,
+                                                  headers=request_id_headers())
+            count(generate_response)
             
             if generate_response.status_code != 200:
-                return {"error": f"生成服务请求失败: {generate_response.status_code}", "details": generate_response.text}
+                return {"error": f"生成服务请求失败: {generate_response.status_code}", "details": generate_response.text,
+                        "llm_calls": llm_calls}
             
             generate_result = generate_response.json()
             print(f"生成服务返回成功，HTML文件已保存")
             
-            # 返回最终结果
             return {
                 "status": "success",
-                "message": f"已为您生成{user_result.get('city')}{user_result.get('days')}天的旅游攻略",
+                "message": f"{city}{days}天的旅游攻略已生成",
                 "file_path": generate_result.get("file_path"),
                 "html_content": generate_result.get("html_content"),
-                "city": user_result.get("city"),
-                "days": user_result.get("days")
+                "city": city,
+                "days": days,
+                "llm_calls": llm_calls
             }
-            
+
         except requests.exceptions.ConnectionError as e:
-            return {"error": f"连接服务失败，请确保所有服务都已启动: {str(e)}"}
+            return {"error": f"连接服务失败，请确保所有服务都已启动: {str(e)}", "llm_calls": llm_calls}
         except Exception as e:
-            return {"error": f"处理请求时发生错误: {str(e)}"}
+            return {"error": f"处理请求时发生错误: {str(e)}", "llm_calls": llm_calls}
 
 central_service = CentralService()
+job_manager = JobManager(max_workers=int(os.getenv("JOB_WORKERS", "2")), service="web_central")
+popularity_tracker = PopularityTracker()
+prefetch_scheduler = PrefetchScheduler.from_env(central_service, job_manager, popularity_tracker)
+# 中枢服务只转发请求，没有需要预热的模型
+lifecycle = ServiceLifecycle("web_central")
+
+def run_query_job(user_query, progress):
+    """后台任务：执行完整流程，结果中只保留页面展示需要的字段"""
+    result = central_service.process_user_query(user_query, progress=progress)
+    result.pop("html_content", None)
+    if result.get("file_path"):
+        result["file_name"] = os.path.basename(result["file_path"])
+    return result
 
 # 创建首页模板
-@app.route('/')
+@bp.route('/')
 def index():
     # 创建templates目录（如果不存在）
     os.makedirs("templates", exist_ok=True)
@@ -212,7 +315,7 @@ def index():
     
     <div id="loading" class="loading">
         <div class="spinner"></div>
-        <p>正在生成旅游攻略，这可能需要几分钟时间，请耐心等待...</p>
+        <p>正在提交任务...</p>
     </div>
     
     {% if message %}
@@ -232,14 +335,14 @@ def index():
             <li>计划去杭州旅行2天</li>
             <li>我想去成都</li>
         </ul>
-        <p><b>注意：</b>生成过程可能需要几分钟时间，尤其是在首次生成特定城市的攻略时。请耐心等待，不要关闭或刷新页面。</p>
+        <p><b>注意：</b>生成过程可能需要几分钟时间，尤其是在首次生成特定城市的攻略时。提交后会跳转到进度页面，可随时刷新查看进度。</p>
     </div>
 </body>
 </html>""")
     
     return render_template('index.html')
 
-@app.route('/process', methods=['POST'])
+@bp.route('/process', methods=['POST'])
 def process():
     user_query = request.form.get('query', '')
     if not user_query:
@@ -247,34 +350,56 @@ def process():
                               message="请输入有效的查询内容", 
                               message_type="error")
     
-    result = central_service.process_user_query(user_query)
-    
-    if "error" in result:
-        return render_template('index.html', 
-                              message=result["error"], 
-                              message_type="error",
-                              query=user_query)
-    elif result.get("status") == "need_more_info":
-        return render_template('index.html', 
-                              message=result["message"], 
-                              message_type="info",
-                              query=user_query)
-    else:
-        # 如果文件路径存在，则保存相对路径用于显示
-        file_path = result.get("file_path", "")
-        if file_path:
-            file_path = os.path.basename(file_path)
-            
-        return render_template('index.html', 
-                              message=result["message"], 
-                              message_type="success",
-                              file_path=file_path,
-                              query=user_query)
+    # 提交到后台执行，立即跳转到进度页面
+    job = job_manager.submit(run_query_job, user_query, meta={"query": user_query})
+    return redirect(url_for('.job_status', job_id=job.job_id))
+
+@bp.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return "任务不存在或已过期", 404
+    return render_template('status.html', job_id=job_id, query=job.meta.get("query", ""))
+
+@bp.route('/api/jobs/<job_id>')
+def job_status_api(job_id):
+    """轮询接口：返回任务状态以及 since 之后的进度事件"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "任务不存在或已过期"}), 404
+    since = request.args.get("since", 0, type=int)
+    return jsonify(job.to_dict(since=since))
+
+@bp.route('/api/jobs/<job_id>/events')
+def job_events(job_id):
+    """SSE接口：推送阶段进度，任务结束时发送 done 事件"""
+    if job_manager.get(job_id) is None:
+        return jsonify({"error": "任务不存在或已过期"}), 404
+    last_seq = request.headers.get("Last-Event-ID", 0, type=int)
+
+    def stream(last_seq):
+        yield "retry: 2000\n\n"
+        deadline = time.time() + SSE_MAX_SECONDS
+        while time.time() < deadline:
+            job_manager.wait_for_update(job_id, last_seq, timeout=deadline - time.time())
+            job = job_manager.get(job_id)
+            if job is None:
+                return
+            snapshot = job.to_dict(since=last_seq)
+            for event in snapshot["events"]:
+                last_seq = event["seq"]
+                yield f"id: {last_seq}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+            if job.finished:
+                yield f"event: done\ndata: {json.dumps(snapshot, ensure_ascii=False)}\n\n"
+                return
 
-@app.route('/view/<filename>')
+    return Response(stream(last_seq), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@bp.route('/view/<filename>')
 def view_file(filename):
     # 构建完整文件路径
-    file_path = os.path.join("storage", filename)
+    file_path = os.path.join(STORAGE_DIR, filename)
     
     # 检查文件是否存在
     if not os.path.exists(file_path):
@@ -287,6 +412,26 @@ def view_file(filename):
     # 直接返回HTML内容
     return html_content
 
+def create_app(warm_up: bool = True) -> Flask:
+    """
+    应用工厂。任务状态保存在进程内存中，部署时请使用单进程多线程，
+    例如 gunicorn -w 1 --threads 8 'web_central:create_app()'
+
+    开启预取时，warm_up 为 True 立即启动预取调度器，否则在首个请求时启动。
+    """
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    lifecycle.install(app)
+    if os.getenv("PREFETCH_ENABLED", "0") == "1":
+        if warm_up:
+            prefetch_scheduler.start()
+        else:
+            app.before_request(prefetch_scheduler.start)
+    return app
+
+# 兼容 flask run 和 gunicorn web_central:app：导入模块时不启动后台线程
+app = create_app(warm_up=False)
+
 if __name__ == '__main__':
     # 确保templates目录存在
     os.makedirs("templates", exist_ok=True)
@@ -294,4 +439,4 @@ if __name__ == '__main__':
     print("旅游攻略生成系统Web界面已启动")
     print("请访问 http://localhost:5000 使用系统")
     print("注意：搜索和生成服务可能需要较长时间，请耐心等待")
-    app.run(debug=True) 
\ No newline at end of file
+    create_app().run(debug=True, threaded=True, use_reloader=False) 
\ No newline at end of file